@@ -205,6 +205,24 @@ SKYLAB_MODULES_PACKAGE = "skylab.modules"  # : skylab/modules
 #mpi_cluster limits
 MAX_NODES_PER_CLUSTER = 5 #value set to 3 for uat   # max nodes per cluster ? 5
 MAX_TOTAL_INSTANCES = 11  # current limit of vcluster : 16 instances #change this value with correct limit
+# total nodes: number of booted, dependency-installed clusters kept for CreateMPIView to claim, e.g. {2: 1, 3: 1}
+# warm clusters count against MAX_TOTAL_INSTANCES
+WARM_POOL_SIZES = {}
+BOOTSTRAP_MARKER_FILE = '.skylab_bootstrap'  # in the home dir of the master node, fingerprints of installed dependencies
+MAX_CONCURRENT_TASKS_PER_CLUSTER = 3  # number of tasks executed at the same time per cluster
+MAX_CONCURRENT_ACTIVATIONS_PER_CLUSTER = 2  # toolsets activated at the same time per cluster, apart from tasks
+# e.g. './vcluster-resize {name} {size}', run in ~/vcluster on the frontend, size as in vcluster-start
+# the command has to update MPIEXEC_NODES_FILE like vcluster-start does, None disables autoscaling
+VCLUSTER_RESIZE_COMMAND = None
+AUTOSCALE_INTERVAL = 60  # in seconds, between queue depth checks of clusters created with autoscale
+AUTOSCALE_TASKS_PER_NODE = 1  # unfinished tasks per node before an autoscaled cluster grows
+AUTOSCALE_SCALE_DOWN_DELAY = 600  # in seconds without tasks before an autoscaled cluster shrinks back
+CLUSTER_IDLE_TTL = 24 * 60  # in minutes without tasks before a cluster is deleted, initial value of CreateMPIForm.idle_ttl
+IDLE_REAPER_INTERVAL = 300  # in seconds, between checks for idle clusters
+SSH_CONNECTIONS_PER_HOST = 2  # pooled ssh connections per cluster/frontend, concurrent tasks share them as channels
+SSH_KEEPALIVE_INTERVAL = 30  # in seconds, keepalive packets sent on idle pooled ssh connections
+CLUSTER_LIVENESS_CHECK_INTERVAL = 30  # in seconds, interval between liveness checks of cluster connections
+SSH_SFTP_SESSION_CACHE_SIZE = 4  # idle sftp sessions kept open per pooled ssh connection
 
 #ssh auth parameters for frontend
 FRONTEND_IP = "10.0.3.101"
@@ -239,8 +257,33 @@ JSMOL_SUPPORTED_FILE_EXT = [ #files with these extensions are rendered with jsmo
 ]
 
 TRY_WHILE_NOT_EXIT_MAX_TIME = 300  # in seconds, max wait time for try while not exit loops in project
+TASKLOG_FLUSH_INTERVAL = 2  # in seconds, task logs are inserted in batches at this interval
+TASKLOG_BUFFER_SIZE = 100  # pending task logs that trigger an immediate batch insert
+STATUS_EVENTS_BUFFER_SIZE = 1000  # latest task/cluster status events kept for long-polling clients
+STATUS_EVENTS_POLL_TIMEOUT = 25  # in seconds, max time a status events request is held open
+STATUS_EVENTS_MAX_LONG_POLLS = 8  # status events requests held open at the same time, each holds a wsgi thread
+STATUS_EVENTS_SHORT_POLL_INTERVAL = 10  # in seconds, between status events requests of clients over the long-poll limit
+AJAX_TABLE_PAGE_SIZE = 100  # rows per page of the task and mpi cluster list tables
 REMOTE_BASE_DIR = '/mirror' #root path for remote cluster
+BLOB_STORE_DIR = 'blobs'  # under MEDIA_ROOT, input files with the same content are stored once
+REMOTE_BLOB_CACHE_DIR = '/mirror/.blobs'  # uploaded input files by sha256, linked into tasks with the same inputs
+REMOTE_BLOB_CACHE_MAX_AGE = 7  # in days, cached files not used by any task since are removed
+# quantum espresso pseudopotentials are downloaded by the cluster from this url, e.g. a local mirror of upf_files
+# or file:///mirror/upf_files as a stand-in for tests
+QE_PSEUDO_MIRROR_URL = "http://www.quantum-espresso.org/wp-content/uploads/upf_files/"
+QE_PSEUDO_DOWNLOAD_WORKERS = 4  # parallel pseudopotential downloads per cluster
 MPIEXEC_NODES_FILE = '/mirror/nodes.txt' #path for text file containing list of mpi nodes
+NODE_MAX_CONSECUTIVE_FAILURES = 3  # nodes unreachable this many times in a row stop taking commands of a task
+VINA_CPU_PER_NODE = 0  # --cpu of each vina run, 0 to use every cpu of the node
+VINA_PROGRESS_UPDATE_INTERVAL = 5  # in seconds, min time between docking progress status updates of a task
+VINA_RESULTS_BATCH_SIZE = 100  # parsed vina results inserted per query while a screening runs
+VINA_RESULTS_PAGE_SIZE = 50  # rows per page of the ranked vina results
+MAX_SWEEP_POINTS = 100  # parameter combinations of a single parameter sweep task
+IMPI_IMAGES_PER_BATCH = 10  # images processed one after the other by each impi batch, batches run in parallel across nodes
+SFTP_UPLOAD_CHANNELS = 4  # number of parallel sftp channels used to upload the input files of a task
+BULK_UPLOAD_MIN_FILES = 50  # input sets with at least this many files are streamed as a single tar archive
+BULK_UPLOAD_COMPRESSION = 'gz'  # '' for an uncompressed tar, e.g. if input files are already compressed
+OUTPUT_ARCHIVE_COMPRESSION = 'gz'  # compression of retrieved output archives, 'gz' or 'zst' (requires zstd on the cluster)
 
 MESSAGE_TAGS = {
     messages.ERROR: 'danger' #to django messages class similar to bootstrap
@@ -1,7 +1,7 @@
 # Register your models here.
 from django.contrib import admin
 
-from skylab.models import ToolSet, Task, TaskLog, MPICluster, ToolActivation, Tool, SkyLabFile
+from skylab.models import ToolSet, Task, TaskLog, MPICluster, ToolActivation, Tool, SkyLabFile, ClusterCapacity
 
 admin.site.register(ToolSet)
 admin.site.register(Task)
@@ -10,3 +10,4 @@ admin.site.register(MPICluster)
 admin.site.register(ToolActivation)
 admin.site.register(Tool)
 admin.site.register(SkyLabFile)
+admin.site.register(ClusterCapacity)
@@ -12,16 +12,23 @@ import pkgutil
 import re
 import threading
 import time
+from datetime import timedelta
 
 from paramiko.ssh_exception import SSHException
 
 import spur
 from django.conf import settings
 from django.db.models.signals import post_save
+from django.utils import timezone
 from skylab.signals import queue_task
 
 import skylab.modules
-from skylab.models import MPICluster, Task, ToolSet, ToolActivation, Tool
+from skylab.bootstrap import ClusterBootstrap
+from skylab.jobs import TaskJob, DeleteClusterJob, ShrinkClusterJob, StopConsumerJob
+from skylab.models import MPICluster, Task, ToolSet, ToolActivation, Tool, ClusterCapacity, activation_cache
+from skylab.modules.basetool import RemoteArchiveError
+from skylab.sshpool import ssh_pool, CONNECTION_ERRORS
+from skylab.warmpool import warm_pool
 
 
 MAX_WAIT = settings.TRY_WHILE_NOT_EXIT_MAX_TIME
@@ -74,41 +81,43 @@ class MPIThreadManager(object):
                 self.threadHash[cluster.id] = t
                 t.start()
 
+        warm_pool.refill_async()
+
+        self.idle_reaper = IdleClusterReaper()
+        self.idle_reaper.start()
+
         super(MPIThreadManager, self).__init__()
 
     def connect_to_frontend(self):
-        if self.frontend_shell is None:
-            self.frontend_shell = spur.SshShell(hostname=settings.FRONTEND_IP,
-                                                username=settings.FRONTEND_USERNAME,
-                                                password=settings.FRONTEND_PASSWORD,
-                                                missing_host_key=spur.ssh.MissingHostKey.accept)
-            retries = 0
-            exit_loop = False
-            while not exit_loop:
-                try:
+        # the frontend shell is shared by all MPIThreads, cluster create/delete commands run as separate channels
+        retries = 0
+        exit_loop = False
+        while not exit_loop:
+            try:
+                if not self._connected_to_frontend.isSet():
                     self.logger.info("Connecting to frontend...")
-                    # check if connection is sucessful
-                    # from : http://stackoverflow.com/questions/28288533/check-if-paramiko-ssh-connection-is-still-alive
-                    channel = self.frontend_shell._get_ssh_transport().send_ignore()
+                self.frontend_shell = ssh_pool.get_shell(settings.FRONTEND_IP, settings.FRONTEND_USERNAME,
+                                                         settings.FRONTEND_PASSWORD)
+                if not self._connected_to_frontend.isSet():
                     self._connected_to_frontend.set()
                     self.logger.info("Connected to frontend...")
-                    exit_loop = True  # exit loop
+                exit_loop = True  # exit loop
 
-                except (spur.ssh.ConnectionError, EOFError) as e:
-                    self.logger.error("Error connecting to frontend", exc_info=True)
+            except CONNECTION_ERRORS:
+                self.logger.error("Error connecting to frontend", exc_info=True)
 
-                finally:
-                    if not exit_loop:
-                        retries += 1
-                        wait_time = min(math.pow(2, retries), MAX_WAIT)
-                        self.logger.debug('Waiting {0}s until next retry'.format(wait_time))
-                        time.sleep(wait_time)
+            finally:
+                if not exit_loop:
+                    retries += 1
+                    wait_time = min(math.pow(2, retries), MAX_WAIT)
+                    self.logger.debug('Waiting {0}s until next retry'.format(wait_time))
+                    time.sleep(wait_time)
         return self.frontend_shell
 
     def get_frontend_shell(self):
         if not self._connected_to_frontend.isSet():
             self._connected_to_frontend.wait()
-        return self.frontend_shell
+        return self.connect_to_frontend()  # health checked, reconnects if the connection dropped
 
     def receive_toolactivation_from_post_save_signal(self, sender, instance, created, **kwargs):
         if instance.status == 1:
@@ -116,37 +125,97 @@ class MPIThreadManager(object):
                 'Received ToolActivation #{0} ({1}) for MPI #{2}'.format(instance.id, instance.toolset.display_name,
                                                                          instance.mpi_cluster_id))
 
-            self.threadHash[instance.mpi_cluster_id].add_task_to_queue(1, "self.activate_tool({0})".format(
-                instance.toolset_id))
+            self.threadHash[instance.mpi_cluster_id].add_toolset_activation_to_queue(instance.toolset_id)
 
     def receive_task_from_queue_task_signal(self, task_instance, **kwargs):
         logging.info('Received Task #{0} for MPI #{1}'.format(task_instance.id, task_instance.mpi_cluster.cluster_name))
 
         # append to queue
-        self.threadHash[task_instance.mpi_cluster_id].add_task_to_queue(task_instance.priority, task_instance)
+        self.threadHash[task_instance.mpi_cluster_id].add_task_to_queue(task_instance)
 
     def receive_mpi_cluster_from_post_save_signal(self, sender, instance, created, **kwargs):
         if created:
             t = MPIThread(instance, self)
             self.threadHash[instance.id] = t
             t.start()
+        elif instance.queued_for_deletion and instance.status != 5 and instance.id in self.threadHash:
+            self.threadHash[instance.id].add_deletion_to_queue()  # delete cluster once its queue is drained
+
+class IdleClusterReaper(threading.Thread):
+    def __init__(self):
+        """
+        Every settings.IDLE_REAPER_INTERVAL seconds, queues the deletion of online clusters without unfinished tasks
+        whose last task activity is older than their idle TTL, the deletion runs the usual vcluster-stop path
+        Warm pool clusters are kept, they are idle until claimed
+        """
+        self.logger = logging.getLogger(__name__)
+        super(IdleClusterReaper, self).__init__()
+        self.daemon = True
+
+    def get_idle_clusters(self):
+        now = timezone.now()
+        for cluster in MPICluster.objects.filter(status=2, queued_for_deletion=False, is_warm_pool=False):
+            idle_ttl = cluster.get_idle_ttl()
+            if not idle_ttl:
+                continue
+            last_activity = cluster.last_activity or cluster.created
+            if now - last_activity >= timedelta(minutes=idle_ttl) and cluster.task_queued_count == 0:
+                yield cluster
+
+    def notify_creator(self, cluster):
+        if cluster.creator is None or not cluster.creator.email:
+            return
+        message = 'No tasks were run on your MPI cluster {0} for {1} minutes, it is being deleted.'.format(
+            cluster.cluster_name, cluster.get_idle_ttl())
+        cluster.creator.email_user('SkyLab: idle cluster {0} deleted'.format(cluster.cluster_name), message,
+                                   fail_silently=True)  # the deletion does not depend on the mail server
+
+    def run(self):
+        while True:
+            time.sleep(settings.IDLE_REAPER_INTERVAL)
+            try:
+                for cluster in self.get_idle_clusters():
+                    if MPICluster.objects.filter(pk=cluster.id, queued_for_deletion=False).update(
+                            queued_for_deletion=True) == 1:
+                        self.logger.info('MPI #{0} ({1}) of {2} was idle for {3} minutes, queued for deletion'.format(
+                            cluster.id, cluster.cluster_name, cluster.creator, cluster.get_idle_ttl()))
+                        self.notify_creator(cluster)
+                        MPICluster.objects.get(pk=cluster.id).save()  # post_save queues the deletion
+            except Exception:
+                self.logger.error('Error while reaping idle clusters', exc_info=True)
+
 
 class MPIThread(threading.Thread):
     def __init__(self, mpi_cluster, manager):
-        # current implementation. task_queue only has a single consumer.
-
         """"
-        This design can be improved and cater multiple consumers for this queue
-        In multiple consumers, this thread would be the producer
-        Consumers consume task queue, pass cluster_shell to consumer instances
-        Recommendation: Dynamic consumers spawn based on task intensity
-        If current task is light on resources regardless of expected running time,
-        A new consumer is signalled that it is allowed to consume
+        This thread is the producer for the cluster's task queue
+        Consumers (MPIConsumerThread) consume the task queue, each with its own connection to the cluster
+        At most settings.MAX_CONCURRENT_TASKS_PER_CLUSTER tasks run at the same time on a cluster
         """
         self.task_queue = Queue.PriorityQueue()
+        self.consumers = []
+        self.max_consumers = max(1, settings.MAX_CONCURRENT_TASKS_PER_CLUSTER)
 
         self._stop = threading.Event()
         self._ready = threading.Event()
+        self.connected = threading.Event()  # maintained by the liveness monitor, read by consumers before each job
+        self.liveness_monitor = ClusterLivenessMonitor(self)
+        self.autoscaler = ClusterAutoscaler(self)
+        self._job_done = threading.Condition()  # notified each time a consumer finishes a job
+        self._deletion_queued = False
+
+        # toolset activations run in their own lane, tasks only wait for the activation of their toolset
+        self.activation_queue = Queue.Queue()
+        self.activation_workers = []
+        self.max_activation_workers = max(1, settings.MAX_CONCURRENT_ACTIVATIONS_PER_CLUSTER)
+        self._activations = {}  # toolset id: threading.Event set once activated, duplicate activations are coalesced
+        self._parked_jobs = {}  # toolset id: jobs requeued once the activation is done, consumers do not wait
+        self._activations_lock = threading.Lock()
+
+        # executables that share remote directories outside the task dir are run one at a time
+        self._exclusive_locks = {}
+        self._exclusive_locks_lock = threading.Lock()
+
         self.manager = manager
         self.mpi_cluster = mpi_cluster
         self.frontend_shell = None
@@ -161,25 +230,26 @@ class MPIThread(threading.Thread):
         super(MPIThread, self).__init__()
 
     def connect_or_create(self):
-        if self.mpi_cluster.status == 0:  # create
+        created = self.mpi_cluster.status == 0
+        if created:  # create
             self.create_mpi_cluster()
         else:
             self.mpi_cluster.change_status(1)
 
         self.connect_to_cluster(init=True)  #get working cluster shell
 
-        if self.mpi_cluster.status == 0:  # create
-            self.install_dependencies()  #zip
+        self.install_dependencies(created=created)  # p2c-tools
+        if created:
             self.mpi_cluster.change_status(1)
 
         self.mpi_cluster.change_status(2)  # cluster available
+        self.connected.set()
         self._ready.set()
 
     def connect_to_cluster(self,init=False):
-        self.cluster_shell = spur.SshShell(hostname=self.mpi_cluster.cluster_ip, username=settings.CLUSTER_USERNAME,
-                                           password=settings.CLUSTER_PASSWORD,
-                                           missing_host_key=spur.ssh.MissingHostKey.accept)
-        self.test_cluster_connection(init=init)
+        self.cluster_shell = self.get_cluster_shell(init=init)
+        if self.cluster_shell is None:  # stopped while reconnecting
+            return
 
         # fix for unresponsive ssh from srg.ics
         self.logger.debug(self.log_prefix + 'Set mtu to 1454')
@@ -197,20 +267,23 @@ class MPIThread(threading.Thread):
         shmax_fixer.wait_for_result()
 
 
-    def test_cluster_connection(self, init=False):
+    def get_cluster_shell(self, init=False, slot=0):
+        # borrow a health checked shell from the connection pool, shells with the same slot share one ssh connection
         retries = 0
         exit_loop = False
         while not exit_loop:
+            if self._stop.isSet():  # cluster deleted
+                return None
             try:
                 self.logger.info(self.log_prefix + "Testing connection to cluster...")
-                # check if connection is sucessful
-                # from : http://stackoverflow.com/questions/28288533/check-if-paramiko-ssh-connection-is-still-alive
-                channel = self.cluster_shell._get_ssh_transport().send_ignore()
+                shell = ssh_pool.get_shell(self.mpi_cluster.cluster_ip, settings.CLUSTER_USERNAME,
+                                           settings.CLUSTER_PASSWORD, slot=slot)
                 exit_loop = True  # exit loop
 
-            except (spur.ssh.ConnectionError, EOFError) as e:
+            except CONNECTION_ERRORS:
                 self.logger.error(self.log_prefix + "Error connecting to cluster", exc_info=True)
-                self.mpi_cluster.change_status(4)
+                if retries == 0:  # once per outage, not on every retry
+                    self.mpi_cluster.change_status(4)
 
             finally:
                 if not exit_loop:
@@ -220,68 +293,20 @@ class MPIThread(threading.Thread):
                     time.sleep(wait_time)
 
         self.logger.info(self.log_prefix + "Connected to cluster...")
-        if not init:
+        if not init and retries > 0:
             self.mpi_cluster.change_status(2)
+        return shell
 
-    def install_dependencies(self):
-        retries = 0
-        exit_loop = False
-        while not exit_loop:
-
-
-            try:
-                # update p2c-tools
-                self.logger.debug(self.log_prefix + "Updating p2c-tools")
-                command = "rm p2c-tools*"
-                self.cluster_shell.run(["sh", "-c", command])
-
-                self.cluster_shell.run(["wget", "10.0.3.10/downloads/p2c/p2c-tools"])
-                self.cluster_shell.run(["chmod", "755", "p2c-tools"])
-                p2c_updater = self.cluster_shell.spawn(["./p2c-tools"], use_pty=True)
-                p2c_updater.stdin_write(settings.CLUSTER_PASSWORD + "\n")
-                self.logger.debug(self.log_prefix + p2c_updater.wait_for_result().output)
-                self.logger.debug(self.log_prefix + self.cluster_shell.run(["p2c-tools"]).output)
-                self.logger.debug(self.log_prefix + "Updated p2c-tools")
-
-                # sudo apt-get update
-                self.logger.debug(self.log_prefix + "Updating apt-get")
-                command = "sudo apt-get update"
-                apt_get_update_shell = self.cluster_shell.spawn(["sh", "-c", command], use_pty=True)
-                apt_get_update_shell.stdin_write(settings.CLUSTER_PASSWORD + "\n")
-                self.logger.debug(self.log_prefix + apt_get_update_shell.wait_for_result().output)
-                self.logger.debug(self.log_prefix + "Updated apt-get")
-
-                # install zip
-                self.logger.debug(self.log_prefix + "Installing zip")
-                command = "sudo apt-get install zip -y"
-                zip_shell = self.cluster_shell.spawn(["sh", "-c", command], use_pty=True)
-                time.sleep(1)
-                zip_shell.stdin_write(settings.CLUSTER_PASSWORD + "\n")
-                # zip_shell.stdin_write("Y\n")
-                self.logger.debug(self.log_prefix + zip_shell.wait_for_result().output)
-                self.logger.debug(self.log_prefix + "Installed zip")
-                exit_loop = True  # exit loop
-
-            except spur.RunProcessError as err:
-                # run process error with return code -1 (no value returned) is returned during unresponsive connection
-                if err.return_code == -1:  # no return code received
-                    self.logger.error(
-                        self.log_prefix + 'No response from server. Retrying command ({0})'.format(command))
-                else:
-                    self.logger.error(self.log_prefix + 'RuntimeError: ' + err.message)
-
-            except spur.ssh.ConnectionError:
-                self.logger.error(self.log_prefix + "Connection Error to MPI Cluster", exc_info=True)
+    def install_dependencies(self, created=False):
+        # skips installed steps, reconnecting to a bootstrapped cluster runs no commands
+        ClusterBootstrap(self).run(created=created)
 
-            finally:
-                if not exit_loop:
-                    retries += 1
-                    wait_time = min(math.pow(2, retries), MAX_WAIT)
-                    self.logger.debug('Waiting {0}s until next retry'.format(wait_time))
-                    time.sleep(wait_time)
+    def activate_toolset(self, toolset_id, shell):
+        # check if toolset is already activated, without a query once its activation is cached
+        if activation_cache.is_activated(self.mpi_cluster.id, toolset_id):
+            self.logger.debug(self.log_prefix + 'Toolset {0} is already activated'.format(toolset_id))
+            return
 
-    def activate_toolset(self, toolset_id):
-        # check if toolset is already activated
         tool_activation_instance = ToolActivation.objects.get(toolset=toolset_id, mpi_cluster=self.mpi_cluster.id)
         if not tool_activation_instance.status == 2:
             toolset = ToolSet.objects.get(pk=toolset_id)
@@ -299,7 +324,7 @@ class MPIThread(threading.Thread):
                 # else:
                 command = "p2c-tools activate {0}".format(toolset.p2ctool_name)
                 try:
-                    tool_activator = self.cluster_shell.spawn(["sh", "-c", command], use_pty=True)
+                    tool_activator = shell.spawn(["sh", "-c", command], use_pty=True)
                     tool_activator.stdin_write(settings.CLUSTER_PASSWORD + "\n")
                     tool_activator.wait_for_result()
                     self.logger.info(self.log_prefix + u"{0:s} is now activated.".format(toolset.display_name))
@@ -331,18 +356,19 @@ class MPIThread(threading.Thread):
 
     def create_mpi_cluster(self):
         self.logger.info(self.log_prefix + "Creating MPI Cluster")
-        self.frontend_shell = self.manager.get_frontend_shell()  # get working frontend_shell
         retries = 0
         exit_loop = False
         while not exit_loop:
-            command = "./vcluster-stop {0} {1}".format(self.mpi_cluster.cluster_name, self.mpi_cluster.cluster_size)
+            self.frontend_shell = self.manager.get_frontend_shell()  # get working frontend_shell
+            command = "./vcluster-stop {0} {1}".format(self.mpi_cluster.vcluster_name,
+                                                       self.mpi_cluster.cluster_size)
             try:
                 self.logger.debug(self.log_prefix + "Execute " + command)
                 self.frontend_shell.run(["sh", "-c", command], cwd="vcluster")
                 # self.frontend_shell.run(["./vcluster-stop", self.mpi_cluster.cluster_name, str(self.mpi_cluster.cluster_size)],
                 #                         cwd="vcluster")  # to remove duplicates in case server restart while creating
 
-                command = "./vcluster-start {0} {1}".format(self.mpi_cluster.cluster_name,
+                command = "./vcluster-start {0} {1}".format(self.mpi_cluster.vcluster_name,
                                                             self.mpi_cluster.cluster_size)
                 self.logger.debug(self.log_prefix + "Execute " + command)
                 result_cluster_ip = self.frontend_shell.run(["sh", "-c", command], cwd="vcluster")
@@ -387,102 +413,443 @@ class MPIThread(threading.Thread):
         # lower priority value are prioritized
 
         for task in tasks:
-            self.add_task_to_queue(task.priority, task)
+            self.add_task_to_queue(task)
 
         # get toolactivations queued for activation (status == 1)
         queued_toolset_activations = self.mpi_cluster.toolsets.filter(toolactivation__status=1)
         for toolset in queued_toolset_activations:
-            self.add_task_to_queue(1, "self.activate_toolset({0})".format(toolset.id))
+            self.add_toolset_activation_to_queue(toolset.id)
+
+        if self.mpi_cluster.queued_for_deletion:  # deletion requested before restart
+            self.add_deletion_to_queue()
+
         self._ready.wait()  # block waiting for connected event to be set
+        self.liveness_monitor.start()
+        if settings.VCLUSTER_RESIZE_COMMAND:  # clusters cannot be resized otherwise
+            self.autoscaler.start()
+
+        self.logger.info(self.log_prefix + 'Starting {0} consumer(s)'.format(self.max_consumers))
+        for consumer_id in range(self.max_consumers):
+            consumer = MPIConsumerThread(self, consumer_id)
+            self.consumers.append(consumer)
+            consumer.start()
+
+        for worker_id in range(self.max_activation_workers):
+            worker = ToolActivationThread(self, worker_id)
+            self.activation_workers.append(worker)
+            worker.start()
+
+        self._stop.wait()  # consumers process the task queue until the cluster is deleted
+        self.logger.info(self.log_prefix + 'Terminating ...')
+
+    def stop(self):
+        self._stop.set()
+        self.liveness_monitor.check_now()  # wakes the monitor so it terminates
+        self.autoscaler.wake()
+        for consumer in self.consumers:  # unblock consumers waiting on the task queue
+            self.add_job_to_queue(StopConsumerJob())
+        for worker in self.activation_workers:
+            self.activation_queue.put(None)
+
+    def job_done(self):
+        self.task_queue.task_done()
+        with self._job_done:
+            self._job_done.notify_all()
+
+    def wait_until_idle(self, unless_queued=False):
+        # block until the calling consumer's job is the only unfinished job
+        # returns False instead if unless_queued and other jobs are waiting or a deletion is queued,
+        # a deletion waiting in another consumer would wait for the calling job otherwise
+        with self._job_done:
+            while self.task_queue.unfinished_tasks > 1:
+                if unless_queued and (self._deletion_queued or not self.task_queue.empty() or self._parked_jobs):
+                    return False
+                self._job_done.wait()
+        return True
+
+    def delete_mpi_cluster(self):
+        self.logger.info(self.log_prefix + "Deleting MPI Cluster")
+        retries = 0
+        exit_loop = False
+        while not exit_loop:
+            self.frontend_shell = self.manager.get_frontend_shell()  # get working frontend_shell
+            command = "./vcluster-stop {0} {1}".format(self.mpi_cluster.vcluster_name,
+                                                       self.mpi_cluster.cluster_size)
+            try:
+                self.logger.debug(self.log_prefix + "Execute " + command)
+                self.frontend_shell.run(["sh", "-c", command], cwd="vcluster")
+                # self.frontend_shell.run(["./vcluster-stop", self.mpi_cluster.cluster_name,
+                # str(self.mpi_cluster.cluster_size)],
+                #                         cwd="vcluster")  # to remove duplicates in case server restart while creating
+                exit_loop = True  # exit loop
+
+            except spur.RunProcessError as err:
+                if err.return_code == -1:  # no return code received
+                    self.logger.error(
+                        self.log_prefix + 'No response from server. Retrying command ({0})'.format(
+                            command))
+                else:
+                    self.logger.error(self.log_prefix + 'RuntimeError: ' + err.message)
+
+            except spur.ssh.ConnectionError:
+                self.logger.error(self.log_prefix + "Connection Error to MPI Cluster", exc_info=True)
+
+            finally:
+                if not exit_loop:
+                    retries += 1
+                    wait_time = min(math.pow(2, retries), MAX_WAIT)
+                    self.logger.debug(self.log_prefix+'Waiting {0}s until next retry'.format(wait_time))
+                    time.sleep(wait_time)
+
+        self.logger.info(self.log_prefix + ' Cluster deleted')
+        ssh_pool.close_host(self.mpi_cluster.cluster_ip)
+        self.mpi_cluster.refresh_from_db()  # a warm pool claim may have renamed the cluster
+        self.mpi_cluster.cluster_name += ' (deleted)'
+        self.mpi_cluster.save()
+        self.mpi_cluster.toolsets.clear()  # clear toolsets, toolactivation
+        self.mpi_cluster.change_status(5)
+        warm_pool.refill_async()  # the released nodes may complete the pool
 
-        while not self._stop.isSet():
+    def resize_mpi_cluster(self, total_nodes):
+        """
+        Grows or shrinks the cluster with settings.VCLUSTER_RESIZE_COMMAND, nodes must already be reserved when growing
+        The command updates settings.MPIEXEC_NODES_FILE, released nodes are returned to the capacity ledger
+        :return: True if the cluster was resized
+        """
+        self.mpi_cluster.refresh_from_db()
+        current_nodes = self.mpi_cluster.total_node_count
+        command = settings.VCLUSTER_RESIZE_COMMAND.format(name=self.mpi_cluster.vcluster_name, size=total_nodes - 1)
+        self.logger.info(self.log_prefix + 'Resizing MPI Cluster from {0} to {1} nodes'.format(current_nodes,
+                                                                                               total_nodes))
+        try:
+            self.frontend_shell = self.manager.get_frontend_shell()  # get working frontend_shell
+            self.logger.debug(self.log_prefix + "Execute " + command)
+            self.frontend_shell.run(["sh", "-c", command], cwd="vcluster")
+        except spur.RunProcessError as err:
+            self.logger.error(self.log_prefix + 'RuntimeError: ' + err.message)
+            return False
+        except CONNECTION_ERRORS:
+            self.logger.error(self.log_prefix + "Connection Error to frontend", exc_info=True)
+            return False
 
-            self.logger.debug(self.log_prefix + 'Waiting 5 seconds, before processing again')
-            event_is_set = self._stop.wait(5)
+        self.mpi_cluster.refresh_from_db()
+        self.mpi_cluster.cluster_size = total_nodes - 1
+        self.mpi_cluster.save()
+        if total_nodes < current_nodes:
+            ClusterCapacity.release(current_nodes - total_nodes)
+        self.check_nodes_file(total_nodes)
+        return True
+
+    def check_nodes_file(self, total_nodes):
+        # hostnames used by mpirun -f and run_commands_across_nodes, written by vcluster on the master node
+        shell = self.get_cluster_shell(init=True)
+        if shell is None:  # cluster deleted
+            return
+        try:
+            output = shell.run(['cat', settings.MPIEXEC_NODES_FILE]).output
+        except spur.RunProcessError as err:
+            self.logger.error(self.log_prefix + 'Could not read nodes file: ' + err.message)
+            return
+        hostnames = set(line.split('#')[0].strip().split(':')[0] for line in output.splitlines()) - {''}
+        if len(hostnames) != total_nodes:
+            self.logger.warning(self.log_prefix + '{0} lists {1} nodes instead of {2} after resizing'.format(
+                settings.MPIEXEC_NODES_FILE, len(hostnames), total_nodes))
+
+    def add_job_to_queue(self, job):
+        self.task_queue.put(job)
+        self.logger.debug(self.log_prefix + 'Queued {0}'.format(job))
+
+    def record_activity(self):
+        # read by the idle reaper
+        MPICluster.objects.filter(pk=self.mpi_cluster.id).update(last_activity=timezone.now())
+
+    def add_task_to_queue(self, task):
+        self.add_job_to_queue(TaskJob(task))
+        self.record_activity()
+        task.change_status(status_code=101, status_msg="Task queued")
+        try:
+            get_executable_class(task).prefetch_inputs(task, self)
+        except Exception:  # the task fetches its inputs when it runs
+            self.logger.error(self.log_prefix + 'Error while prefetching inputs of task {0}'.format(task.id),
+                              exc_info=True)
+
+    def add_toolset_activation_to_queue(self, toolset_id):
+        with self._activations_lock:
+            if toolset_id in self._activations:
+                self.logger.debug(self.log_prefix + 'Activation of toolset {0} already queued'.format(toolset_id))
+                return
+            self._activations[toolset_id] = threading.Event()
+        self.activation_queue.put(toolset_id)
+        self.logger.debug(self.log_prefix + 'Queued activation of toolset {0}'.format(toolset_id))
+
+    def add_deletion_to_queue(self):
+        with self._job_done:
+            if self._deletion_queued:
+                return
+            self._deletion_queued = True
+            self._job_done.notify_all()  # a waiting shrink gives way to the deletion
+        self.add_job_to_queue(DeleteClusterJob())
+
+    def activation_done(self, toolset_id):
+        # also called when the activation failed, tasks of the toolset are not parked forever
+        with self._activations_lock:
+            activation = self._activations.pop(toolset_id)
+            for job in self._parked_jobs.pop(toolset_id, []):  # keep their priority and sequence
+                self.add_job_to_queue(job)
+        activation.set()  # parked jobs are queued by the time waiting deletions wake up
+
+    def wait_until_activated(self):
+        # block until no toolset activation is queued, the jobs parked on them are back in the task queue by then
+        while True:
+            with self._activations_lock:
+                activations = list(self._activations.values())
+            if not activations:
+                return
+            for activation in activations:
+                activation.wait()
+
+    def park_until_activated(self, job, toolset_id):
+        # parks the job while its toolset is queued for activation, other activations do not matter
+        # :return: True if the job was parked, activation_done requeues it
+        with self._activations_lock:
+            if toolset_id not in self._activations:
+                return False
+            self._parked_jobs.setdefault(toolset_id, []).append(job)
+        self.logger.debug(self.log_prefix + 'Parked {0} until toolset {1} is activated'.format(job, toolset_id))
+        return True
+
+    def get_exclusive_lock(self, executable_name):
+        with self._exclusive_locks_lock:
+            if executable_name not in self._exclusive_locks:
+                self._exclusive_locks[executable_name] = threading.Lock()
+            return self._exclusive_locks[executable_name]
+
+
+class MPIConsumerThread(threading.Thread):
+    def __init__(self, mpi_thread, consumer_id):
+        # consumes the task queue of mpi_thread, sharing pooled ssh connections to the cluster
+        self.mpi_thread = mpi_thread
+        self.consumer_id = consumer_id
+        self.cluster_shell = None
+        self.logger = mpi_thread.logger
+        self.log_prefix = '{0}[Consumer {1}] : '.format(mpi_thread.log_prefix, consumer_id)
+        super(MPIConsumerThread, self).__init__()
 
-            # test cluster connection before processing
-            self.test_cluster_connection()
+    def connect_to_cluster(self, init=True):
+        self.cluster_shell = self.mpi_thread.get_cluster_shell(init=init, slot=self.consumer_id)
 
-            if event_is_set:
-                self.logger.info(self.log_prefix + 'Terminating ...')
-            else:
-                try:
-                    queue_obj = self.task_queue.get(block=True, timeout=60) #block wait for 60s, then raise exception
-
-                    if queue_obj[0] == 1:  # p2c-tools activate are always priority # 1
-                        self.logger.debug(self.log_prefix + "Running " + queue_obj[1])
-                        exec (queue_obj[1])
-
-                    elif isinstance(queue_obj[1], Task):
-                        current_task = queue_obj[1]
-                        current_task.refresh_from_db()  # refresh instance
-                        task_log_prefix = '[Task {0} ({1})] : '.format(current_task.id, current_task.tool.display_name)
-                        self.logger.info('{0}Processing {1}'.format(self.log_prefix, task_log_prefix))
-                        mod = importlib.import_module('{0}.executables'.format(current_task.tool.toolset.package_name))
-
-                        cls = getattr(mod, current_task.tool.executable_name)
-                        executable_obj = cls(shell=self.cluster_shell, task=current_task, logger=self.logger,
-                                             log_prefix=self.log_prefix + task_log_prefix)
-                        try:
-                            executable_obj.run_tool()
-                        except SSHException:
-                            current_task.refresh_from_db()
-                            current_task.priority += 1
-                            current_task.save()
-                            self.logger.error(self.log_prefix + task_log_prefix + "SSH Connection dropped. Reconnecting to cluster and requeue task with lower priority.")
-                            self.connect_to_cluster(init=False)
-                            self.add_task_to_queue(current_task.priority, current_task)
-                    self.task_queue.task_done()
-                except Queue.Empty:
-                    if self.mpi_cluster.queued_for_deletion:  # if queue is empty and cluster is queued for deletion
-                        self._stop.set()
-                        self.logger.info(self.log_prefix + "Deleting MPI Cluster")
-                        self.frontend_shell = self.manager.get_frontend_shell()  # get working frontend_shell
-                        retries = 0
-                        exit_loop = False
-                        while not exit_loop:
-                            command = "./vcluster-stop {0} {1}".format(self.mpi_cluster.cluster_name,
-                                                                       self.mpi_cluster.cluster_size)
-                            try:
-                                self.logger.debug(self.log_prefix + "Execute " + command)
-                                self.frontend_shell.run(["sh", "-c", command], cwd="vcluster")
-                                # self.frontend_shell.run(["./vcluster-stop", self.mpi_cluster.cluster_name,
-                                # str(self.mpi_cluster.cluster_size)],
-                                #                         cwd="vcluster")  # to remove duplicates in case server restart while creating
-                                exit_loop = True  # exit loop
-
-                            except spur.RunProcessError as err:
-                                if err.return_code == -1:  # no return code received
-                                    self.logger.error(
-                                        self.log_prefix + 'No response from server. Retrying command ({0})'.format(
-                                            command))
-                                else:
-                                    self.logger.error(self.log_prefix + 'RuntimeError: ' + err.message)
-
-                            except spur.ssh.ConnectionError:
-                                self.logger.error(self.log_prefix + "Connection Error to MPI Cluster", exc_info=True)
-
-                            finally:
-                                if not exit_loop:
-                                    retries += 1
-                                    wait_time = min(math.pow(2, retries), MAX_WAIT)
-                                    self.logger.debug(self.log_prefix+'Waiting {0}s until next retry'.format(wait_time))
-                                    time.sleep(wait_time)
-
-                        self.logger.info(self.log_prefix + ' Cluster deleted')
-                        self.mpi_cluster.cluster_name += ' (deleted)'
-                        self.mpi_cluster.save()
-                        self.mpi_cluster.toolsets.clear()  # clear toolsets, toolactivation
-                        self.mpi_cluster.change_status(5)
-                    else:
-                        self.logger.debug(self.log_prefix+"Queue is empty. Sleeping for 30 seconds")
-                        time.sleep(30) #sleep for 30 seconds before processing again, since queue is empty
-
-    def add_task_to_queue(self, priority, task):
-        self.task_queue.put((priority, task))
-        if isinstance(task, Task):
-            task.change_status(status_code=101, status_msg="Task queued")
-            self.logger.debug(self.log_prefix + 'Queued task [id:{0},priority:{1}]'.format(task.id, priority))
+    def run(self):
+        self.connect_to_cluster()
+        while True:
+            job = self.mpi_thread.task_queue.get(block=True)  # wakes up as soon as a job is queued
+            try:
+                if job.stops_consumer:
+                    break
+
+                if job.requires_connection:
+                    self.mpi_thread.connected.wait()  # blocks only while the liveness monitor is reconnecting
+                    if self.cluster_shell is None or self.cluster_shell.closed:  # discarded from the pool
+                        self.connect_to_cluster()
+                    if self.cluster_shell is None:  # None once the cluster is deleted
+                        self.logger.debug(self.log_prefix + 'Cluster deleted, skipping {0}'.format(job))
+                        continue
+                self.logger.debug(self.log_prefix + 'Running {0}'.format(job))
+                job.execute(self)
+            except Exception:  # keep consuming, a failed job must not take the consumer down with it
+                self.logger.error(self.log_prefix + 'Error while running {0}'.format(job), exc_info=True)
+            finally:
+                self.mpi_thread.job_done()
+
+        self.logger.info(self.log_prefix + 'Terminating ...')
+
+    def process_task(self, current_task):
+        current_task.refresh_from_db()  # refresh instance
+        task_log_prefix = '[Task {0} ({1})] : '.format(current_task.id, current_task.tool.display_name)
+        self.logger.info('{0}Processing {1}'.format(self.log_prefix, task_log_prefix))
+        cls = get_executable_class(current_task)
+        executable_obj = cls(shell=self.cluster_shell, task=current_task, logger=self.logger,
+                             log_prefix=self.log_prefix + task_log_prefix)
+
+        if cls.allow_concurrent_runs:
+            self.run_executable(executable_obj, current_task, task_log_prefix)
+        else:
+            with self.mpi_thread.get_exclusive_lock(current_task.tool.executable_name):
+                self.run_executable(executable_obj, current_task, task_log_prefix)
+
+    def run_executable(self, executable_obj, current_task, task_log_prefix):
+        try:
+            executable_obj.run_tool()
+        except SSHException:
+            current_task.refresh_from_db()
+            current_task.priority += 1
+            current_task.save()
+            self.logger.error(self.log_prefix + task_log_prefix + "SSH Connection dropped. Reconnecting to cluster and requeue task with lower priority.")
+            ssh_pool.discard(self.cluster_shell)
+            # the monitor checks the other pooled connections, this consumer reconnects before its next job
+            # mtu and shmmax are only reapplied by MPIThread.connect_to_cluster, when the whole cluster was unreachable
+            self.mpi_thread.liveness_monitor.check_now()
+            self.mpi_thread.add_task_to_queue(current_task)
+        except RemoteArchiveError as err:
+            self.logger.error(self.log_prefix + task_log_prefix + err.message)
+            current_task.change_status(status_code=401, status_msg='Output files could not be retrieved')
+        finally:  # failed tasks are activity too
+            self.mpi_thread.record_activity()
+
+
+class ToolActivationThread(threading.Thread):
+    def __init__(self, mpi_thread, worker_id):
+        """
+        Runs p2c-tools activate for toolsets in mpi_thread.activation_queue, apart from the task queue
+        settings.MAX_CONCURRENT_ACTIVATIONS_PER_CLUSTER activations run at the same time on a cluster
+        """
+        self.mpi_thread = mpi_thread
+        self.worker_id = worker_id
+        self.cluster_shell = None
+        self.logger = mpi_thread.logger
+        self.log_prefix = '{0}[Activation {1}] : '.format(mpi_thread.log_prefix, worker_id)
+        super(ToolActivationThread, self).__init__()
+
+    def connect_to_cluster(self):
+        # slots after the consumers', shared with them if there are fewer pooled connections
+        self.cluster_shell = self.mpi_thread.get_cluster_shell(init=True,
+                                                               slot=self.mpi_thread.max_consumers + self.worker_id)
+
+    def run(self):
+        self.connect_to_cluster()
+        while True:
+            toolset_id = self.mpi_thread.activation_queue.get(block=True)
+            if toolset_id is None:  # cluster deleted
+                break
+            try:
+                self.mpi_thread.connected.wait()  # blocks only while the liveness monitor is reconnecting
+                if self.cluster_shell is None or self.cluster_shell.closed:
+                    self.connect_to_cluster()
+                if self.cluster_shell is not None:  # None once the cluster is deleted
+                    self.mpi_thread.activate_toolset(toolset_id, self.cluster_shell)
+            except Exception:
+                self.logger.error(self.log_prefix + 'Error while activating toolset {0}'.format(toolset_id),
+                                  exc_info=True)
+            finally:
+                self.mpi_thread.activation_done(toolset_id)
+
+        self.logger.info(self.log_prefix + 'Terminating ...')
+
+
+class ClusterAutoscaler(threading.Thread):
+    def __init__(self, mpi_thread):
+        """
+        Every settings.AUTOSCALE_INTERVAL seconds, resizes clusters created with autoscale to their unfinished tasks
+        Grows to one node per settings.AUTOSCALE_TASKS_PER_NODE tasks, up to settings.MAX_NODES_PER_CLUSTER and
+        as far as the capacity ledger allows. Shrinks back to the size chosen by the creator after
+        settings.AUTOSCALE_SCALE_DOWN_DELAY seconds without tasks, once running tasks are finished
+        """
+        self.mpi_thread = mpi_thread
+        self.logger = mpi_thread.logger
+        self.log_prefix = '{0}[Autoscaler] : '.format(mpi_thread.log_prefix)
+        self._wake = threading.Event()
+        self._last_busy = time.time()
+        self._shrink_queued = False
+        super(ClusterAutoscaler, self).__init__()
+
+    def wake(self):
+        self._wake.set()
+
+    def get_target_nodes(self, mpi_cluster, task_count):
+        min_nodes = mpi_cluster.min_cluster_size + 1
+        demand = int(math.ceil(float(task_count) / max(1, settings.AUTOSCALE_TASKS_PER_NODE)))
+        return min(settings.MAX_NODES_PER_CLUSTER, max(min_nodes, demand))
+
+    def grow(self, current_nodes, target_nodes):
+        # reserve as many of the missing nodes as the ledger allows
+        extra = target_nodes - current_nodes
+        while extra > 0 and not ClusterCapacity.reserve(extra):
+            extra -= 1
+        if extra == 0:
+            self.logger.debug(self.log_prefix + 'No nodes available to grow the cluster')
+            return
+        if not self.mpi_thread.resize_mpi_cluster(current_nodes + extra):
+            ClusterCapacity.release(extra)
+
+    def check(self):
+        mpi_cluster = self.mpi_thread.mpi_cluster
+        mpi_cluster.refresh_from_db()  # autoscale may be set when a warm cluster is claimed
+        if not mpi_cluster.autoscale or mpi_cluster.queued_for_deletion or mpi_cluster.status != 2:
+            return
+        if mpi_cluster.min_cluster_size is None:
+            MPICluster.objects.filter(pk=mpi_cluster.id).update(min_cluster_size=mpi_cluster.cluster_size)
+            mpi_cluster.min_cluster_size = mpi_cluster.cluster_size
+
+        task_count = mpi_cluster.task_queued_count
+        if task_count > 0:
+            self._last_busy = time.time()
+            self._shrink_queued = False
+
+        current_nodes = mpi_cluster.total_node_count
+        target_nodes = self.get_target_nodes(mpi_cluster, task_count)
+        if target_nodes > current_nodes:
+            self.grow(current_nodes, target_nodes)
+        elif target_nodes < current_nodes and task_count == 0 and not self._shrink_queued and \
+                time.time() - self._last_busy >= settings.AUTOSCALE_SCALE_DOWN_DELAY:
+            self._shrink_queued = True
+            self.mpi_thread.add_job_to_queue(ShrinkClusterJob(target_nodes))
+
+    def run(self):
+        while True:
+            self._wake.wait(settings.AUTOSCALE_INTERVAL)
+            self._wake.clear()
+            if self.mpi_thread._stop.isSet():
+                break
+            try:
+                self.check()
+            except Exception:
+                self.logger.error(self.log_prefix + 'Error while autoscaling', exc_info=True)
+
+        self.logger.info(self.log_prefix + 'Terminating ...')
+
+
+class ClusterLivenessMonitor(threading.Thread):
+    def __init__(self, mpi_thread):
+        """
+        Checks the pooled ssh connections to the cluster every settings.CLUSTER_LIVENESS_CHECK_INTERVAL seconds
+        Dead transports are detected by ssh keepalives, no command is run on the cluster
+        mpi_thread.connected is cleared while reconnecting with exponential backoff
+        """
+        self.mpi_thread = mpi_thread
+        self.logger = mpi_thread.logger
+        self.log_prefix = '{0}[Liveness] : '.format(mpi_thread.log_prefix)
+        self._check_requested = threading.Event()
+        super(ClusterLivenessMonitor, self).__init__()
+
+    def check_now(self):
+        self._check_requested.set()
+
+    def cluster_is_alive(self):
+        alive = True
+        for shell in ssh_pool.get_host_shells(self.mpi_thread.mpi_cluster.cluster_ip):
+            if not shell.is_healthy():
+                ssh_pool.discard(shell)  # borrowers reconnect through the pool
+                alive = False
+        return alive
+
+    def run(self):
+        while True:
+            self._check_requested.wait(settings.CLUSTER_LIVENESS_CHECK_INTERVAL)
+            self._check_requested.clear()
+            if self.mpi_thread._stop.isSet():
+                break
+
+            if not self.cluster_is_alive():
+                self.mpi_thread.connected.clear()
+                self.logger.error(self.log_prefix + 'Lost connection to cluster')
+                self.mpi_thread.connect_to_cluster(init=False)  # retries until the cluster is reachable
+                self.mpi_thread.connected.set()
+
+        self.logger.info(self.log_prefix + 'Terminating ...')
+
+
+def get_executable_class(task):
+    mod = importlib.import_module('{0}.executables'.format(task.tool.toolset.package_name))
+    return getattr(mod, task.tool.executable_name)
 
 
 def install_toolsets():  # searches for packages inside modules folder
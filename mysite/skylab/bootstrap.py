@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import math
+import pipes
+import threading
+import time
+
+import spur
+from django.conf import settings
+
+from skylab.models import MPICluster
+from skylab.sshpool import CONNECTION_ERRORS
+
+MAX_WAIT = settings.TRY_WHILE_NOT_EXIT_MAX_TIME
+
+
+class BootstrapStep(object):
+    """
+    Commands run in order on the master node, as (command, needs_password) pairs
+    Commands that need a password (sudo, p2c-tools) are run in a pty and sent settings.CLUSTER_PASSWORD
+    """
+
+    def __init__(self, name, commands, requires=()):
+        self.name = name
+        self.commands = commands
+        self.requires = requires  # names of steps that have to finish first
+
+    @property
+    def fingerprint(self):
+        # changing the commands of a step installs it again on every cluster
+        return hashlib.sha1(json.dumps(self.commands)).hexdigest()[:12]
+
+
+BOOTSTRAP_STEPS = [
+    BootstrapStep('p2c-tools', [
+        ('rm -f p2c-tools*', False),
+        ('wget 10.0.3.10/downloads/p2c/p2c-tools', False),
+        ('chmod 755 p2c-tools', False),
+        ('./p2c-tools', True),  # self update
+        ('p2c-tools', False),
+    ]),
+    BootstrapStep('apt-update', [('sudo apt-get update', True)]),
+]
+
+
+class ClusterBootstrap(object):
+    """
+    Installs the dependencies of a cluster, skipping steps whose fingerprint is already recorded
+    Fingerprints of finished steps are kept in MPICluster.bootstrap_fingerprint and in
+    settings.BOOTSTRAP_MARKER_FILE on the master node, the node marker is checked when the cluster was (re)created
+    Existing clusters are only bootstrapped again when a step's fingerprint changes
+    Steps run concurrently once the steps they require are done, a failed step is retried on its own
+    """
+
+    def __init__(self, mpi_thread, steps=BOOTSTRAP_STEPS):
+        self.mpi_thread = mpi_thread
+        self.steps = steps
+        self.logger = logging.getLogger(__name__)
+        self._installed = {}  # step name: fingerprint
+        self._lock = threading.Lock()
+
+    @property
+    def log_prefix(self):
+        return self.mpi_thread.log_prefix
+
+    def get_expected_fingerprint(self):
+        return {step.name: step.fingerprint for step in self.steps}
+
+    def _read_db(self):
+        try:
+            return json.loads(self.mpi_thread.mpi_cluster.bootstrap_fingerprint or '{}')
+        except ValueError:
+            return {}
+
+    def _read_marker(self, shell):
+        result = shell.run(['sh', '-c', 'cat {0}'.format(pipes.quote(settings.BOOTSTRAP_MARKER_FILE))],
+                           allow_error=True)
+        if result.return_code != 0:  # no marker, nothing installed yet
+            return {}
+        try:
+            return json.loads(result.output)
+        except ValueError:
+            return {}
+
+    def _save_db(self, fingerprint):
+        mpi_cluster = self.mpi_thread.mpi_cluster
+        mpi_cluster.bootstrap_fingerprint = fingerprint
+        # update instead of save, the cluster may have been claimed or renamed meanwhile
+        MPICluster.objects.filter(pk=mpi_cluster.id).update(bootstrap_fingerprint=fingerprint)
+
+    def _record(self, shell, step):
+        with self._lock:
+            self._installed[step.name] = step.fingerprint
+            fingerprint = json.dumps(self._installed, sort_keys=True)
+            marker = pipes.quote(settings.BOOTSTRAP_MARKER_FILE)
+            command = 'printf "%s" {0} > {1}.tmp && mv {1}.tmp {1}'.format(pipes.quote(fingerprint), marker)
+            shell.run(['sh', '-c', command])
+            self._save_db(fingerprint)
+
+    def _run_command(self, shell, command, needs_password):
+        self.logger.debug(self.log_prefix + 'Execute ' + command)
+        if needs_password:
+            process = shell.spawn(['sh', '-c', command], use_pty=True)
+            time.sleep(1)  # wait for the password prompt
+            process.stdin_write(settings.CLUSTER_PASSWORD + "\n")
+            output = process.wait_for_result().output
+        else:
+            output = shell.run(['sh', '-c', command]).output
+        self.logger.debug(self.log_prefix + output)
+
+    def _run_step(self, step, slot, done):
+        try:
+            for name in step.requires:
+                done[name].wait()
+
+            self.logger.debug(self.log_prefix + 'Installing ' + step.name)
+            retries = 0
+            exit_loop = False
+            while not exit_loop:
+                shell = self.mpi_thread.get_cluster_shell(init=True, slot=slot)
+                if shell is None:  # cluster deleted
+                    return
+                try:
+                    for command, needs_password in step.commands:
+                        self._run_command(shell, command, needs_password)
+                    self._record(shell, step)
+                    self.logger.debug(self.log_prefix + 'Installed ' + step.name)
+                    exit_loop = True  # exit loop
+
+                except spur.RunProcessError as err:
+                    # run process error with return code -1 (no value returned) is returned during unresponsive connection
+                    if err.return_code == -1:  # no return code received
+                        self.logger.error(self.log_prefix + 'No response from server. Retrying ' + step.name)
+                    else:
+                        self.logger.error(self.log_prefix + 'RuntimeError: ' + err.message)
+
+                except CONNECTION_ERRORS:
+                    self.logger.error(self.log_prefix + "Connection Error to MPI Cluster", exc_info=True)
+
+                finally:
+                    if not exit_loop:
+                        retries += 1
+                        wait_time = min(math.pow(2, retries), MAX_WAIT)
+                        self.logger.debug('Waiting {0}s until next retry'.format(wait_time))
+                        time.sleep(wait_time)
+        finally:
+            done[step.name].set()  # steps requiring this one stop waiting even if the cluster was deleted
+
+    def run(self, created=False):
+        """
+        :param created: the cluster was just created, its nodes may not have the installed steps of the database record
+        """
+        expected = self.get_expected_fingerprint()
+        if not created:
+            installed = self._read_db()
+            if not installed:  # cluster bootstrapped before fingerprints were recorded
+                self.logger.debug(self.log_prefix + 'Recording the fingerprint of installed dependencies')
+                self._save_db(json.dumps(expected, sort_keys=True))
+                return
+            if installed == expected:
+                self.logger.debug(self.log_prefix + 'Dependencies are already installed')
+                return
+
+        shell = self.mpi_thread.get_cluster_shell(init=True)
+        if shell is None:  # cluster deleted
+            return
+        marker = self._read_marker(shell)
+        self._installed = {name: fingerprint for name, fingerprint in marker.items() if name in expected}
+
+        pending = [step for step in self.steps if self._installed.get(step.name) != step.fingerprint]
+        if not pending:
+            self.logger.debug(self.log_prefix + 'Dependencies are already installed on the cluster')
+            self._save_db(json.dumps(self._installed, sort_keys=True))
+            return
+
+        done = {step.name: threading.Event() for step in self.steps}
+        for step in self.steps:
+            if step not in pending:
+                done[step.name].set()
+
+        threads = [threading.Thread(target=self._run_step, args=(step, slot, done))
+                   for slot, step in enumerate(pending)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
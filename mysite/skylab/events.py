@@ -0,0 +1,71 @@
+import collections
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+
+class StatusEventBus(object):
+    """
+    In-process pub/sub for task and mpi cluster status changes, published by Task/MPICluster.change_status
+    Each event has an increasing cursor, clients long-poll get_events with the last cursor they received
+    Only the latest settings.STATUS_EVENTS_BUFFER_SIZE events are kept
+    """
+
+    def __init__(self):
+        self._events = collections.deque(maxlen=settings.STATUS_EVENTS_BUFFER_SIZE)
+        self._cursor = 0
+        self._condition = threading.Condition()
+
+    @property
+    def cursor(self):
+        return self._cursor
+
+    def publish(self, event):
+        with self._condition:
+            self._cursor += 1
+            event['cursor'] = self._cursor
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def publish_task(self, task):
+        self.publish({
+            'type': 'task',
+            'id': task.id,
+            'user_id': task.user_id,
+            'mpi_cluster_id': task.mpi_cluster_id,
+            'status_code': task.status_code,
+            'status_msg': task.status_msg,
+            'simple_status_msg': task.simple_status_msg,
+            'completion_rate': task.completion_rate,
+            'updated': timezone.localtime(task.updated).strftime('%x %I:%M %p'),
+        })
+
+    def publish_mpi_cluster(self, mpi_cluster):
+        self.publish({
+            'type': 'mpi_cluster',
+            'id': mpi_cluster.id,
+            'cluster_name': mpi_cluster.cluster_name,
+            'is_public': mpi_cluster.is_public,
+            'status': mpi_cluster.status,
+            'status_msg': mpi_cluster.current_simple_status_msg,
+            'queued_for_deletion': mpi_cluster.queued_for_deletion,
+        })
+
+    def get_events(self, cursor, timeout):
+        """
+        Blocks up to timeout seconds until there are events after cursor
+        :return: (events, latest cursor, reset) reset is True if events after cursor were already dropped
+        """
+        with self._condition:
+            if self._cursor <= cursor:
+                self._condition.wait(timeout)
+            if self._cursor < cursor:  # cursor from before a server restart
+                return [], self._cursor, True
+
+            events = [event for event in self._events if event['cursor'] > cursor]
+            reset = bool(self._events) and self._events[0]['cursor'] > cursor + 1
+            return events, self._cursor, reset
+
+
+status_events = StatusEventBus()
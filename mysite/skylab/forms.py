@@ -5,7 +5,7 @@ from django.conf import settings
 from django.db.models import Q
 from django.core.validators import RegexValidator
 
-from skylab.models import ToolSet, MPICluster, ToolActivation
+from skylab.models import ToolSet, MPICluster, activation_cache
 from skylab.validators import cluster_name_unique_validator, cluster_size_validator, get_current_max_nodes
 
 class CreateMPIForm(forms.Form):  # form for creating an mpi cluster
@@ -22,24 +22,28 @@ class CreateMPIForm(forms.Form):  # form for creating an mpi cluster
                                               widget=forms.CheckboxSelectMultiple())
     is_public = forms.BooleanField(required=False, label="Public",
                                    help_text="This option makes the cluster visible to all users.")
+    idle_ttl = forms.IntegerField(required=False, label="Idle timeout", min_value=0,
+                                  initial=settings.CLUSTER_IDLE_TTL,
+                                  help_text="Minutes without tasks before the cluster is deleted. Empty or 0 keeps the cluster.")
+    autoscale = forms.BooleanField(required=False, label="Autoscale",
+                                   help_text="Adds nodes while tasks are queued, up to {0} nodes. "
+                                             "They are removed once the cluster is idle.".format(settings.MAX_NODES_PER_CLUSTER))
 
     def __init__(self, *args, **kwargs):
         super(CreateMPIForm, self).__init__(*args, **kwargs)
         self.fields['cluster_size'].widget.attrs.update({'max': get_current_max_nodes()})
-
+        if not settings.VCLUSTER_RESIZE_COMMAND:  # clusters cannot be resized
+            del self.fields['autoscale']
 
         self.helper = FormHelper()
         self.helper.form_id = 'id-mpiForm'
         self.helper.form_class = 'create-mpi-cluster-form'
         self.helper.form_method = 'post'
         self.helper.form_action = ''
+        fields = ['cluster_name', 'cluster_size', 'toolsets', 'is_public', 'autoscale', 'idle_ttl']
         self.helper.layout = Layout(
-            'cluster_name',
-            'cluster_size',
-            'toolsets',
-            'is_public',
-            HTML('<input name="submit" value="Create cluster" type="submit" class="btn btn-primary btn-block">')
-
+            *[field for field in fields if field in self.fields] +
+             [HTML('<input name="submit" value="Create cluster" type="submit" class="btn btn-primary btn-block">')]
         )
 
     def clean_cluster_name(self):
@@ -56,7 +60,7 @@ def get_mpi_queryset_for_task_submission(user):  # returns avaiable mpi clusters
         user_allowed = Q(allowed_users=user)
         cluster_is_public = Q(is_public=True)
         qs = MPICluster.objects.filter(user_allowed | cluster_is_public)
-    qs = qs.exclude(status=5).exclude(queued_for_deletion=True)
+    qs = qs.exclude(status=5).exclude(queued_for_deletion=True).exclude(is_warm_pool=True)
 
     return qs
 
@@ -67,18 +71,17 @@ class MPIModelChoiceField(forms.ModelChoiceField):
 
     def label_from_instance(self, obj):  # returns string to be displayed as dropdown options
         if self.toolset is not None:
-            try:
-                tool_activation = ToolActivation.objects.get(mpi_cluster=obj, toolset=self.toolset)
-
-                if tool_activation.status == 2:
+            activation_status = activation_cache.get_status(obj.id, self.toolset.id)
+            if activation_status is not None:
+                if activation_status == 2:
                     status = "Installed"
-                elif tool_activation.status == 1:
+                elif activation_status == 1:
                     status = "Queued for installation"
-                elif tool_activation.status == 0:
+                elif activation_status == 0:
                     status = "Not installed"
                 return "{0} (nodes : {1}, tasks queued: {2}) ({3} status: {4})".format(obj.cluster_name, obj.total_node_count, obj.task_queued_count,
                                                                     self.toolset.display_name, status)
-            except ToolActivation.DoesNotExist:
+            else:
                 return "{0} (nodes : {1}) ({2}, tasks queued: {3}) ".format(obj.cluster_name, obj.total_node_count,
                                                         self.toolset.display_name, obj.task_queued_count)
         else:
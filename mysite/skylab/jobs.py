@@ -0,0 +1,102 @@
+import itertools
+import threading
+
+# jobs processed by MPIConsumerThreads, ordered by (priority, sequence) in MPIThread.task_queue
+# lower priority values are processed first
+
+STOP_CONSUMER_PRIORITY = 0  # consumers stop before processing anything else
+DELETE_CLUSTER_PRIORITY = 32768  # after every task, Task.priority is a PositiveSmallIntegerField
+SHRINK_CLUSTER_PRIORITY = DELETE_CLUSTER_PRIORITY - 1  # after every task, before a deletion
+
+_sequence = itertools.count()
+_sequence_lock = threading.Lock()
+
+
+def next_sequence():
+    # tie-breaker for jobs with the same priority, jobs are processed in the order they were queued
+    with _sequence_lock:
+        return next(_sequence)
+
+
+class MPIJob(object):  # parent class for all jobs in a task queue
+    priority = 3
+    stops_consumer = False
+    requires_connection = True  # consumers wait for a live cluster connection before executing the job
+
+    def __init__(self, priority=None):
+        if priority is not None:
+            self.priority = priority
+        self.sequence = next_sequence()
+
+    @property
+    def sort_key(self):
+        return self.priority, self.sequence
+
+    def __lt__(self, other):  # used by Queue.PriorityQueue
+        return self.sort_key < other.sort_key
+
+    def execute(self, consumer):
+        raise NotImplementedError
+
+
+class TaskJob(MPIJob):
+    def __init__(self, task):
+        self.task = task
+        super(TaskJob, self).__init__(priority=task.priority)
+
+    def __str__(self):
+        return 'TaskJob [task:{0},priority:{1}]'.format(self.task.id, self.priority)
+
+    def execute(self, consumer):
+        # the consumer is freed for other jobs while the toolset is activated
+        if consumer.mpi_thread.park_until_activated(self, self.task.tool.toolset_id):
+            return
+        consumer.process_task(self.task)
+
+
+class DeleteClusterJob(MPIJob):
+    priority = DELETE_CLUSTER_PRIORITY
+    requires_connection = False  # runs on the frontend, also for unreachable clusters
+
+    def __str__(self):
+        return 'DeleteClusterJob'
+
+    def execute(self, consumer):
+        mpi_thread = consumer.mpi_thread
+        mpi_thread.wait_until_activated()  # tasks parked on an activation are requeued once it is done
+        if not mpi_thread.task_queue.empty():  # requeued tasks run first, the deletion is queued after them
+            mpi_thread.add_job_to_queue(DeleteClusterJob())
+            return
+        mpi_thread.wait_until_idle()  # let tasks running in other consumers finish
+        mpi_thread.stop()
+        mpi_thread.delete_mpi_cluster()
+
+
+class ShrinkClusterJob(MPIJob):
+    priority = SHRINK_CLUSTER_PRIORITY
+    requires_connection = False  # runs on the frontend
+
+    def __init__(self, total_nodes):
+        self.total_nodes = total_nodes
+        super(ShrinkClusterJob, self).__init__()
+
+    def __str__(self):
+        return 'ShrinkClusterJob [nodes:{0}]'.format(self.total_nodes)
+
+    def execute(self, consumer):
+        # removed nodes may be running tasks, tasks or a deletion queued meanwhile cancel the shrink
+        if consumer.mpi_thread.wait_until_idle(unless_queued=True):
+            consumer.mpi_thread.resize_mpi_cluster(self.total_nodes)
+        else:
+            consumer.logger.info(consumer.log_prefix + 'Tasks or a deletion were queued, cluster not shrunk')
+
+
+class StopConsumerJob(MPIJob):
+    priority = STOP_CONSUMER_PRIORITY
+    stops_consumer = True
+
+    def __str__(self):
+        return 'StopConsumerJob'
+
+    def execute(self, consumer):
+        pass
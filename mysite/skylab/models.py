@@ -1,18 +1,27 @@
 from __future__ import unicode_literals
 
+import atexit
+import errno
+import hashlib
+import json
 import os
 import random
 import re
 import string
+import threading
+import time
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.core.validators import MaxValueValidator
-from django.db import models
+from django.db import models, IntegrityError
+from django.db.models import Count, F, Sum
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
+from skylab.events import status_events
+
 def get_available_tools():
     module_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modules')
     dirs = [(lst, lst) for lst in os.listdir(module_path) if
@@ -42,6 +51,14 @@ class MPICluster(models.Model):  # database model for mpi cluster
     cluster_ip = models.GenericIPAddressField(null=True, default=None)
     cluster_name = models.CharField(max_length=50, unique=True)
     cluster_size = models.SmallIntegerField(default=1, validators=[MaxValueValidator(MAX_MPI_CLUSTER_SIZE)])
+    # vcluster instances keep the name they were started with, warm pool clusters are renamed when claimed
+    instance_name = models.CharField(max_length=50, blank=True, default='')
+    is_warm_pool = models.BooleanField(default=False)  # booted in advance, not claimed by a user yet
+    bootstrap_fingerprint = models.TextField(blank=True, default='')  # json, installed dependency step: fingerprint
+    autoscale = models.BooleanField(default=False)  # nodes are added while tasks are queued
+    min_cluster_size = models.SmallIntegerField(null=True, default=None)  # autoscaled clusters shrink back to it
+    idle_ttl = models.PositiveIntegerField(null=True, blank=True)  # in minutes, None or 0 keeps the cluster
+    last_activity = models.DateTimeField(null=True, blank=True)  # last task queued or finished
 
 
     share_key = models.CharField(default=generate_share_key, max_length=10)
@@ -60,6 +77,15 @@ class MPICluster(models.Model):  # database model for mpi cluster
     def total_node_count(self):
         return self.cluster_size + 1
 
+    @property
+    def vcluster_name(self):
+        return self.instance_name or self.cluster_name
+
+    def get_idle_ttl(self):
+        # minutes without tasks before the cluster is deleted, 0 keeps it
+        # clusters created before idle timeouts were added have none, they are never reaped
+        return self.idle_ttl or 0
+
     @property
     def current_simple_status_msg(self):
         status_msg = {
@@ -85,8 +111,12 @@ class MPICluster(models.Model):  # database model for mpi cluster
 
     def change_status(self, status):
         self.refresh_from_db()
+        released = status == 5 and self.status != 5
         self.status = status
         self.save()
+        if released:  # deleted cluster's nodes are available again
+            ClusterCapacity.release(self.total_node_count)
+        status_events.publish_mpi_cluster(self)
 
     def save(self, *args, **kwargs):
         # Update timestamps
@@ -95,6 +125,53 @@ class MPICluster(models.Model):  # database model for mpi cluster
         self.updated = timezone.now()
         super(MPICluster, self).save(*args, **kwargs)
 
+@python_2_unicode_compatible
+class ClusterCapacity(models.Model):
+    """
+    Single row ledger of the nodes allocated to clusters that are not deleted
+    Nodes are reserved before a cluster is created and released when it is deleted,
+    with atomic UPDATEs so two concurrent creates cannot both exceed settings.MAX_TOTAL_INSTANCES
+    """
+    LEDGER_ID = 1
+    allocated_nodes = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "{0}/{1} nodes allocated".format(self.allocated_nodes, settings.MAX_TOTAL_INSTANCES)
+
+    @classmethod
+    def get_ledger(cls):
+        # first use counts the nodes of existing clusters
+        def count_allocated_nodes():
+            clusters = MPICluster.objects.exclude(status=5).aggregate(size=Sum('cluster_size'), count=Count('id'))
+            return (clusters['size'] or 0) + clusters['count']  # total_node_count = cluster_size + 1
+
+        try:
+            return cls.objects.get(pk=cls.LEDGER_ID)
+        except cls.DoesNotExist:
+            return cls.objects.get_or_create(pk=cls.LEDGER_ID,
+                                             defaults={'allocated_nodes': count_allocated_nodes()})[0]
+
+    @classmethod
+    def available_nodes(cls):
+        return settings.MAX_TOTAL_INSTANCES - cls.get_ledger().allocated_nodes
+
+    @classmethod
+    def reserve(cls, nodes):
+        """
+        :return: True if the nodes were reserved, False if that would exceed settings.MAX_TOTAL_INSTANCES
+        """
+        cls.get_ledger()
+        return cls.objects.filter(pk=cls.LEDGER_ID,
+                                  allocated_nodes__lte=settings.MAX_TOTAL_INSTANCES - nodes).update(
+            allocated_nodes=F('allocated_nodes') + nodes) == 1
+
+    @classmethod
+    def release(cls, nodes):
+        cls.get_ledger()
+        cls.objects.filter(pk=cls.LEDGER_ID, allocated_nodes__gte=nodes).update(
+            allocated_nodes=F('allocated_nodes') - nodes)
+
+
 @python_2_unicode_compatible
 class ToolActivation(models.Model):
     mpi_cluster = models.ForeignKey(MPICluster, on_delete=models.CASCADE)
@@ -121,6 +198,46 @@ class ToolActivation(models.Model):
         elif self.status == 0:
             return 'Not selected for activation'
 
+class ToolActivationCache(object):
+    """
+    In-process ToolActivation status keyed by (mpi_cluster_id, toolset_id)
+    Entries are read from the database once and kept current by the ToolActivation post_save and post_delete
+    receivers in skylab.signals, saves in other processes are not seen until then
+    """
+
+    def __init__(self):
+        self._statuses = {}
+        self._lock = threading.Lock()
+
+    def get_status(self, mpi_cluster_id, toolset_id):
+        """
+        :return: ToolActivation.status, None if the toolset has no activation for the cluster
+        """
+        key = (mpi_cluster_id, toolset_id)
+        with self._lock:
+            if key in self._statuses:
+                return self._statuses[key]
+
+        status = ToolActivation.objects.filter(mpi_cluster_id=mpi_cluster_id, toolset_id=toolset_id).values_list(
+            'status', flat=True).first()
+        with self._lock:
+            return self._statuses.setdefault(key, status)
+
+    def is_activated(self, mpi_cluster_id, toolset_id):
+        return self.get_status(mpi_cluster_id, toolset_id) == 2
+
+    def update(self, tool_activation):
+        with self._lock:
+            self._statuses[(tool_activation.mpi_cluster_id, tool_activation.toolset_id)] = tool_activation.status
+
+    def invalidate(self, mpi_cluster_id, toolset_id):
+        with self._lock:
+            self._statuses.pop((mpi_cluster_id, toolset_id), None)
+
+
+activation_cache = ToolActivationCache()
+
+
 def get_default_package_name(display_name):
     pattern = re.compile('[\W]+')
     pattern.sub('', display_name).lower()
@@ -203,6 +320,18 @@ def get_sentinel_mpi():
 
 @python_2_unicode_compatible
 class Task(models.Model):
+    # last completed phase of P2CToolGeneric.run_phases, a requeued task resumes after it
+    CHECKPOINT_NONE = 0
+    CHECKPOINT_UPLOADED = 1
+    CHECKPOINT_EXECUTED = 2
+    CHECKPOINT_RETRIEVED = 3
+    CHECKPOINT_CHOICES = (
+        (CHECKPOINT_NONE, 'Not started'),
+        (CHECKPOINT_UPLOADED, 'Input files uploaded'),
+        (CHECKPOINT_EXECUTED, 'Commands executed'),
+        (CHECKPOINT_RETRIEVED, 'Output files retrieved'),
+    )
+
     priority = models.PositiveSmallIntegerField(default=3)  # 1=(reserved) p2c tool activate, 2=high, 3=normal
     task_data = models.TextField(max_length=500, blank=True)
     # additional_info = models.CharField(max_length=500, blank=True)
@@ -212,10 +341,14 @@ class Task(models.Model):
     mpi_cluster = models.ForeignKey(MPICluster, on_delete=models.CASCADE, null=True)
     status_msg = models.TextField(default="Task Created", max_length=300)
     status_code = models.SmallIntegerField(default=0)
+    checkpoint = models.PositiveSmallIntegerField(default=CHECKPOINT_NONE, choices=CHECKPOINT_CHOICES)
 
-    updated = models.DateTimeField()
+    updated = models.DateTimeField(db_index=True)
     created = models.DateTimeField()
 
+    class Meta:
+        index_together = [['user', 'updated']]  # task list pages
+
     def __str__(self):
         return "Task {0} {1}@{2}".format(self.id,self.tool.display_name, self.mpi_cluster.cluster_name)
 
@@ -227,13 +360,18 @@ class Task(models.Model):
             self.created = timezone.now()
 
         self.updated = timezone.now()
-        # create toolactivation if does not exist
-        obj, created = ToolActivation.objects.get_or_create(mpi_cluster_id=self.mpi_cluster_id, toolset_id=self.tool.toolset_id,
-                                             defaults={'status': 1})
-        if not created:
-            if obj.status == 0:
-                obj.status = 1
-                obj.save()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'updated'}
+
+        if created and not activation_cache.is_activated(self.mpi_cluster_id, self.tool.toolset_id):
+            # create toolactivation if does not exist
+            obj, activation_created = ToolActivation.objects.get_or_create(mpi_cluster_id=self.mpi_cluster_id,
+                                                                           toolset_id=self.tool.toolset_id,
+                                                                           defaults={'status': 1})
+            if not activation_created:
+                if obj.status == 0:
+                    obj.status = 1
+                    obj.save()
 
         super(Task, self).save(*args, **kwargs)
 
@@ -261,8 +399,16 @@ class Task(models.Model):
         status_msg = kwargs.get('status_msg', None)
         self.status_code = status_code
         self.status_msg = status_msg if status_msg else self.simple_status_msg
-        self.save()
-        TaskLog.objects.create(status_code=self.status_code, status_msg=self.status_msg, task=self)
+        self.save(update_fields=['status_code', 'status_msg'])
+        task_log_buffer.add(TaskLog(status_code=self.status_code, status_msg=self.status_msg, task=self,
+                                    timestamp=timezone.now()),
+                            flush=self.status_code in TaskLogBuffer.FLUSH_STATUS_CODES)
+        status_events.publish_task(self)
+
+    def set_checkpoint(self, checkpoint):
+        # saved immediately, a server restart right after a phase must not redo it
+        self.checkpoint = checkpoint
+        Task.objects.filter(pk=self.pk).update(checkpoint=checkpoint)
 
     @property
     def task_dirname(self):
@@ -361,6 +507,67 @@ class Task(models.Model):
 
         return jsmol_files_absolute_uris
 
+@python_2_unicode_compatible
+class FileBlob(models.Model):
+    """
+    Content-addressed copy of input files, stored once under MEDIA_ROOT/<BLOB_STORE_DIR>/
+    SkyLabFiles with the same content are hardlinks to the blob, which is deleted with its last reference
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "{0} ({1} references)".format(self.sha256, self.ref_count)
+
+    @property
+    def path(self):
+        return os.path.join(settings.MEDIA_ROOT, settings.BLOB_STORE_DIR, self.sha256[:2], self.sha256)
+
+    @classmethod
+    def store(cls, path):
+        """
+        Adds a reference to the blob with the content of path, replacing path with a hardlink to a stored blob
+        :return: FileBlob
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+
+        try:
+            blob = cls.objects.get_or_create(sha256=digest.hexdigest(), defaults={'size': os.path.getsize(path)})[0]
+        except IntegrityError:  # created by a concurrent upload
+            blob = cls.objects.get(sha256=digest.hexdigest())
+        cls.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+
+        if not os.path.isfile(blob.path):
+            try:
+                os.makedirs(os.path.dirname(blob.path))
+            except OSError:
+                pass  # dir already exists
+            try:
+                os.link(path, blob.path)
+                return blob
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+        if not os.path.samefile(blob.path, path):
+            # atomically replace the uploaded copy
+            tmp_path = path + '.blob'
+            os.link(blob.path, tmp_path)
+            os.rename(tmp_path, path)
+        return blob
+
+    @classmethod
+    def release(cls, blob_id):
+        # removes a reference, the blob and its file (see signals) are deleted with the last one
+        cls.objects.filter(pk=blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        for blob in cls.objects.filter(pk=blob_id, ref_count=0):
+            blob.delete()
+
+
 def get_upload_path(instance, filename):
     # file will be uploaded to MEDIA_ROOT/user_<id>/<filename>
     upload_path = instance.upload_path
@@ -374,6 +581,7 @@ class SkyLabFile(models.Model):
     filename = models.CharField(max_length=200)
     render_with_jsmol = models.BooleanField(default=False)
     task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name="files")
+    blob = models.ForeignKey(FileBlob, null=True, blank=True, on_delete=models.SET_NULL)  # input files only
 
     # @property
     # def filename(self):
@@ -404,6 +612,49 @@ class SkyLabFile(models.Model):
                 pass #No duplicates
         super(SkyLabFile, self).save(*args, **kwargs)
 
+        if self.type == 1 and self.file and self.blob_id is None:  # deduplicate uploaded input files
+            self.blob = FileBlob.store(self.file.path)
+            super(SkyLabFile, self).save(update_fields=['blob'])
+
+@python_2_unicode_compatible
+class SweepPoint(models.Model):  # one combination of parameter values of a parameter sweep task
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name="sweep_points")
+    index = models.PositiveIntegerField()
+    parameters = models.TextField()  # json object, parameter name: value
+    status_code = models.PositiveSmallIntegerField(default=101)  # same codes as Task: 101, 200, 400
+    status_msg = models.CharField(max_length=300, default="Queued")
+
+    class Meta:
+        unique_together = [['task', 'index']]
+        ordering = ['index']
+
+    def __str__(self):
+        return "Task {0} point {1}".format(self.task_id, self.index)
+
+    @property
+    def parameters_display(self):
+        return ', '.join('{0}={1}'.format(name, value) for name, value in
+                         sorted(json.loads(self.parameters).items()))
+
+
+@python_2_unicode_compatible
+class VinaResult(models.Model):  # best docking mode of a ligand, parsed from vina output of a task
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name="vina_results")
+    ligand = models.CharField(max_length=200)
+    affinity = models.FloatField()  # kcal/mol, lower is a better binder
+    rmsd_lb = models.FloatField(default=0)
+    rmsd_ub = models.FloatField(default=0)
+    mode_count = models.PositiveSmallIntegerField(default=1)
+    pose = models.TextField(blank=True)  # first MODEL of vina_out.pdbqt
+
+    class Meta:
+        unique_together = [['task', 'ligand']]
+        index_together = [['task', 'affinity']]  # ranked results of a task
+
+    def __str__(self):
+        return "Task {0} {1}: {2}".format(self.task_id, self.ligand, self.affinity)
+
+
 @python_2_unicode_compatible
 class TaskLog(models.Model):
     status_code = models.PositiveSmallIntegerField()
@@ -420,3 +671,58 @@ class TaskLog(models.Model):
         self.task.updated = timezone.now()
         self.timestamp = timezone.now()
         super(TaskLog, self).save(*args, **kwargs)
+
+
+class TaskLogBuffer(object):
+    """
+    Collects TaskLogs written by Task.change_status and inserts them with bulk_create
+    Logs are flushed in the order they were added, every settings.TASKLOG_FLUSH_INTERVAL seconds,
+    once settings.TASKLOG_BUFFER_SIZE logs are pending and immediately for terminal status codes
+    """
+    FLUSH_STATUS_CODES = (200, 401, 500)  # terminal status codes
+
+    def __init__(self):
+        self._logs = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # keeps flushes in order
+        self._flusher = None
+
+    def add(self, log, flush=False):
+        with self._lock:
+            self._logs.append(log)
+            flush = flush or len(self._logs) >= settings.TASKLOG_BUFFER_SIZE
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically)
+                self._flusher.daemon = True
+                self._flusher.start()
+        if flush:
+            self.flush()
+
+    def discard(self, task_id):
+        # pending logs of a deleted task
+        with self._lock:
+            self._logs = [log for log in self._logs if log.task_id != task_id]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                logs, self._logs = self._logs, []
+            if not logs:
+                return
+            try:
+                TaskLog.objects.bulk_create(logs)
+            except IntegrityError:  # task deleted while its logs were pending
+                for log in logs:
+                    try:
+                        log.save()
+                    except (IntegrityError, Task.DoesNotExist):
+                        pass
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(settings.TASKLOG_FLUSH_INTERVAL)
+            self.flush()
+
+
+task_log_buffer = TaskLogBuffer()
+atexit.register(task_log_buffer.flush)  # pending logs on shutdown
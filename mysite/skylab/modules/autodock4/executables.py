@@ -26,29 +26,8 @@ class Autodock4Executable(P2CToolGeneric):
         self.logger.debug(self.log_prefix + 'Uploading input files')
         files = self.task.files.filter(type=1)  # query task input files
 
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()  # returns an instance of paramiko's SFTPClient
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-
-        sftp.get_channel().settimeout(300.0)  # timeout for sftp read/write commands
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-
-        sftp.chdir(self.working_dir)  # change directory to /mirror/task_xx/workdir
-        for f in files:
-            while True:
-                try:
-                    self.logger.debug(self.log_prefix + "Uploading " + f.filename)
-                    # transfer file to remote cluster
-                    sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)
-                    self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
-                    break
-
-                except (socket.timeout, EOFError):  # if timeout is reached before command is completed
-
-                    self.logger.debug(self.log_prefix + "Retrying for " + f.filename)
-                    time.sleep(2)
-
-        sftp.close()  # close sftp client
+        # upload to /mirror/task_xx/workdir
+        self.upload_input_files(files=files, remote_dir=self.working_dir, timeout=300.0)
 
     def run_commands(self, **kwargs):
         self.task.change_status(status_msg="Executing tool script", status_code=152)
@@ -104,10 +83,7 @@ class Autodock4Executable(P2CToolGeneric):
 
         task_remote_subdirs = ['workdir', 'output']  # task subdirectories
         # create or clear required remote directories
-        self.clear_or_create_dirs(task_remote_subdirs=task_remote_subdirs)
-        self.handle_input_files()  # upload input files to remote cluster
-        self.run_commands()  # run tool commands
-        self.handle_output_files()  # retrieve task output files from remote cluster
+        self.run_phases(task_remote_subdirs=task_remote_subdirs)  # resumes after the last completed phase
 
     def handle_output_files(self, **kwargs):
         self.task.change_status(status_msg='Retrieving output files', status_code=154 if not self.task.status_code >= 400 else self.task.status_code)
@@ -152,7 +128,7 @@ class Autodock4Executable(P2CToolGeneric):
 
         sftp.close()  # close sftp client
         self.logger.debug(self.log_prefix + 'Closed SFTP client')
-        self.shell.run(['rm', '-rf', self.remote_task_dir])  # Delete remote task directory
+        self.remove_remote_task_dir()
 
         if not self.task.status_code == 400:
             self.task.change_status(status_code=200, status_msg="Output files received. No errors encountered")
@@ -174,27 +150,8 @@ class Autogrid4Executable(P2CToolGeneric):
 
         files = self.task.files.filter(type=1)  # query task input files
 
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()  # returns an instance of paramiko's SFTPClient
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-
-        sftp.get_channel().settimeout(300.0)  # timeout for sftp read/write operations
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-
-        sftp.chdir(self.working_dir)  # cd /mirror/task_xx/workdir
-        for f in files:
-            while True:
-                try:
-                    self.logger.debug(self.log_prefix + "Uploading " + f.filename)
-                    # upload input file to remote cluster
-                    sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)
-                    self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
-                    break
-                except (socket.timeout, EOFError):  # if timeout is reached before upload is completed
-                    self.logger.debug(self.log_prefix + "Retrying for " + f.filename)
-                    time.sleep(2)
-        sftp.close()  # close sftp client
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
+        # upload to /mirror/task_xx/workdir
+        self.upload_input_files(files=files, remote_dir=self.working_dir, timeout=300.0)
 
     def run_commands(self, **kwargs):
         self.task.change_status(status_msg="Executing tool script", status_code=152)
@@ -247,18 +204,12 @@ class Autogrid4Executable(P2CToolGeneric):
 
         task_remote_subdirs = ['workdir', 'output']  # task subdirectories
         # create or clear required task subdirectories
-        self.clear_or_create_dirs(task_remote_subdirs=task_remote_subdirs)
-        self.handle_input_files()  # upload input files to remote cluster
-        self.run_commands()  # execute tool commands
-        self.handle_output_files()  # retrieve output files from remote cluster
+        self.run_phases(task_remote_subdirs=task_remote_subdirs)  # resumes after the last completed phase
 
     def handle_output_files(self, **kwargs):
         self.task.change_status(status_msg='Retrieving output files', status_code=154 if not self.task.status_code >= 400 else self.task.status_code)
 
         self.logger.debug(self.log_prefix + 'Sending output files to server')
-        media_root = getattr(settings, "MEDIA_ROOT")
-
-        remote_dir = self.task.task_dirname
 
         self.logger.debug(self.log_prefix + 'Opening SFTP client')
         sftp = self.shell._open_sftp_client()  # open sftp client
@@ -278,35 +229,14 @@ class Autogrid4Executable(P2CToolGeneric):
             if remote_file in input_filenames:
                 sftp.remove(remote_filepath)  # delete remote file
 
-        zip_filename = self.task.task_dirname + "-output.zip"  # output zip filename
-        local_zip_filepath = os.path.join(media_root, "%s/output/%s" % (remote_dir, zip_filename))
-        remote_zip_filepath = os.path.join(self.remote_task_dir, zip_filename)
-
-        # create output zip
-        self.shell.run(["zip", "-r", zip_filename, "output"], cwd=self.remote_task_dir)
-        self.shell.run(["zip", "-r", "-g", zip_filename, "workdir"], cwd=self.remote_task_dir)
-
-        while True:
-            try:
-                self.logger.debug(self.log_prefix + ' Retrieving ' + zip_filename)
-                sftp.get(remote_zip_filepath, local_zip_filepath, callback=self.sftp_file_transfer_callback)
-                self.logger.debug(self.log_prefix + ' Received ' + zip_filename)
-                break
-            except (socket.timeout, EOFError):
-                self.logger.debug(self.log_prefix + ' Retrying for ' + zip_filename)
-                time.sleep(2)
-
         sftp.close()  # close sftp client
         self.logger.debug(self.log_prefix + 'Closed SFTP client')
 
-        # attach transferred file to database
-        new_file = SkyLabFile.objects.create(type=2, task=self.task)
-        new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'),
-                                          zip_filename)
-        new_file.save()
+        # stream output and workdir as an archive, attached as a skylabfile
+        self.retrieve_output_archive(self.task.task_dirname + "-output", ["output", "workdir"], timeout=300.0)
 
         # Delete remote task directory
-        self.shell.run(['rm', '-rf', self.remote_task_dir])
+        self.remove_remote_task_dir()
 
         if not self.task.status_code == 400:
             self.task.change_status(status_code=200, status_msg="Output files received. No errors encountered")
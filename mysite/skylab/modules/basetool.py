@@ -1,4 +1,12 @@
+import Queue
+import collections
+import json
 import os.path
+import pipes
+import shutil
+import socket
+import tarfile
+import threading
 import spur
 import time
 import math
@@ -6,9 +14,16 @@ from abc import abstractmethod
 
 from django.conf import settings
 
-from skylab.models import SkyLabFile
+from skylab.models import SkyLabFile, SweepPoint, Task, TaskLog, task_log_buffer
 
 MAX_WAIT = settings.TRY_WHILE_NOT_EXIT_MAX_TIME
+SFTP_CHUNK_SIZE = 32768  # paramiko's max packet size
+
+
+class RemoteArchiveError(Exception):
+    # tar exited with a fatal error on the cluster, the received archive is truncated or empty
+    pass
+
 
 # source: http://stackoverflow.com/questions/14819681/upload-files-using-sftp-in-python-but-create-directories-if-path-doesnt-exist
 def mkdir_p(sftp, remote_directory):
@@ -33,6 +48,10 @@ def mkdir_p(sftp, remote_directory):
 class P2CToolGeneric(object):  # parent class for all skylab.modules.*.executables
     # functions are made to be as generic as possible for future simplification of executable creation process
 
+    # set to False if the tool uses remote directories shared by all tasks (e.g. scratch dirs)
+    # tasks of executables that do not allow concurrent runs are executed one at a time per cluster
+    allow_concurrent_runs = True
+
     def __init__(self, **kwargs):
         self.shell = kwargs.get('shell')  # cluster shell
         self.task = kwargs.get('task')
@@ -41,6 +60,74 @@ class P2CToolGeneric(object):  # parent class for all skylab.modules.*.executabl
         self.remote_task_dir = os.path.join(settings.REMOTE_BASE_DIR, self.task.task_dirname)
         self.working_dir = self.remote_task_dir  # dir where tool commands will be executed
 
+    @classmethod
+    def prefetch_inputs(cls, task, mpi_thread):
+        # called when a task is queued, executables can start fetching shared inputs while earlier tasks run
+        pass
+
+    def run_phases(self, **kwargs):
+        """
+        Runs clear_or_create_dirs (with kwargs), handle_input_files, run_commands and handle_output_files
+        Phases completed by an interrupted run of the task (see Task.checkpoint) are skipped,
+        e.g. a task requeued after an ssh drop or a server restart keeps its remote task dir and uploaded files
+        """
+        checkpoint = self.task.checkpoint
+        if checkpoint >= Task.CHECKPOINT_UPLOADED:
+            self.logger.info(self.log_prefix + 'Resuming task after {0}'.format(self.task.get_checkpoint_display()))
+
+        if checkpoint < Task.CHECKPOINT_UPLOADED:
+            self.clear_or_create_dirs(**kwargs)
+            self.handle_input_files()  # upload input files to remote cluster
+            self.task.set_checkpoint(Task.CHECKPOINT_UPLOADED)
+
+        if checkpoint < Task.CHECKPOINT_EXECUTED:
+            self.run_commands()  # execute tool commands, commands with a completion marker are skipped
+            self.task.set_checkpoint(Task.CHECKPOINT_EXECUTED)
+        else:  # handle_output_files reports errors of the commands by the status code
+            self.restore_error_status()
+
+        if checkpoint < Task.CHECKPOINT_RETRIEVED:
+            # outputs registered by an interrupted retrieval are retrieved again
+            SkyLabFile.objects.filter(type=2, task=self.task).delete()
+            self.handle_output_files()  # retrieve output files from remote cluster
+            self.task.set_checkpoint(Task.CHECKPOINT_RETRIEVED)
+        else:  # interrupted after remove_remote_task_dir, only the final status is missing
+            self.finish_resumed_task()
+
+    def remove_remote_task_dir(self):
+        # called by handle_output_files once outputs are retrieved, a resumed task never retrieves from the removed dir
+        self.task.set_checkpoint(Task.CHECKPOINT_RETRIEVED)
+        self.shell.run(['rm', '-rf', self.remote_task_dir])
+
+    def get_error_log(self):
+        # the status was reset when the task was requeued, errors of executed commands are kept in the task's logs
+        task_log_buffer.flush()
+        return TaskLog.objects.filter(task=self.task, status_code=400).order_by('-id').first()
+
+    def restore_error_status(self):
+        error_log = self.get_error_log()
+        if error_log is not None:
+            self.task.change_status(status_code=400, status_msg=error_log.status_msg)
+
+    def finish_resumed_task(self):
+        if self.get_error_log() is not None:
+            self.task.change_status(status_code=401, status_msg="Output files received. Errors encountered")
+        else:
+            self.task.change_status(status_code=200, status_msg="Output files received. No errors encountered")
+
+    def get_command_markers_dir(self):
+        return os.path.join(self.remote_task_dir, '.done')
+
+    def get_done_commands(self):
+        """
+        :return: indexes in the task's command list of commands that completed in a previous run
+        """
+        result = self.shell.run(['sh', '-c', 'mkdir -p {0} && ls {0}'.format(self.get_command_markers_dir())])
+        return set(int(marker) for marker in result.output.split() if marker.isdigit())
+
+    def mark_command_done(self, index):
+        self.shell.run(['touch', os.path.join(self.get_command_markers_dir(), str(index))])
+
     def test_ssh_connection(self):
         retries = 0
         exit_loop = False
@@ -68,6 +155,483 @@ class P2CToolGeneric(object):  # parent class for all skylab.modules.*.executabl
     def sftp_file_transfer_callback(self, bytes_transferred, total_bytes):
         self.logger.debug(self.log_prefix + "Bytes transferred :{bytes_transferred}, Bytes to transfer: {total_bytes}".format(bytes_transferred=bytes_transferred, total_bytes=total_bytes))
 
+    def upload_input_files(self, files=None, remote_dir=None, keep_upload_path=False, timeout=300.0):
+        """
+        Uploads files to the cluster over parallel sftp channels of self.shell
+        Remote directories are created once before the transfer
+        Files are resumed from the size already written remotely after a timeout
+        Sets of at least BULK_UPLOAD_MIN_FILES files are streamed as a single tar archive instead
+        Files whose content was already uploaded to the cluster are linked from its blob cache instead of uploaded
+        :param files: SkyLabFile instances, defaults to the input files of the task
+        :param remote_dir: remote directory for the files, defaults to self.remote_task_dir
+        :param keep_upload_path: upload to remote_dir/<upload_path>/ instead of remote_dir/
+        :param timeout: timeout in seconds for sftp read/write operations, None for no timeout
+        """
+        if files is None:
+            files = SkyLabFile.objects.filter(type=1, task=self.task).select_related('blob')  # input files for this task
+        remote_dir = remote_dir or self.remote_task_dir
+
+        transfers = []
+        for f in files:
+            if keep_upload_path:
+                remote_path = os.path.join(remote_dir, f.upload_path, f.filename)
+            else:
+                remote_path = os.path.join(remote_dir, f.filename)
+            transfers.append((f, remote_path))
+
+        if not transfers:
+            return
+
+        # mkdir -p every remote directory in a single command instead of chdir round trips per file
+        remote_dirs = sorted(set(os.path.dirname(remote_path) for f, remote_path in transfers))
+        self.shell.run(['mkdir', '-p'] + remote_dirs)
+
+        transfers = self._link_cached_blobs(transfers)
+        if not transfers:
+            return
+
+        uploaded = False
+        if len(transfers) >= settings.BULK_UPLOAD_MIN_FILES:
+            try:
+                self._upload_as_archive(transfers, remote_dir, timeout)
+                uploaded = True
+            except (socket.timeout, EOFError, IOError) as err:
+                # files already extracted are overwritten by the sftp upload
+                self.logger.error(self.log_prefix + "Archive upload failed ({0}), uploading files one by one".format(err))
+
+        if not uploaded:
+            self._upload_over_sftp_channels(transfers, timeout)
+        self._cache_uploaded_blobs(transfers)
+
+    def _link_cached_blobs(self, transfers):
+        """
+        Hardlinks input files already in settings.REMOTE_BLOB_CACHE_DIR of the cluster, e.g. a receptor used by every task
+        :return: transfers of files that still have to be uploaded
+        """
+        cache_dir = settings.REMOTE_BLOB_CACHE_DIR
+        if not any(f.blob_id for f, remote_path in transfers):
+            return transfers
+
+        try:
+            cached = set(self.shell.run(['sh', '-c', 'mkdir -p {0} && ls {0}'.format(pipes.quote(cache_dir))]).output.split())
+            links = [(f, remote_path) for f, remote_path in transfers if f.blob_id and f.blob.sha256 in cached]
+            if links:
+                self._run_remote_script(['ln -f {0} {1}'.format(pipes.quote(os.path.join(cache_dir, f.blob.sha256)),
+                                                                pipes.quote(remote_path)) for f, remote_path in links])
+        except (spur.RunProcessError, IOError) as err:
+            self.logger.warning(self.log_prefix + 'Could not link cached input files ({0})'.format(err))
+            return transfers
+
+        self.logger.debug(self.log_prefix + 'Linked {0} cached input file(s)'.format(len(links)))
+        linked = set(remote_path for f, remote_path in links)
+        return [(f, remote_path) for f, remote_path in transfers if remote_path not in linked]
+
+    def _cache_uploaded_blobs(self, transfers):
+        # add uploaded files to the cache, cached files no longer linked to a task are removed after a while
+        cache_dir = settings.REMOTE_BLOB_CACHE_DIR
+        lines = ['ln -f {0} {1}'.format(pipes.quote(remote_path), pipes.quote(os.path.join(cache_dir, f.blob.sha256)))
+                 for f, remote_path in transfers if f.blob_id]
+        lines.append('find {0} -type f -links 1 -ctime +{1} -delete'.format(pipes.quote(cache_dir),
+                                                                           settings.REMOTE_BLOB_CACHE_MAX_AGE))
+        try:
+            self._run_remote_script(lines)
+        except IOError as err:
+            self.logger.warning(self.log_prefix + 'Could not cache uploaded input files ({0})'.format(err))
+
+    def _run_remote_script(self, lines, timeout=300.0):
+        # commands are sent over stdin, a command line would be too long for thousands of files
+        channel = self._open_remote_stream('sh -e', timeout)
+        try:
+            channel.sendall('\n'.join(lines) + '\n')
+            channel.shutdown_write()
+            exit_code = channel.recv_exit_status()
+            if exit_code != 0:
+                raise IOError('sh exited with status {0}: {1}'.format(exit_code,
+                                                                      channel.makefile_stderr('rb').read().strip()))
+        finally:
+            channel.close()
+
+    def _upload_as_archive(self, transfers, remote_dir, timeout):
+        """
+        Streams the files as a single tar archive over one ssh channel, unpacked by tar on the cluster as it arrives
+        Avoids an sftp open/write/close round trip per file, e.g. for ligand libraries
+        """
+        compression = settings.BULK_UPLOAD_COMPRESSION
+        self.logger.debug(self.log_prefix + 'Uploading {0} file(s) as a tar{1} archive'.format(
+            len(transfers), '.' + compression if compression else ''))
+
+        channel = self.shell._get_ssh_transport().open_session()
+        try:
+            channel.settimeout(timeout)
+            channel.exec_command('tar -x{0}f - -C {1}'.format('z' if compression == 'gz' else '', remote_dir))
+            stream = channel.makefile('wb')
+            archive = tarfile.open(fileobj=stream, mode='w|' + compression)
+            for f, remote_path in transfers:
+                info = tarfile.TarInfo(name=os.path.relpath(remote_path, remote_dir))
+                info.size = f.file.size
+                info.mtime = time.time()
+                info.mode = 0644
+                f.file.open('rb')
+                try:
+                    archive.addfile(info, f.file)
+                finally:
+                    f.file.close()
+            archive.close()
+            stream.flush()
+            channel.shutdown_write()  # EOF for the remote tar
+
+            exit_code = channel.recv_exit_status()
+            if exit_code != 0:
+                raise IOError('tar exited with status {0}: {1}'.format(exit_code,
+                                                                       channel.makefile_stderr('rb').read().strip()))
+        finally:
+            channel.close()
+        self.logger.debug(self.log_prefix + 'Uploaded {0} file(s)'.format(len(transfers)))
+
+    def _upload_over_sftp_channels(self, transfers, timeout):
+        transfer_queue = Queue.Queue()
+        for transfer in transfers:
+            transfer_queue.put(transfer)
+
+        errors = []
+        channel_count = max(1, min(settings.SFTP_UPLOAD_CHANNELS, len(transfers)))
+        self.logger.debug(self.log_prefix + 'Uploading {0} file(s) over {1} sftp channel(s)'.format(len(transfers),
+                                                                                                   channel_count))
+        workers = []
+        for i in range(channel_count):
+            worker = threading.Thread(target=self._upload_worker, args=(transfer_queue, timeout, errors))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        if errors:
+            raise errors[0]  # e.g. SSHException, handled by MPIConsumerThread
+        self.logger.debug(self.log_prefix + 'Uploaded {0} file(s)'.format(len(transfers)))
+
+    def _open_sftp_channel(self, timeout):
+        sftp = self.shell._open_sftp_client()  # each client has its own channel on the ssh transport
+        sftp.get_channel().settimeout(timeout)
+        return sftp
+
+    def _upload_worker(self, transfer_queue, timeout, errors):
+        sftp = None
+        try:
+            sftp = self._open_sftp_channel(timeout)
+            while not errors:
+                try:
+                    f, remote_path = transfer_queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+                offset = 0
+                while True:
+                    try:
+                        self.logger.debug(self.log_prefix + "Uploading " + f.filename)
+                        self._put_file(sftp, f, remote_path, offset)
+                        self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
+                        break
+                    except (socket.timeout, EOFError):
+                        time.sleep(2)
+                        sftp.close()
+                        sftp = self._open_sftp_channel(timeout)
+                        try:
+                            offset = min(sftp.stat(remote_path).st_size, f.file.size)
+                        except IOError:  # remote file was not created
+                            offset = 0
+                        self.logger.debug(self.log_prefix + "Resuming {0} from byte {1}".format(f.filename, offset))
+        except Exception as err:
+            errors.append(err)
+        finally:
+            if sftp is not None:
+                sftp.close()
+
+    def _put_file(self, sftp, f, remote_path, offset=0):
+        total_bytes = f.file.size
+        f.file.open('rb')
+        try:
+            f.file.seek(offset)
+            remote_file = sftp.open(remote_path, 'r+' if offset else 'w')
+            try:
+                remote_file.seek(offset)
+                remote_file.set_pipelined(True)  # do not wait for the server to ack each write
+                bytes_transferred = offset
+                while True:
+                    data = f.file.read(SFTP_CHUNK_SIZE)
+                    if not data:
+                        break
+                    remote_file.write(data)
+                    bytes_transferred += len(data)
+                    self.sftp_file_transfer_callback(bytes_transferred, total_bytes)
+            finally:
+                remote_file.close()  # waits for pending pipelined writes
+        finally:
+            f.file.close()
+
+    def retrieve_output_archive(self, archive_name, paths, cwd=None, timeout=300.0):
+        """
+        Streams a tar archive of paths from the cluster into MEDIA_ROOT/task_xx/output while it is being produced
+        Nothing is written to the remote disk, unlike zip then sftp.get
+        :param archive_name: archive filename without extension, e.g. task_xx-output
+        :param paths: files or directories relative to cwd
+        :param cwd: remote directory, defaults to self.remote_task_dir
+        :return: SkyLabFile of the archive
+        """
+        compression = settings.OUTPUT_ARCHIVE_COMPRESSION
+        archive_filename = '{0}.tar.{1}'.format(archive_name, compression)
+        local_dir = self._get_local_output_dir()
+        command = 'tar -cf - {0} -C {1} {2}'.format('-I zstd' if compression == 'zst' else '-z',
+                                                    cwd or self.remote_task_dir,
+                                                    ' '.join(pipes.quote(path) for path in paths))
+
+        while True:
+            try:
+                self.logger.debug(self.log_prefix + ' Retrieving ' + archive_filename)
+                with open(os.path.join(local_dir, archive_filename), 'wb') as local_file:
+                    channel = self._open_remote_stream(command, timeout)
+                    try:
+                        bytes_transferred = 0
+                        while True:
+                            data = channel.recv(SFTP_CHUNK_SIZE)
+                            if not data:
+                                break
+                            local_file.write(data)
+                            bytes_transferred += len(data)
+                        self._check_remote_stream(channel)
+                    finally:
+                        channel.close()
+                self.logger.debug(self.log_prefix + ' Received {0} ({1} bytes)'.format(archive_filename,
+                                                                                       bytes_transferred))
+                break
+            except (socket.timeout, EOFError):
+                self.logger.debug(self.log_prefix + ' Retrying for ' + archive_filename)
+                time.sleep(2)
+            except RemoteArchiveError:
+                os.remove(os.path.join(local_dir, archive_filename))  # never registered as the task output
+                raise
+
+        # attach transferred file to database
+        new_file = SkyLabFile.objects.create(type=2, task=self.task)
+        new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'), archive_filename)
+        new_file.save()
+        return new_file
+
+    def retrieve_output_files(self, remote_dir, exclude=None, timeout=300.0, render_with_jsmol=False):
+        """
+        Retrieves the regular files directly under remote_dir as one tar stream, extracted into MEDIA_ROOT/task_xx/output
+        Each file is attached to the task as an output SkyLabFile
+        :param exclude: filenames that are not retrieved, e.g. input files in the working directory
+        :return: list of SkyLabFile
+        """
+        local_dir = self._get_local_output_dir()
+        find_command = 'find . -maxdepth 1 -type f' + ''.join(
+            ' ! -name {0}'.format(pipes.quote(filename)) for filename in exclude or [])
+        command = 'cd {0} && {1} -print0 | tar -czf - --null -T -'.format(remote_dir, find_command)
+
+        while True:
+            filenames = []
+            try:
+                channel = self._open_remote_stream(command, timeout)
+                try:
+                    archive = tarfile.open(fileobj=channel.makefile('rb'), mode='r|gz')
+                    for member in archive:
+                        if not member.isfile():
+                            continue
+                        filename = os.path.basename(member.name)
+                        self.logger.debug(self.log_prefix + ' Received ' + filename)
+                        with open(os.path.join(local_dir, filename), 'wb') as local_file:
+                            shutil.copyfileobj(archive.extractfile(member), local_file)
+                        filenames.append(filename)
+                    archive.close()
+                    self._check_remote_stream(channel)
+                except tarfile.ReadError:  # nothing was archived, or tar failed (e.g. missing remote_dir)
+                    self._check_remote_stream(channel)
+                    self.logger.debug(self.log_prefix + ' No files retrieved from ' + remote_dir)
+                finally:
+                    channel.close()
+                break
+            except (socket.timeout, EOFError):
+                self.logger.debug(self.log_prefix + ' Retrying for ' + remote_dir)
+                time.sleep(2)
+
+        # register newly transferred files as skylabfiles
+        new_files = []
+        for filename in filenames:
+            new_file = SkyLabFile.objects.create(type=2, task=self.task, render_with_jsmol=render_with_jsmol)
+            new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'), filename)
+            new_file.save()
+            new_files.append(new_file)
+        return new_files
+
+    def _get_local_output_dir(self):
+        local_dir = os.path.join(settings.MEDIA_ROOT, self.task.task_dirname, 'output')
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        return local_dir
+
+    def _open_remote_stream(self, command, timeout):
+        channel = self.shell._get_ssh_transport().open_session()
+        channel.settimeout(timeout)
+        channel.exec_command(command)
+        return channel
+
+    def _check_remote_stream(self, channel):
+        exit_code = channel.recv_exit_status()
+        if exit_code == 0:
+            return
+        message = 'Remote archive exited with status {0}: {1}'.format(
+            exit_code, channel.makefile_stderr('rb').read().strip())
+        if exit_code == 1:  # a file changed while being archived, keep what was received
+            self.logger.warning(self.log_prefix + message)
+        else:  # fatal, e.g. a missing directory
+            raise RemoteArchiveError(message)
+
+    def get_cluster_nodes(self):
+        """
+        Hostnames listed in settings.MPIEXEC_NODES_FILE, e.g. master, node001...
+        Falls back to the master node if the file is missing or empty
+        """
+        try:
+            result = self.shell.run(['cat', settings.MPIEXEC_NODES_FILE])
+        except spur.RunProcessError:
+            self.logger.warning(self.log_prefix + 'Could not read {0}'.format(settings.MPIEXEC_NODES_FILE))
+            return ['localhost']
+
+        nodes = []
+        for line in result.output.splitlines():
+            node = line.split('#')[0].strip().split(':')[0]  # mpich format, host[:processes]
+            if node and node not in nodes:
+                nodes.append(node)
+        return nodes or ['localhost']
+
+    def run_commands_across_nodes(self, commands, on_complete=None, cwd=None):
+        """
+        Runs independent commands in parallel, one at a time per cluster node
+        Nodes take the next command from a shared queue as soon as they finish one, so faster nodes run more commands
+        Commands are executed with ssh from the master node over channels of self.shell
+        A command interrupted by a connection error is queued again for any node, a node that keeps failing is dropped
+        :param commands: shell commands, each must be runnable on any node (e.g. paths on the shared /mirror)
+        :param on_complete: called as on_complete(index, error) after each command, error is None if it succeeded
+        :return: {index: error message} of commands that failed or could not be run
+        """
+        cwd = cwd or self.working_dir
+        nodes = self.get_cluster_nodes()
+        # completed before the task was interrupted
+        done_commands = set(index for index in self.get_done_commands() if index < len(commands))
+        command_queue = Queue.Queue()
+        for index in range(len(commands)):
+            if index not in done_commands:
+                command_queue.put(index)
+
+        state = {'remaining': len(commands) - len(done_commands), 'active_nodes': 0}
+        errors = {}
+        lock = threading.Lock()
+
+        def finish(index, error):
+            with lock:
+                state['remaining'] -= 1
+                if error is not None:
+                    errors[index] = error
+            if on_complete is not None:
+                on_complete(index, error)
+
+        def worker(node):
+            failures = 0
+            while True:
+                with lock:
+                    if state['remaining'] <= 0:
+                        break
+                try:
+                    index = command_queue.get(timeout=1)  # commands may be queued again by other nodes
+                except Queue.Empty:
+                    continue
+
+                remote_command = 'cd {0} && ({1}) && touch {2}'.format(
+                    pipes.quote(cwd), commands[index], os.path.join(self.get_command_markers_dir(), str(index)))
+                self.logger.debug(self.log_prefix + u'[{0}] Running {1}'.format(node, commands[index]))
+                try:
+                    self.shell.run(['ssh', '-o', 'StrictHostKeyChecking=no', '-o', 'BatchMode=yes', node,
+                                    remote_command])
+                    failures = 0
+                    finish(index, None)
+                    continue
+                except spur.RunProcessError as err:
+                    if err.return_code not in (-1, 255):  # -1: no return code received, 255: ssh to node failed
+                        self.logger.error(self.log_prefix + u'[{0}] RuntimeError: {1}'.format(node, err.message))
+                        finish(index, err.message)
+                        continue
+                    self.logger.error(self.log_prefix + u'[{0}] No response from node'.format(node))
+                except spur.ssh.ConnectionError:
+                    self.logger.error(self.log_prefix + u'[{0}] Connection error'.format(node), exc_info=True)
+
+                command_queue.put(index)  # let any node retry the command
+                failures += 1
+                if failures >= settings.NODE_MAX_CONSECUTIVE_FAILURES:
+                    self.logger.error(self.log_prefix + u'[{0}] Dropped after {1} failures'.format(node, failures))
+                    break
+                time.sleep(min(math.pow(2, failures), MAX_WAIT))
+
+            with lock:
+                state['active_nodes'] -= 1
+                last_node = state['active_nodes'] == 0
+            while last_node:  # no node left to run queued commands
+                try:
+                    finish(command_queue.get_nowait(), 'No reachable node')
+                except Queue.Empty:
+                    break
+
+        if on_complete is not None:
+            for index in sorted(done_commands):
+                on_complete(index, None)
+
+        workers = []
+        state['active_nodes'] = min(len(nodes), state['remaining'])
+        self.logger.debug(self.log_prefix + 'Running {0} command(s) across {1} node(s)'.format(len(commands),
+                                                                                           state['active_nodes']))
+        for node in nodes[:state['active_nodes']]:
+            thread = threading.Thread(target=worker, args=(node,))
+            thread.start()
+            workers.append(thread)
+        for thread in workers:
+            thread.join()
+        return errors
+
+    def run_sweep_across_nodes(self, commands, command_points, points, on_complete=None):
+        """
+        Runs the commands of a parameter sweep with run_commands_across_nodes, tracking the status of each point
+        :param commands: independent commands of all points
+        :param command_points: index in points of each command, a point may have several commands (e.g. one per ligand)
+        :param points: parameter values of each point, e.g. [{'exhaustiveness': '4'}, {'exhaustiveness': '8'}]
+        :return: {index: error message} of commands that failed or could not be run
+        """
+        SweepPoint.objects.filter(task=self.task).delete()  # points of a previous run
+        SweepPoint.objects.bulk_create([SweepPoint(task=self.task, index=index, parameters=json.dumps(parameters))
+                                        for index, parameters in enumerate(points)])
+
+        remaining = collections.Counter(command_points)
+        point_errors = {}
+        lock = threading.Lock()
+
+        def on_command_complete(index, error):
+            point = command_points[index]
+            with lock:
+                remaining[point] -= 1
+                if error is not None:
+                    point_errors.setdefault(point, error)
+                point_done = remaining[point] == 0
+
+            if point_done:
+                if point in point_errors:
+                    status_code, status_msg = 400, 'RuntimeError: ' + point_errors[point]
+                else:
+                    status_code, status_msg = 200, 'Success'
+                SweepPoint.objects.filter(task=self.task, index=point).update(status_code=status_code,
+                                                                              status_msg=status_msg[:300])
+            if on_complete is not None:
+                on_complete(index, error)
+
+        return self.run_commands_across_nodes(commands, on_complete=on_command_complete)
+
     def clear_or_create_dirs(self, **kwargs):
         # clean task output skylabfile, with a signal receiver deleting the actual files
         self.logger.debug(self.log_prefix + "Clearing attached output files if any")
@@ -100,9 +664,10 @@ class P2CToolGeneric(object):  # parent class for all skylab.modules.*.executabl
         # sftp.close()
 
         self.logger.debug(self.log_prefix + 'Clear or create task folder')
-        # clear or create task folder
+        # clear or create task folder, rm -rf dir/* keeps the command completion markers in dir/.done
         self.shell.run(
             ['sh', '-c', clear_or_create.format(self.remote_task_dir)])
+        self.shell.run(['rm', '-rf', self.get_command_markers_dir()])
 
         # create task subdirectories
         self.logger.debug(self.log_prefix + 'Create task subdirs')
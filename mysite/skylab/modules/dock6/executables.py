@@ -3,7 +3,6 @@ import math
 import os.path
 import time
 import stat
-import socket
 
 import spur
 from django.conf import settings
@@ -20,27 +19,8 @@ class GridExecutable(P2CToolGeneric):
         self.task.change_status(status_msg='Uploading input files', status_code=151)
         self.logger.debug(self.log_prefix + 'Uploading input files')
 
-        files = SkyLabFile.objects.filter(type=1, task=self.task)  # fetch input files for this task
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()  # returns a paramiko SFTPClient instance
-        sftp.get_channel().settimeout(300.0)  # set timeout for sftp operations
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-        sftp.chdir(self.working_dir)  # cd /mirror/task_xx/workdir
-
-        for f in files:
-            while True:
-                try:
-                    self.logger.debug(self.log_prefix + "Uploading " + f.filename)
-                    # upload file to remote cluster
-                    sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)
-                    self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
-                    break
-                except (socket.timeout, EOFError):
-                    self.logger.debug(self.log_prefix + "Retrying for " + f.filename)
-                    time.sleep(2)
-        sftp.close()  # close sftp client
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
+        # upload to /mirror/task_xx/workdir
+        self.upload_input_files(remote_dir=self.working_dir, timeout=300.0)
 
     def run_commands(self, **kwargs):
         self.task.change_status(status_msg="Executing tool script", status_code=152)
@@ -49,7 +29,11 @@ class GridExecutable(P2CToolGeneric):
 
         # dock6 and grid does not need export
         error = False
-        for command in command_list:
+        done_commands = self.get_done_commands()  # completed before the task was interrupted
+        for index, command in enumerate(command_list):
+            if index in done_commands:
+                self.logger.debug(self.log_prefix + u'Skipping completed command {0:s}'.format(command))
+                continue
             retries = 0
             exit_loop = False
 
@@ -63,6 +47,7 @@ class GridExecutable(P2CToolGeneric):
                     )
 
                     self.logger.debug(self.log_prefix + "Finished command exec")
+                    self.mark_command_done(index)
                     exit_loop = True  # exit loop
 
                 except spur.RunProcessError as err:
@@ -98,72 +83,22 @@ class GridExecutable(P2CToolGeneric):
     def run_tool(self, **kwargs):  # main function
         self.task.change_status(status_msg='Task started', status_code=150)
         task_remote_subdirs = ['output', 'workdir']  # task subdirectories
-        self.clear_or_create_dirs(task_remote_subdirs=task_remote_subdirs)  # clear or create task subdirectories
-        self.handle_input_files()  # upload input files to remote cluster
-        self.run_commands()  # execute tool commands
-        self.handle_output_files()  # retrieve output files from remote cluster
+        self.run_phases(task_remote_subdirs=task_remote_subdirs)  # resumes after the last completed phase
 
     def handle_output_files(self, **kwargs):
         self.task.change_status(status_msg='Retrieving output files', status_code=154 if not self.task.status_code >= 400 else self.task.status_code)
 
         self.logger.debug(self.log_prefix + 'Sending output files to server')
-        media_root = getattr(settings, "MEDIA_ROOT")
 
         input_files = SkyLabFile.objects.filter(type=1, task=self.task)  # more optimized instead of using related tables
         input_filenames = [file.filename for file in input_files]
 
-        local_dir = u'{0:s}/output/'.format(self.task.task_dirname)
-        local_path = os.path.join(media_root, local_dir)  # absolute path for local dir
-
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-
-        remote_path = self.working_dir
-        remote_files = sftp.listdir(path=remote_path)
-
-        sftp.get_channel().settimeout(300.0)
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-
-
-        for remote_file in remote_files:
-            remote_filepath = os.path.join(remote_path, remote_file)
-            if not stat.S_ISDIR(sftp.stat(remote_filepath).st_mode):  # if regular file
-                if not remote_file in input_filenames:  # do not retrieve input files
-                    local_filepath = os.path.join(local_path, remote_file)
-
-                    self.logger.debug(self.log_prefix + ' Retrieving ' + remote_file)
-                    sftp.get(remote_filepath, local_filepath,
-                             callback=self.sftp_file_transfer_callback)  # transfer file
-                    self.logger.debug(self.log_prefix + ' Received ' + remote_file)
-                    # no need to remove files since parent directory (task folder) will be deleted
-                    # sftp.remove(remote_filepath)  # delete file after transfer
-
-                    # register newly transferred file as skylabfile
-                    new_file = SkyLabFile.objects.create(type=2, task=self.task)  # gamess output file can be rendered with jsmol
-                    new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'),
-                                                      remote_file)  # manual assignment to model filefield
-                    new_file.save()  # save changes
+        # retrieve files produced in workdir, each registered as a skylabfile
+        # no need to remove files since parent directory (task folder) will be deleted
+        self.retrieve_output_files(self.working_dir, exclude=input_filenames, timeout=300.0)
 
         # for tool's other output files
-        zip_filename = self.task.task_dirname + "-other-outputs.zip"
-        local_zip_filepath = os.path.join(media_root, "%s/output/%s" % (self.task.task_dirname, zip_filename))
-        remote_zip_filepath = os.path.join(self.remote_task_dir, zip_filename)
-
-        self.shell.run(["zip", "-r", zip_filename, "output"], cwd=self.remote_task_dir)
-        # self.shell.run(["zip", "-r", "-g", zip_filename, "workdir"], cwd=self.remote_task_dir)
-
-        self.logger.debug(self.log_prefix + ' Retrieving ' + zip_filename)
-        sftp.get(remote_zip_filepath, local_zip_filepath, callback=self.sftp_file_transfer_callback)  # get remote zip
-        self.logger.debug(self.log_prefix + ' Received ' + zip_filename)
-        sftp.close()  # close sftp client
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
-
-        with open(local_zip_filepath, "rb") as local_file:  # attach transferred file to database
-            new_file = SkyLabFile.objects.create(type=2, task=self.task)
-            new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'),
-                                              zip_filename)
-            new_file.save()
+        self.retrieve_output_archive(self.task.task_dirname + "-other-outputs", ["output"], timeout=300.0)
 
         if not self.task.status_code == 400:
             self.task.change_status(status_code=200, status_msg="Output files received. No errors encountered")
@@ -173,7 +108,7 @@ class GridExecutable(P2CToolGeneric):
         self.logger.info(self.log_prefix + 'Done. Output files sent')
 
         # Delete remote task directory
-        self.shell.run(['rm', '-r', self.remote_task_dir])
+        self.remove_remote_task_dir()
 
 class Dock6Executable(GridExecutable):  # dock6 executable if implemented will exactly be the same as grid executable
     pass
@@ -4,7 +4,6 @@ import os
 import re
 import stat
 import time
-import socket
 
 import spur
 from django.conf import settings
@@ -14,6 +13,8 @@ from skylab.modules.basetool import P2CToolGeneric
 
 
 class GamessExecutable(P2CToolGeneric):
+    allow_concurrent_runs = False  # scratch files are written to and cleared from the shared ~/scr dir
+
     def __init__(self, **kwargs):
         super(GamessExecutable, self).__init__(**kwargs)
         self.working_dir = os.path.join(self.remote_task_dir, 'input')  # this is where the commands will be executed
@@ -22,28 +23,8 @@ class GamessExecutable(P2CToolGeneric):
         self.task.change_status(status_msg='Uploading input files', status_code=151)
         self.logger.debug(self.log_prefix + 'Uploading input files')
 
-        files = SkyLabFile.objects.filter(type=1, task=self.task)  #fetch input files for this task
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-        sftp.get_channel().settimeout(300.0)
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-
-        sftp.chdir(self.working_dir)  # cd /mirror/task_xx/input
-
-        for f in files:
-            while True:
-                try:
-                    self.logger.debug(self.log_prefix + "Uploading " + f.filename)
-                    sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)  # copy file object to cluster as f.filename in the current dir
-                    self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
-                    break
-                except (socket.timeout, EOFError):
-                    self.logger.debug(self.log_prefix + "Retrying for " + f.filename)
-                    time.sleep(2)
-
-        sftp.close()
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
+        # upload to /mirror/task_xx/input
+        self.upload_input_files(remote_dir=self.working_dir, timeout=300.0)
 
     def run_commands(self, **kwargs):
         self.task.change_status(status_msg="Executing tool script", status_code=152)
@@ -62,7 +43,11 @@ class GamessExecutable(P2CToolGeneric):
         env_command = "export PATH=$PATH:{0};".format(export_path)
 
         error = False
-        for command in command_list:
+        done_commands = self.get_done_commands()  # completed before the task was interrupted
+        for index, command in enumerate(command_list):
+            if index in done_commands:
+                self.logger.debug(self.log_prefix + u'Skipping completed command {0:s}'.format(command))
+                continue
             retries = 0
             exit_loop = False
 
@@ -76,6 +61,7 @@ class GamessExecutable(P2CToolGeneric):
                     )
 
                     self.logger.debug(self.log_prefix + "Finished command exec")
+                    self.mark_command_done(index)
                     exit_loop = True  # exit loop
 
                 except spur.RunProcessError as err:
@@ -128,66 +114,19 @@ class GamessExecutable(P2CToolGeneric):
         self.task.change_status(status_msg='Retrieving output files', status_code=154 if not self.task.status_code >= 400 else self.task.status_code)
 
         self.logger.debug(self.log_prefix + 'Sending output files to server')
-        media_root = getattr(settings, "MEDIA_ROOT")
-
-        local_dir = u'{0:s}/output/'.format(self.task.task_dirname)
-        local_path = os.path.join(media_root, local_dir)  # absolute path for local dir
-
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-
-
-        remote_path = os.path.join(self.remote_task_dir, 'output')
-
-        # retrieve then delete produced output files
-        remote_files = sftp.listdir(path=remote_path)  # list dirs and files in remote path
-        sftp.get_channel().settimeout(300.0)
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-        for remote_file in remote_files:
-            remote_filepath = os.path.join(remote_path, remote_file)
-            if not stat.S_ISDIR(sftp.stat(remote_filepath).st_mode):  # if regular file
-
-                local_filepath = os.path.join(local_path, remote_file)
-                while True:
-                    try:
-                        self.logger.debug(self.log_prefix + ' Retrieving ' + remote_file)
-                        sftp.get(remote_filepath, local_filepath, callback=self.sftp_file_transfer_callback)  # transfer file
-                        self.logger.debug(self.log_prefix + ' Received ' + remote_file)
-                        break
-                    except (socket.timeout, EOFError):
-                        self.logger.debug(self.log_prefix + ' Retrying for ' + remote_file)
-                        time.sleep(2)
-
-                # register newly transferred file as skylabfile
-                new_file = SkyLabFile.objects.create(type=2, task=self.task,
-                                                     render_with_jsmol=True)  # gamess output file can be rendered with jsmol
-                new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'),
-                                                  remote_file)  # manual assignment to model filefield
-                new_file.save()  # save changes
+
+        # retrieve produced output files, each registered as a skylabfile
+        # gamess output files can be rendered with jsmol
+        self.retrieve_output_files(os.path.join(self.remote_task_dir, 'output'), timeout=300.0,
+                                   render_with_jsmol=True)
 
         # retrieve then delete produced scratch files
-        zip_filename = self.task.task_dirname + "-scratch_files.zip"
-        local_zip_filepath = os.path.join(media_root, "%s/output/%s" % (self.task.task_dirname, zip_filename))
-        remote_zip_filepath = os.path.join(settings.REMOTE_BASE_DIR, zip_filename)
-
-        self.shell.run(["zip", "-r", zip_filename, "scr"])  # zip scr folder
-        self.logger.debug(self.log_prefix + 'Downloading '+ zip_filename)
-        sftp.get(remote_zip_filepath, local_zip_filepath, callback=self.sftp_file_transfer_callback)  # get remote zip
-        self.logger.debug(self.log_prefix + 'Downloaded '+ zip_filename)
-        sftp.remove(remote_zip_filepath)
-        sftp.close()
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
-
-        # register newly transferred file as skylabfile
-        new_file = SkyLabFile.objects.create(type=2, task=self.task)
-        new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'),
-                                          zip_filename)
-        new_file.save()
+        self.retrieve_output_archive(self.task.task_dirname + "-scratch_files", ["scr"],
+                                     cwd=settings.REMOTE_BASE_DIR, timeout=300.0)
 
         # delete via ssh is faster than sftp
         self.shell.run(['sh', '-c', 'rm -rf scr/*'])  # Clear scratch directory
-        self.shell.run(['rm', '-rf', self.remote_task_dir])  # Delete remote task directory
+        self.remove_remote_task_dir()
 
         if not self.task.status_code == 400:
             self.task.change_status(status_code=200, status_msg="Output files received. No errors encountered")
@@ -203,8 +142,5 @@ class GamessExecutable(P2CToolGeneric):
         task_remote_subdirs = ['input', 'output']
 
         # clear or create required remote directories
-        self.clear_or_create_dirs(additional_dirs=additional_dirs, task_remote_subdirs=task_remote_subdirs)
-
-        self.handle_input_files()  # upload input files to remote cluster
-        self.run_commands()  # execute tool commands
-        self.handle_output_files()  # retrieve output files from remote cluster
\ No newline at end of file
+        self.run_phases(additional_dirs=additional_dirs,
+                        task_remote_subdirs=task_remote_subdirs)  # resumes after the last completed phase
\ No newline at end of file
@@ -1,7 +1,9 @@
 import json
 import math
 import os
+import pipes
 import stat
+import threading
 import time
 import socket
 
@@ -11,10 +13,27 @@ from django.conf import settings
 from skylab.models import SkyLabFile
 from skylab.modules.basetool import P2CToolGeneric
 
-from cStringIO import StringIO
 # 6, 11, 12 (segmentation fault) inherent error
 # 3, 4 secondary numeric input needed
 
+# usage: sh run_impi.sh image... (executed in /mirror/task_xx/output, images in /mirror/task_xx/input)
+# impi always writes test_out.jpg in its current dir, so each image runs in its own dir to allow parallel runs
+BATCH_SCRIPT = """export PATH=$PATH:/mirror/impi
+status=0
+for image in "$@"; do
+    name=$(basename "$image")
+    name=${name%%.*}
+    mkdir -p "$name"
+    if (cd "$name" && impi "../../input/$image" < %(params)s > impi.log 2>&1 && mv test_out.jpg "../${name}_out.jpg"); then
+        rm -rf "$name"
+    else
+        echo "impi failed for $image, see output/$name/impi.log" >&2
+        status=1
+    fi
+done
+exit $status
+"""
+
 class ImpiExecutable(P2CToolGeneric):  # for multiple files with the same operations to run with
     def __init__(self, **kwargs):
         super(ImpiExecutable, self).__init__(**kwargs)
@@ -25,28 +44,8 @@ class ImpiExecutable(P2CToolGeneric):  # for multiple files with the same operat
         self.task.change_status(status_msg='Uploading input files', status_code=151)
         self.logger.debug(self.log_prefix + 'Uploading input files')
 
-        files = SkyLabFile.objects.filter(type=1, task=self.task)  # fetch input files for this task
-        self.logger.debug(self.log_prefix + "Opening SFTP client")
-        sftp = self.shell._open_sftp_client()
-
-        sftp.chdir(os.path.join(self.remote_task_dir, 'input'))  # cd /mirror/task_xx/input
-        self.logger.debug(self.log_prefix + "Opened SFTP client")
-
-        sftp.get_channel().settimeout(300.0)  # set timeout for sftp operations
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-
-        for f in files:
-            while True:
-                try:
-                    self.logger.debug(self.log_prefix + "Uploading " + f.filename)
-                    sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)  # copy file object to cluster as f.filename in the current dir
-                    self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
-                    break
-                except (socket.timeout, EOFError):
-                    self.logger.debug(self.log_prefix + "Retrying for " + f.filename)
-                    time.sleep(2)
-        sftp.close()  # close sftp client
-        self.logger.debug(self.log_prefix + "Closed SFTP client")
+        # upload to /mirror/task_xx/input
+        self.upload_input_files(remote_dir=os.path.join(self.remote_task_dir, 'input'), timeout=300.0)
 
     def run_commands(self, **kwargs):
         self.task.change_status(status_msg="Executing tool script", status_code=152)
@@ -54,88 +53,47 @@ class ImpiExecutable(P2CToolGeneric):  # for multiple files with the same operat
         command_list = task_data['command_list']  # load json array
         input_filenames = task_data['input_filenames']
 
-        default_output_filename = 'test_out.jpg'
-
-        export_path = "/mirror/impi"
-        env_command = "export PATH=$PATH:{0};".format(export_path)
-
-        error = False
-
-        self.logger.debug(self.log_prefix + "Opening SFTP client")
-        sftp = self.shell._open_sftp_client()  # open sftp client
-        sftp.chdir(self.working_dir)  # go to working dir
-        self.logger.debug(self.log_prefix + "Opened SFTP client")
-
-        for filename in input_filenames:
-            command = 'impi '+ os.path.join('../input', filename)
-            # running using mpirun causes execution to not terminate most of the time
-            # hypothesis: only one process receives stdin_write, additional process do not receive them, thus, the said
-            # processes won't terminate properly
-
-            #command = "mpirun -np {0:d} -f {1:s} impi ../input/{2}".format(self.task.mpi_cluster.total_node_count,
-            #                                                        settings.MPIEXEC_NODES_FILE, filename)
-            retries = 0
-            exit_loop = False
-
-            while not exit_loop:  # try while not exit
-                self.logger.debug(self.log_prefix + u'Running {0:s}'.format(command))
-                try:
-                    exit_retries = 0
-                    exec_shell = self.shell.spawn(
-                        ['sh', '-c', env_command + command],  # run command with env_command
-                        cwd=self.working_dir
-                    )
-
-                    for parameter in command_list:
-                        self.logger.debug(self.log_prefix + 'input ' + str(parameter))
-                        exec_shell.stdin_write(str(parameter) + "\n")  # stdin input of parameters
-                        time.sleep(2)
-
-                    self.logger.debug(self.log_prefix + 'Running exit operation')
-
-                    exec_shell.stdin_write(str(0)+"\n")
-
-                    exec_shell.wait_for_result()
-                    self.logger.debug(self.log_prefix + 'Exited operation')
-
-                    new_output_filename = os.path.splitext(os.path.basename(filename))[0] + '_out.jpg'
-                    if default_output_filename != new_output_filename:
-                        sftp.rename(default_output_filename, new_output_filename)
-                        self.output_files.append(new_output_filename)
-
-                    self.logger.debug(self.log_prefix + "Finished command exec")
-                    exit_loop = True  # exit loop
-                except IOError as err:
-                    self.logger.error(self.log_prefix + 'IOError: ' + err.message)
-
-                except spur.RunProcessError as err:
-                    if err.return_code == -1:  # no return code received
-                        self.logger.error(
-                            self.log_prefix + 'No response from server. Retrying command ({0})'.format(command))
-                    else:
-                        self.logger.error(self.log_prefix + 'RuntimeError: ' + err.message)
-                        error = True  # do not retry
-                        self.task.change_status(
-                            status_msg='RuntimeError: ' + err.message, status_code=400)
-                        exit_loop = True  # exit loop
-
-                except spur.ssh.ConnectionError:
-                    self.logger.error('Connection error. Command: ({0})'.format(command), exc_info=True)
-
-                finally:
-                    if not exit_loop:
-                        retries += 1
-                        wait_time = min(math.pow(2, retries),
-                                        settings.TRY_WHILE_NOT_EXIT_MAX_TIME)  # exponential wait with max
-                        self.logger.debug('Waiting {0}s until next retry'.format(wait_time))
-                        time.sleep(wait_time)
-
-        sftp.close()
-        self.logger.debug(self.log_prefix + "Closed SFTP client")
-
-        if error:
+        # impi reads menu parameters from stdin, the whole parameter script is redirected from a file instead of
+        # written one parameter at a time, so each image finishes as soon as impi exits
+        params_path = os.path.join(self.remote_task_dir, 'impi_params.txt')
+        script_path = os.path.join(self.remote_task_dir, 'run_impi.sh')
+        self.logger.debug(self.log_prefix + 'Writing parameter and batch scripts')
+        self._run_remote_script(
+            ["cat > {0} <<'EOF'".format(params_path)] + [str(parameter) for parameter in command_list] +
+            ['0', 'EOF'] +  # 0 exits the menu
+            ["cat > {0} <<'EOF'".format(script_path)] + (BATCH_SCRIPT % {'params': params_path}).splitlines() +
+            ['EOF']
+        )
+
+        # several images per batch run one after the other in a single invocation, batches run in parallel across nodes
+        batch_size = max(1, settings.IMPI_IMAGES_PER_BATCH)
+        batches = [input_filenames[i:i + batch_size] for i in range(0, len(input_filenames), batch_size)]
+        commands = ['sh {0} {1}'.format(script_path, ' '.join(pipes.quote(filename) for filename in batch))
+                    for batch in batches]
+
+        progress = {'processed': 0}
+        progress_lock = threading.Lock()
+
+        def on_complete(index, error):
+            with progress_lock:
+                progress['processed'] += len(batches[index])
+                self.task.change_status(status_msg='Processed {0} of {1} images'.format(progress['processed'],
+                                                                                       len(input_filenames)),
+                                        status_code=152)
+
+        errors = self.run_commands_across_nodes(commands, on_complete=on_complete)
+
+        # the batch script leaves <image>_out.jpg in the working dir for each image that was processed
+        result = self.shell.run(['sh', '-c', 'ls *_out.jpg 2>/dev/null || true'], cwd=self.working_dir)
+        self.output_files = result.output.split()
+
+        if errors:
+            for index, error in errors.items():
+                self.logger.error(self.log_prefix + 'RuntimeError: ' + error)
             self.task.change_status(
-                status_msg='Task execution error!', status_code=400)
+                status_msg='Task execution error! {0} of {1} images processed'.format(len(self.output_files),
+                                                                                     len(input_filenames)),
+                status_code=400)
         else:
             self.logger.debug(self.log_prefix + 'Finished command list execution')
 
@@ -192,7 +150,7 @@ class ImpiExecutable(P2CToolGeneric):  # for multiple files with the same operat
         sftp.close()
         self.logger.debug(self.log_prefix + "Closed SFTP client")
 
-        self.shell.run(['rm', '-rf', self.remote_task_dir])  # Delete remote task directory
+        self.remove_remote_task_dir()
         self.logger.debug(self.log_prefix + "Deleted remote task dir")
 
         if not self.task.status_code == 400:
@@ -206,7 +164,4 @@ class ImpiExecutable(P2CToolGeneric):  # for multiple files with the same operat
         self.task.change_status(status_msg='Task started', status_code=150)
 
         task_remote_subdirs = ['input', 'output']
-        self.clear_or_create_dirs(task_remote_subdirs=task_remote_subdirs)
-        self.handle_input_files()  # upload input files to remote cluster
-        self.run_commands()  # execute tool commands
-        self.handle_output_files()  # retrieve output files from remote cluster
+        self.run_phases(task_remote_subdirs=task_remote_subdirs)  # resumes after the last completed phase
@@ -10,70 +10,44 @@ from django.conf import settings
 
 from skylab.models import SkyLabFile
 from skylab.modules.basetool import P2CToolGeneric
+from skylab.modules.quantumespresso.pseudocache import pseudo_cache
 
+PSEUDO_DIR = os.path.join(settings.REMOTE_BASE_DIR, 'espresso-5.4.0/pseudo')  # shared by all tasks
 
 # current implementation installs via apt-get install quantum-espresso
 class QuantumEspressoExecutable(P2CToolGeneric):
+    allow_concurrent_runs = False  # tmp_dir is shared by all tasks and cleared after each task
+
     def __init__(self, **kwargs):
         super(QuantumEspressoExecutable, self).__init__(**kwargs)
         # self.pseudo_dir = os.path.join(self.remote_task_dir, 'pseudodir')
         # self.tmp_dir = os.path.join(self.remote_task_dir, 'tempdir')
-        self.pseudo_dir = os.path.join(settings.REMOTE_BASE_DIR, 'espresso-5.4.0/pseudo')
+        self.pseudo_dir = PSEUDO_DIR
         self.tmp_dir = os.path.join(settings.REMOTE_BASE_DIR, 'espresso-5.4.0/tempdir')
-        self.network_pseudo_download_url = "http://www.quantum-espresso.org/wp-content/uploads/upf_files/"
-        # suggestion is to download all pseudopotentials and host them in a webserver for faster retrieval
+        # pseudopotentials are downloaded from settings.QE_PSEUDO_MIRROR_URL
+
+    @classmethod
+    def prefetch_inputs(cls, task, mpi_thread):
+        pseudopotentials = json.loads(task.task_data).get("pseudopotentials", None)
+        if pseudopotentials:
+            pseudo_cache.prefetch(mpi_thread, PSEUDO_DIR, pseudopotentials)
 
     def handle_input_files(self, **kwargs):
         self.task.change_status(status_msg='Uploading input files', status_code=151)
         self.logger.debug(self.log_prefix + 'Uploading input files')
 
-        files = SkyLabFile.objects.filter(type=1, task=self.task)  # fetch input files for this task
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-        sftp.chdir(os.path.join(self.remote_task_dir, 'input'))  # cd /mirror/task_xx/input
-
-        sftp.get_channel().settimeout(180.0)
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-
-        for f in files:
-            while True:
-                try:
-                    self.logger.debug(self.log_prefix + "Uploading " + f.filename)
-                    sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)  # copy file object to cluster as f.filename in the current dir
-                    self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
-                    break
-                except (socket.timeout, EOFError):
-                    self.logger.debug(self.log_prefix + "Retrying for " + f.filename)
-                    time.sleep(2)
+        # upload to /mirror/task_xx/input
+        self.upload_input_files(remote_dir=os.path.join(self.remote_task_dir, 'input'), timeout=180.0)
 
         pseudopotentials = json.loads(self.task.task_data).get("pseudopotentials", None)
         if pseudopotentials:
             self.logger.debug(self.log_prefix + 'Downloading pseudopotentials')
-            # pseudopotential_urls = []
-
-            for pseudo_file in pseudopotentials:
-                try:
-                    sftp.stat(os.path.join(self.pseudo_dir, pseudo_file))
-                    self.logger.debug(self.log_prefix + pseudo_file + "already in pseudo_dir")
-                except IOError: #if pseudopotential file not found, download
-                    url = os.path.join(self.network_pseudo_download_url, pseudo_file)
-                    # pseudopotential_urls.append(url)
-                    command = 'curl --max-time 300 -O ' + url
-                    # command = "wget --timeout=60 " + url
-                    self.logger.debug(self.log_prefix + 'Downloading '+ url)
-                    self.shell.run(["sh","-c", command], cwd=self.pseudo_dir)
-                    self.logger.debug(self.log_prefix + 'Downloaded file')
-
-
-            # command = 'printf "{urls}" > urls.txt && wget -i urls.txt'.format(urls='\n'.join(pseudopotential_urls))
-            # self.logger.debug(self.log_prefix + 'Command: ' + command)
-            # download_shell = self.shell.run(["sh", "-c", command], cwd=self.pseudo_dir)
-            # self.logger.debug(self.log_prefix + download_shell.output)
-            self.logger.debug(self.log_prefix + 'Downloaded pseudopotentials')
-
-        sftp.close()
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
+            # usually already in the cluster's pseudo_dir, prefetched when the task was queued
+            missing = pseudo_cache.ensure(self.task.mpi_cluster_id, self.shell, self.pseudo_dir, pseudopotentials)
+            if missing:
+                self.logger.error(self.log_prefix + 'Could not download {0}'.format(', '.join(missing)))
+            else:
+                self.logger.debug(self.log_prefix + 'Downloaded pseudopotentials')
 
     def run_commands(self, **kwargs):
         # change export path QE will be installed via p2c-tools
@@ -93,7 +67,11 @@ class QuantumEspressoExecutable(P2CToolGeneric):
         command_list = task_data['command_list']
 
         error = False
-        for command in command_list:
+        done_commands = self.get_done_commands()  # completed before the task was interrupted
+        for index, command in enumerate(command_list):
+            if index in done_commands:
+                self.logger.debug(self.log_prefix + u'Skipping completed command {0:s}'.format(command))
+                continue
             retries = 0
             exit_loop = False
 
@@ -107,6 +85,7 @@ class QuantumEspressoExecutable(P2CToolGeneric):
                     )
 
                     self.logger.debug(self.log_prefix + "Finished command exec")
+                    self.mark_command_done(index)
                     exit_loop = True  # exit loop
 
                 except spur.RunProcessError as err:
@@ -188,7 +167,7 @@ class QuantumEspressoExecutable(P2CToolGeneric):
         sftp.close()
         self.logger.debug(self.log_prefix + 'Closed SFTP client')
 
-        self.shell.run(['rm', '-rf', self.remote_task_dir])  # Delete remote task directory
+        self.remove_remote_task_dir()
 
         # clear tempdir
         command = 'rm -rf *'
@@ -208,8 +187,5 @@ class QuantumEspressoExecutable(P2CToolGeneric):
         self.task.change_status(status_msg='Task started', status_code=150)
         additional_dirs = ['/mirror/espresso-5.4.0/tempdir','/mirror/espresso-5.4.0/pseudo']
         task_remote_subdirs = ['input', 'output'] # 'pseudodir', 'tempdir'
-        self.clear_or_create_dirs(task_remote_subdirs=task_remote_subdirs)
-        self.handle_input_files()  # upload input files to remote cluster
-        self.run_commands()  # execute tool commandas
-        self.handle_output_files()  # retrieve output files from remote cluster
+        self.run_phases(task_remote_subdirs=task_remote_subdirs)  # resumes after the last completed phase
 
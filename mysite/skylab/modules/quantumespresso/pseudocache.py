@@ -0,0 +1,103 @@
+import logging
+import pipes
+import threading
+
+from django.conf import settings
+
+
+class PseudopotentialCache(object):
+    """
+    Tracks the pseudopotential files held in the pseudo dir of each cluster
+    Missing files are downloaded in parallel from settings.QE_PSEUDO_MIRROR_URL by the cluster itself
+    A file is downloaded once per cluster, callers needing a file that is being downloaded wait for that download
+    """
+
+    def __init__(self):
+        self._manifests = {}  # mpi cluster id: filenames in the pseudo dir
+        self._downloads = {}  # (mpi cluster id, filename): threading.Event set once the download finished
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _list_pseudo_dir(self, shell, pseudo_dir):
+        command = 'mkdir -p {0} && ls {0}'.format(pipes.quote(pseudo_dir))
+        return set(shell.run(['sh', '-c', command]).output.split())
+
+    def _get_manifest(self, cluster_id, shell, pseudo_dir):
+        with self._lock:
+            manifest = self._manifests.get(cluster_id)
+        if manifest is None:  # first use for this cluster, e.g. after a server restart
+            files = self._list_pseudo_dir(shell, pseudo_dir)
+            with self._lock:
+                manifest = self._manifests.setdefault(cluster_id, set())
+                manifest.update(files)
+        return manifest
+
+    def _download(self, shell, pseudo_dir, filenames):
+        # curl writes to a .part file so interrupted downloads are never mistaken for cached files
+        command = 'printf "%s\\n" {0} | xargs -n 1 -P {1} sh -c {2} {3}'.format(
+            ' '.join(pipes.quote(filename) for filename in filenames),
+            max(1, settings.QE_PSEUDO_DOWNLOAD_WORKERS),
+            pipes.quote('curl -sfS --max-time 300 -o "$1.part" "$0/$1" && mv "$1.part" "$1"'),
+            pipes.quote(settings.QE_PSEUDO_MIRROR_URL.rstrip('/')))
+        result = shell.run(['sh', '-c', command], cwd=pseudo_dir, allow_error=True)
+        if result.return_code != 0:
+            self.logger.warning('Pseudopotential download exited with status {0}: {1}'.format(
+                result.return_code, result.stderr_output.strip()))
+
+    def ensure(self, cluster_id, shell, pseudo_dir, filenames):
+        """
+        Makes sure filenames are in pseudo_dir of the cluster
+        :return: filenames that could not be downloaded
+        """
+        manifest = self._get_manifest(cluster_id, shell, pseudo_dir)
+        to_download = []
+        to_wait = []
+        with self._lock:
+            for filename in set(filenames):
+                if filename in manifest:
+                    continue
+                download = self._downloads.get((cluster_id, filename))
+                if download is None:
+                    self._downloads[(cluster_id, filename)] = threading.Event()
+                    to_download.append(filename)
+                else:  # being downloaded by a prefetch or another task
+                    to_wait.append(download)
+
+        try:
+            if to_download:
+                self.logger.debug('Downloading pseudopotentials {0}'.format(', '.join(to_download)))
+                self._download(shell, pseudo_dir, to_download)
+                files = self._list_pseudo_dir(shell, pseudo_dir)
+                with self._lock:
+                    manifest.update(files)
+        finally:
+            with self._lock:
+                for filename in to_download:
+                    self._downloads.pop((cluster_id, filename)).set()
+
+        for download in to_wait:
+            download.wait()
+
+        with self._lock:
+            return [filename for filename in filenames if filename not in manifest]
+
+    def prefetch(self, mpi_thread, pseudo_dir, filenames):
+        # downloads in the background, e.g. while the tasks queued before run
+        def run():
+            mpi_thread.connected.wait()
+            shell = mpi_thread.get_cluster_shell()
+            if shell is None:  # cluster deleted
+                return
+            try:
+                missing = self.ensure(mpi_thread.mpi_cluster.id, shell, pseudo_dir, filenames)
+                if missing:
+                    self.logger.warning(mpi_thread.log_prefix + 'Could not prefetch {0}'.format(', '.join(missing)))
+            except Exception:
+                self.logger.error(mpi_thread.log_prefix + 'Error while prefetching pseudopotentials', exc_info=True)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+pseudo_cache = PseudopotentialCache()
@@ -7,7 +7,7 @@ import spur
 from django.conf import settings
 
 from skylab.models import SkyLabFile
-from skylab.modules.basetool import P2CToolGeneric, mkdir_p
+from skylab.modules.basetool import P2CToolGeneric
 
 
 class RayExecutable(P2CToolGeneric):
@@ -19,23 +19,9 @@ class RayExecutable(P2CToolGeneric):
         self.task.change_status(status_msg='Uploading input files', status_code=151)
         self.logger.debug(self.log_prefix + 'Uploading input files')
 
-        files = SkyLabFile.objects.filter(type=1, task=self.task)  # input files for this task
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()  # open sftp client
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-
         #no timeouts will be implemented for ray since input files used are too large
-        # sftp.get_channel().settimeout(900.0) #
-        # self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-
-        for f in files:
-            sftp.chdir(self.remote_task_dir)  # cd /mirror/task_xx
-            self.logger.debug(self.log_prefix + 'Uploading ' + f.filename )
-            mkdir_p(sftp, f.upload_path)  # mimics mkdir -p f.upload_path
-            sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)  # At this point, you are f.upload_path
-            self.logger.debug(self.log_prefix + 'Uploaded ' + f.filename)
-        sftp.close()
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
+        # upload to /mirror/task_xx/<upload_path>
+        self.upload_input_files(keep_upload_path=True, timeout=None)
 
     def run_commands(self, **kwargs):
         self.task.change_status(status_msg="Executing tool script", status_code=152)
@@ -47,7 +33,11 @@ class RayExecutable(P2CToolGeneric):
         env_command = "export PATH=$PATH:{0};".format(export_path)
 
         error = False
-        for command in command_list:
+        done_commands = self.get_done_commands()  # completed before the task was interrupted
+        for index, command in enumerate(command_list):
+            if index in done_commands:
+                self.logger.debug(self.log_prefix + u'Skipping completed command {0:s}'.format(command))
+                continue
             retries = 0
             exit_loop = False
 
@@ -61,6 +51,7 @@ class RayExecutable(P2CToolGeneric):
                     )
 
                     self.logger.debug(self.log_prefix + "Finished command exec")
+                    self.mark_command_done(index)
                     exit_loop = True  # exit loop
 
                 except spur.RunProcessError as err:
@@ -93,33 +84,12 @@ class RayExecutable(P2CToolGeneric):
         self.task.change_status(status_msg='Retrieving output files', status_code=154 if not self.task.status_code >= 400 else self.task.status_code)
 
         self.logger.debug(self.log_prefix + 'Sending output files to server')
-        media_root = getattr(settings, "MEDIA_ROOT")
-
-        zip_filename = self.task.task_dirname + "-output.zip"
-        local_zip_filepath = os.path.join(media_root, "%s/output/%s" % (self.task.task_dirname, zip_filename))
-        remote_zip_filepath = os.path.join(self.remote_task_dir, zip_filename)
-
-        self.shell.run(["zip", "-r", zip_filename, "output"], cwd=self.remote_task_dir)
-
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-
-        self.logger.debug(self.log_prefix + 'Retrieving ' + zip_filename)
-        sftp.get(remote_zip_filepath, local_zip_filepath, callback=self.sftp_file_transfer_callback)  # get remote zip
-        self.logger.debug(self.log_prefix + 'Retrieved ' + zip_filename)
-        #sftp.remove(remote_zip_filepath) no need to delete file after transfer since parent directory will be deleted anyway
-
-        sftp.close()
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
 
-        # attach transferred file to database
-        new_file = SkyLabFile.objects.create(type=2, task=self.task)
-        new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'),
-                                          zip_filename)
-        new_file.save()
+        # stream /mirror/task_xx/output as an archive, attached as a skylabfile
+        # no timeouts since ray assemblies are too large
+        self.retrieve_output_archive(self.task.task_dirname + "-output", ["output"], timeout=None)
 
-        self.shell.run(['rm', '-rf', self.remote_task_dir])  # Delete remote task directory
+        self.remove_remote_task_dir()
 
         if not self.task.status_code == 400:
             self.task.change_status(status_code=200, status_msg="Output files received. No errors encountered")
@@ -130,7 +100,4 @@ class RayExecutable(P2CToolGeneric):
 
     def run_tool(self, **kwargs):  # the whole task process
         self.task.change_status(status_msg='Task started', status_code=150)
-        self.clear_or_create_dirs(task_remote_subdirs=['input', 'output'])
-        self.handle_input_files()  # upload files to remote cluster
-        self.run_commands()  # execute tool commands
-        self.handle_output_files()  # retrieve output files from remote cluster
+        self.run_phases(task_remote_subdirs=['input', 'output'])  # resumes after the last completed phase
@@ -4,11 +4,15 @@ import os.path
 import stat
 import time
 import socket
+import threading
 import spur
 from django.conf import settings
 
-from skylab.models import SkyLabFile
-from skylab.modules.basetool import P2CToolGeneric, mkdir_p
+from skylab.models import SkyLabFile, VinaResult
+from skylab.modules.basetool import P2CToolGeneric
+from skylab.modules.vina.results import parse_vina_log, parse_vina_pose
+
+POSE_SEPARATOR = '__SKYLAB_VINA_POSE__'
 
 
 class VinaExecutable(P2CToolGeneric):
@@ -20,131 +24,110 @@ class VinaExecutable(P2CToolGeneric):
         self.task.change_status(status_msg='Uploading input files', status_code=151)
         self.logger.debug(self.log_prefix + 'Uploading input files')
 
-        files = SkyLabFile.objects.filter(type=1, task=self.task)  # input files for this task
-
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()  # open sftp client
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-
-        sftp.get_channel().settimeout(180.0)  # set timeout to 3 mins
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-
-        for f in files:
-            sftp.chdir(self.remote_task_dir)  # cd /mirror/task_xx
-            mkdir_p(sftp, f.upload_path)  # mimics mkdir -p f.upload_path
-            while True:
-                try:
-                    self.logger.debug(self.log_prefix + "Uploading " + f.filename)
-                    sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)  # copy file object to cluster as f.filename in the current dir
-                    self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
-                    break
-                except (socket.timeout, EOFError):
-                    self.logger.debug(self.log_prefix + "Retrying for " + f.filename)
-                    time.sleep(2)
-        sftp.close()
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
+        # upload to /mirror/task_xx/<upload_path>, e.g. input/ligands
+        self.upload_input_files(keep_upload_path=True, timeout=180.0)
 
     def run_commands(self, **kwargs):
         self.task.change_status(status_msg="Executing tool script", status_code=152)
-        command = json.loads(self.task.task_data)['command_list'][0]  # load json array
-
-        retries = 0
-        exit_loop = False
-        error = False
-
-        while not exit_loop:
-            self.logger.debug(self.log_prefix + u'Running {0:s}'.format(command))
-            try:
-                # export commands does not persist with spur at least
-                exec_shell = self.shell.run(
-                    ['sh', '-c', command],
-                    cwd=self.working_dir
-                )
-
-                self.logger.debug(self.log_prefix + "Finished command exec")
-                exit_loop = True  # exit loop
-
-            except spur.RunProcessError as err:
-                if err.return_code == -1:  # no return code received
-                    self.logger.error(
-                        self.log_prefix + 'No response from server. Retrying command ({0})'.format(command))
-                else:
-                    self.logger.error(self.log_prefix + 'RuntimeError: ' + err.message)
-                    self.task.change_status(
-                        status_msg='RuntimeError: ' + err.message, status_code=400)
-                    error = True
-                    exit_loop = True  # exit loop
-
-            except spur.ssh.ConnectionError:
-                self.logger.error('Connection error. Command: ({0})'.format(command), exc_info=True)
-            finally:
-                if not exit_loop:
-                    retries += 1
-                    wait_time = min(math.pow(2, retries), settings.TRY_WHILE_NOT_EXIT_MAX_TIME)
-                    self.logger.debug('Waiting {0}s until next retry'.format(wait_time))
-                    time.sleep(wait_time)
-
-        if not error:
+        task_data = json.loads(self.task.task_data)
+        # one vina command per ligand, independent of each other
+        command_list = [command.strip().rstrip(';') for command in task_data['command_list']]
+        ligands = task_data.get('ligands') or [str(i + 1) for i in range(len(command_list))]
+
+        # each node docks one ligand at a time with all of its cpus
+        cpu = settings.VINA_CPU_PER_NODE or '$(nproc)'
+        command_list = [u'{0} --cpu {1}'.format(command, cpu) for command in command_list]
+
+        VinaResult.objects.filter(task=self.task).delete()  # results of a previous run
+        progress = {'docked': 0, 'failed': 0, 'updated': time.time()}
+        pending_results = []
+        progress_lock = threading.Lock()
+
+        def on_complete(index, error):
+            result = None
+            if error is None and 'ligands' in task_data:
+                result = self.parse_ligand_result(ligands[index])  # outputs of the ligand are complete
+
+            with progress_lock:
+                progress['docked'] += 1
+                if error is not None:
+                    progress['failed'] += 1
+                # each status change is logged and published, at most one per VINA_PROGRESS_UPDATE_INTERVAL
+                if progress['docked'] == len(command_list) or \
+                        time.time() - progress['updated'] >= settings.VINA_PROGRESS_UPDATE_INTERVAL:
+                    progress['updated'] = time.time()
+                    status_msg = u'Docked {0} of {1} ligands'.format(progress['docked'], len(command_list))
+                    if progress['failed']:
+                        status_msg += u' ({0} failed)'.format(progress['failed'])
+                    self.task.change_status(status_msg=status_msg, status_code=152)
+
+                if result is not None:
+                    pending_results.append(result)
+                if len(pending_results) >= settings.VINA_RESULTS_BATCH_SIZE:
+                    VinaResult.objects.bulk_create(pending_results)
+                    del pending_results[:]
+
+        sweep = task_data.get('sweep')
+        if sweep:  # one command per ligand and sweep point
+            errors = self.run_sweep_across_nodes(command_list, sweep['command_points'], sweep['points'],
+                                                 on_complete=on_complete)
+        else:
+            errors = self.run_commands_across_nodes(command_list, on_complete=on_complete)
+        VinaResult.objects.bulk_create(pending_results)
+
+        if errors:
+            failed_ligands = ', '.join(ligands[index] for index in sorted(errors))
+            self.logger.error(self.log_prefix + u'Failed ligands: {0}'.format(failed_ligands))
+            self.task.change_status(
+                status_msg=u'RuntimeError: {0} of {1} ligands failed ({2})'.format(len(errors), len(command_list),
+                                                                                   failed_ligands),
+                status_code=400)
+        else:
             self.logger.debug(self.log_prefix + 'Finished command list execution')
 
             self.task.change_status(status_msg='Tool execution successful',
                                     status_code=153)
 
+    def parse_ligand_result(self, ligand):
+        """
+        Best docking mode of a ligand from output/<ligand>/log.txt and vina_out.pdbqt
+        Only the first MODEL of vina_out.pdbqt is read from the cluster, with the log in one command
+        :return: unsaved VinaResult, None if the outputs could not be parsed
+        """
+        outpath = os.path.join(self.remote_task_dir, 'output', ligand)
+        # log and pose in a single exec, the separator cannot occur in either file
+        command = 'cat log.txt && echo {0} && sed -n "1,/^ENDMDL/p" vina_out.pdbqt'.format(POSE_SEPARATOR)
+        try:
+            output = self.shell.run(['sh', '-c', command], cwd=outpath).output
+        except (spur.RunProcessError, spur.ssh.ConnectionError):
+            self.logger.warning(self.log_prefix + u'Could not read results of {0}'.format(ligand), exc_info=True)
+            return None
+        log, _, pose = output.partition(POSE_SEPARATOR + '\n')
+
+        modes = parse_vina_log(log)
+        pose, best_mode = parse_vina_pose(pose)
+        best_mode = best_mode or (modes[0] if modes else None)
+        if best_mode is None:
+            self.logger.warning(self.log_prefix + u'No docking modes found for {0}'.format(ligand))
+            return None
+
+        affinity, rmsd_lb, rmsd_ub = best_mode
+        return VinaResult(task=self.task, ligand=ligand, affinity=affinity, rmsd_lb=rmsd_lb, rmsd_ub=rmsd_ub,
+                          mode_count=max(len(modes), 1), pose=pose)
+
     def run_tool(self, **kwargs):
         self.task.change_status(status_msg='Task started', status_code=150)
-        self.clear_or_create_dirs(task_remote_subdirs=json.loads(self.task.task_data).get('task_remote_subdirs', None))
-        self.handle_input_files()
-        self.run_commands()
-        self.handle_output_files()
+        self.run_phases(task_remote_subdirs=json.loads(self.task.task_data).get('task_remote_subdirs', None))
 
     def handle_output_files(self, **kwargs):
         self.task.change_status(status_msg='Retrieving output files', status_code=154 if not self.task.status_code >= 400 else self.task.status_code)
 
         self.logger.debug(self.log_prefix + 'Sending output files to server')
-        media_root = getattr(settings, "MEDIA_ROOT")
-
-        local_dir = u'{0:s}/output/'.format(self.task.task_dirname)
-        local_path = os.path.join(media_root, local_dir)  # absolute path for local dir
-
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-        sftp.get_channel().settimeout(180.0)  # set timeout to 3 mins
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
 
-        # For future use. zip > send to server > extract > attach as skylabfile (render_with_jsmol=True)
-        # Transfer via zip.
-        zip_filename = self.task.task_dirname + "-output.zip"
-        local_zip_filepath = os.path.join(media_root, "%s/output/%s" % (self.task.task_dirname, zip_filename))
-        remote_zip_filepath = os.path.join(self.remote_task_dir, zip_filename)
+        # stream /mirror/task_xx/output as an archive, attached as a skylabfile
+        self.retrieve_output_archive(self.task.task_dirname + "-output", ["output"], timeout=180.0)
 
-        self.shell.run(["zip", "-r", zip_filename, "output"], cwd=self.remote_task_dir)
-
-
-
-        while True:
-            try:
-                self.logger.debug(self.log_prefix + ' Retrieving ' + zip_filename)
-                sftp.get(remote_zip_filepath, local_zip_filepath)  # get remote zip
-                self.logger.debug(self.log_prefix + ' Received ' + zip_filename)
-                break
-            except (socket.timeout, EOFError):
-                self.logger.debug(self.log_prefix + ' Retrying for ' + zip_filename)
-
-        #sftp.remove(remote_zip_filepath) no need to delete since task dir will be deleted anyway
-        sftp.close()
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
-
-        # attach transferred file to database
-        new_file = SkyLabFile.objects.create(type=2, task=self.task)
-        new_file.file.name = os.path.join(os.path.join(self.task.task_dirname, 'output'),
-                                          zip_filename)
-        new_file.save()
-
-
-
-
-        self.shell.run(['rm', '-rf', self.remote_task_dir])  # Delete remote task directory
+        self.remove_remote_task_dir()
 
         if not self.task.status_code == 400:
             self.task.change_status(status_code=200, status_msg="Output files received. No errors encountered")
@@ -165,32 +148,19 @@ class VinaSplitExecutable(P2CToolGeneric):
         self.task.change_status(status_msg='Uploading input files', status_code=151)
         self.logger.debug(self.log_prefix + 'Uploading input files')
 
-        files = SkyLabFile.objects.filter(type=1, task=self.task)  # input files for this task
-        self.logger.debug(self.log_prefix + 'Opening SFTP client')
-        sftp = self.shell._open_sftp_client()  # open sftp client
-        self.logger.debug(self.log_prefix + 'Opened SFTP client')
-        sftp.get_channel().settimeout(180.0)
-        self.logger.debug(self.log_prefix + "Set timeout to {0}".format(sftp.get_channel().gettimeout()))
-        sftp.chdir(os.path.join(self.remote_task_dir, "output"))  # cd /mirror/task_xx
-        for f in files:
-            while True:
-                try:
-                    self.logger.debug(self.log_prefix + "Uploading " + f.filename)
-                    sftp.putfo(f.file, f.filename, callback=self.sftp_file_transfer_callback)  # copy file object to cluster as f.filename in the current dir
-                    self.logger.debug(self.log_prefix + "Uploaded " + f.filename)
-                    break
-                except (socket.timeout, EOFError):
-                    self.logger.debug(self.log_prefix + "Retrying for " + f.filename)
-                    time.sleep(2)
-        sftp.close()
-        self.logger.debug(self.log_prefix + 'Closed SFTP client')
+        # vina_split is executed in /mirror/task_xx/output
+        self.upload_input_files(remote_dir=os.path.join(self.remote_task_dir, "output"), timeout=180.0)
 
     def run_commands(self, **kwargs):
         self.task.change_status(status_msg="Executing tool script", status_code=152)
         command_list = json.loads(self.task.task_data)['command_list']  # load json array
 
         error = False
-        for command in command_list:  # todo: make vina_split view support dynamic formset
+        done_commands = self.get_done_commands()  # completed before the task was interrupted
+        for index, command in enumerate(command_list):  # todo: make vina_split view support dynamic formset
+            if index in done_commands:
+                self.logger.debug(self.log_prefix + u'Skipping completed command {0:s}'.format(command))
+                continue
             retries = 0
             exit_loop = False
 
@@ -204,6 +174,7 @@ class VinaSplitExecutable(P2CToolGeneric):
                     )
 
                     self.logger.debug(self.log_prefix + "Finished command exec")
+                    self.mark_command_done(index)
                     exit_loop = True  # exit loop
 
                 except spur.RunProcessError as err:
@@ -285,7 +256,7 @@ class VinaSplitExecutable(P2CToolGeneric):
         sftp.close()
         self.logger.debug(self.log_prefix + 'Closed SFTP client')
 
-        self.shell.run(['rm', '-rf', self.remote_task_dir])  # Delete remote task directory
+        self.remove_remote_task_dir()
 
         if not self.task.status_code == 400:
             self.task.change_status(status_code=200, status_msg="Output files received. No errors encountered")
@@ -296,7 +267,4 @@ class VinaSplitExecutable(P2CToolGeneric):
 
     def run_tool(self, **kwargs):  # the whole task process
         self.task.change_status(status_msg='Task started', status_code=150)
-        self.clear_or_create_dirs(task_remote_subdirs=['output'])
-        self.handle_input_files()  # upload input files to remote cluster
-        self.run_commands()  # execute tool commands
-        self.handle_output_files()  # retrieve output files from remote cluster
+        self.run_phases(task_remote_subdirs=['output'])  # resumes after the last completed phase
@@ -8,12 +8,18 @@ from multiupload.fields import MultiFileField
 
 from skylab.forms import MPIModelChoiceField, get_mpi_queryset_for_task_submission
 from skylab.models import MPICluster, ToolSet
+from skylab.sweeps import parse_parameter_grid, expand_parameter_grid
 from validators import pdbqt_file_extension_validator, multi_pdbqt_file_validator
 
 
 # for value type reference:  https://github.com/ryancoleman/autodock-vina/blob/master/src/main/main.cpp
 # see line 459 onwards
 
+# vina options that can be swept, values override the corresponding param_ field for each sweep point
+SWEEP_PARAMETERS = ['center_x', 'center_y', 'center_z', 'size_x', 'size_y', 'size_z', 'seed', 'exhaustiveness',
+                    'num_modes', 'energy_range']
+
+
 class VinaForm(forms.Form):
     # Input (receptor and ligand(s) are required)
     param_receptor = forms.FileField(validators=[pdbqt_file_extension_validator], label="Receptor file",
@@ -63,6 +69,11 @@ class VinaForm(forms.Form):
                                                 attrs={
                                                     'placeholder': '3.0'}))  # 1-3 default 3.0 float-value in cpp
 
+    param_sweep = forms.CharField(required=False, label="Parameter sweep",
+                                  help_text="Optional. Dock every ligand once per combination of values, one parameter per line.<br>"
+                                            "e.g. exhaustiveness=4,8 <br>Parameters: " + ', '.join(SWEEP_PARAMETERS),
+                                  widget=forms.Textarea(attrs={'rows': 3, 'placeholder': 'exhaustiveness=4,8'}))
+
     # # Advanced (removed since advanced parameters are not intended for actual use case)
     # param_score_only = forms.BooleanField(required=False, label="--score_only", help_text="Search space can be omitted")
     # param_local_only = forms.BooleanField(required=False, label="--local_only ", help_text="Do local search only    ")
@@ -127,6 +138,7 @@ class VinaForm(forms.Form):
                         Field('param_exhaustiveness', wrapper_class="col-xs-12 col-md-8"),
                         Field('param_num_modes', wrapper_class="col-xs-12 col-md-8"),
                         Field('param_energy_range', wrapper_class="col-xs-12 col-md-8"),
+                        Field('param_sweep', wrapper_class="col-xs-12 col-md-8"),
                         css_class='col-xs-12'
                     ),
 
@@ -174,6 +186,21 @@ class VinaForm(forms.Form):
             # )
         )
 
+    def clean_param_sweep(self):
+        # returns the sweep points, empty if no sweep
+        try:
+            grid = parse_parameter_grid(self.cleaned_data.get('param_sweep', ''), SWEEP_PARAMETERS)
+        except ValueError as err:
+            raise forms.ValidationError(str(err))
+
+        for name, values in grid.items():
+            for value in values:
+                try:
+                    float(value)
+                except ValueError:
+                    raise forms.ValidationError("Invalid value for {0} : {1}".format(name, value))
+        return expand_parameter_grid(grid)
+
     # def clean(self):
     #     if self.cleaned_data:
     #         if not self.cleaned_data['param_score_only']:
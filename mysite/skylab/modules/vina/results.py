@@ -0,0 +1,43 @@
+import re
+
+# -----+------------+----------+----------
+#    1         -7.2      0.000      0.000
+LOG_MODE_RE = re.compile(r'^\s*(\d+)\s+(-?\d+(?:\.\d+)?)\s+(\d+(?:\.\d+)?)\s+(\d+(?:\.\d+)?)\s*$')
+# REMARK VINA RESULT:      -7.2      0.000      0.000
+PDBQT_RESULT_RE = re.compile(r'^REMARK VINA RESULT:\s+(-?\d+(?:\.\d+)?)\s+(\d+(?:\.\d+)?)\s+(\d+(?:\.\d+)?)')
+
+
+def parse_vina_log(text):
+    """
+    Docking modes in the result table of a vina log.txt
+    :return: list of (affinity, rmsd_lb, rmsd_ub) ordered by mode
+    """
+    modes = []
+    in_table = False
+    for line in text.splitlines():
+        if line.startswith('-----+'):
+            in_table = True
+            continue
+        if in_table:
+            match = LOG_MODE_RE.match(line)
+            if not match:
+                break
+            modes.append((float(match.group(2)), float(match.group(3)), float(match.group(4))))
+    return modes
+
+
+def parse_vina_pose(text):
+    """
+    First MODEL of a vina_out.pdbqt, the best docking mode
+    :return: (pose, (affinity, rmsd_lb, rmsd_ub)) result is None if the remark is missing
+    """
+    lines = []
+    result = None
+    for line in text.splitlines():
+        lines.append(line)
+        match = PDBQT_RESULT_RE.match(line)
+        if match and result is None:
+            result = tuple(float(value) for value in match.groups())
+        if line.startswith('ENDMDL'):
+            break
+    return '\n'.join(lines), result
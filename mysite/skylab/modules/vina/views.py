@@ -1,12 +1,18 @@
 import json
 import os.path
+import re
+from collections import OrderedDict
 
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.urlresolvers import reverse
-from django.views.generic import FormView
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.generic import FormView, ListView
 
-from skylab.models import Task, SkyLabFile, Tool
-from skylab.modules.vina.forms import VinaForm, VinaSplitForm
+from skylab.models import Task, SkyLabFile, Tool, VinaResult
+from skylab.modules.vina.forms import SWEEP_PARAMETERS, VinaForm, VinaSplitForm
 from skylab.signals import send_to_queue
 
 
@@ -54,27 +60,12 @@ class VinaView(LoginRequiredMixin, FormView):
         # if form.cleaned_data['param_score_only']:  # search space not required
         #     exec_string_template += "--score_only "
         # else:  # search space required
-        center_x = form.cleaned_data['param_center_x']
-        center_y = form.cleaned_data['param_center_y']
-        center_z = form.cleaned_data['param_center_z']
-        size_x = form.cleaned_data['param_size_x']
-        size_y = form.cleaned_data['param_size_y']
-        size_z = form.cleaned_data['param_size_z']
-
-        exec_string_template += "--center_x {0} --center_y {1} --center_z {2} --size_x {3} --size_y {4} --size_z {5} ".format(
-            center_x, center_y, center_z, size_x, size_y, size_z)
-
-        if form.cleaned_data.get('param_seed'):
-            exec_string_template += "--seed {0} ".format(form.cleaned_data['param_seed'])
-
-        if form.cleaned_data.get('param_exhaustiveness'):
-            exec_string_template += "--exhaustiveness {0} ".format(form.cleaned_data['param_exhaustiveness'])
-
-        if form.cleaned_data.get('param_num_modes'):
-            exec_string_template += "--num_modes {0} ".format(form.cleaned_data['param_num_modes'])
-
-        if form.cleaned_data.get('param_energy_range'):
-            exec_string_template += "--energy_range {0} ".format(form.cleaned_data['param_energy_range'])
+        # search space and misc options, in the order of SWEEP_PARAMETERS
+        options = OrderedDict()
+        for name in SWEEP_PARAMETERS:
+            value = form.cleaned_data.get('param_' + name)
+            if value is not None:
+                options[name] = value
 
         # if form.cleaned_data['param_local_only']:
         #     exec_string_template += "--local_only "
@@ -103,25 +94,41 @@ class VinaView(LoginRequiredMixin, FormView):
         # if form.cleaned_data.get('param_weight_rot'):
         #     exec_string_template += "--weight_rot {0:s} ".format(form.cleaned_data['param_weight_rot'])
 
-        exec_string_template += "; "
-
-        # build commands
+        # build commands, one per ligand and sweep point
 
-        command_list = []
-        task_remote_subdirs = ['input', 'output']
+        ligand_files = []
         for f in form.cleaned_data['param_ligands']:
             instance = SkyLabFile.objects.create(type=1, upload_path='input/ligands', file=f, task=task)
-            filepath = instance.file.name
             # filepath = create_input_skylab_file(task, 'input/ligands', f)
-            filename_without_ext = os.path.splitext(f.name)[0]
-            task_remote_subdir = 'output/' + filename_without_ext
-
-            outpath = os.path.join(task.task_dirname, task_remote_subdir)
+            ligand_files.append((instance.file.name, os.path.splitext(f.name)[0]))
 
-            task_remote_subdirs.append(task_remote_subdir)
-            command_list.append(exec_string_template.format(outpath=outpath, filepath=filepath))
-
-        task.task_data = json.dumps({'command_list': command_list, 'task_remote_subdirs': task_remote_subdirs})
+        points = form.cleaned_data.get('param_sweep')  # empty if not a sweep
+        command_list = []
+        command_points = []
+        ligands = []
+        task_remote_subdirs = ['input', 'output']
+        for point_index, point in enumerate(points or [{}]):
+            point_options = options.copy()
+            point_options.update(point)  # swept values override the form values
+            point_template = exec_string_template + ''.join(
+                '--{0} {1} '.format(name, value) for name, value in point_options.items())
+
+            for filepath, filename_without_ext in ligand_files:
+                # output/<ligand> or output/point_<n>/<ligand> for sweeps
+                ligand = filename_without_ext if not points else 'point_{0}/{1}'.format(point_index, filename_without_ext)
+                task_remote_subdir = 'output/' + ligand
+
+                outpath = os.path.join(task.task_dirname, task_remote_subdir)
+
+                task_remote_subdirs.append(task_remote_subdir)
+                ligands.append(ligand)
+                command_points.append(point_index)
+                command_list.append(point_template.format(outpath=outpath, filepath=filepath))
+
+        task_data = {'command_list': command_list, 'ligands': ligands, 'task_remote_subdirs': task_remote_subdirs}
+        if points:
+            task_data['sweep'] = {'points': points, 'command_points': command_points}
+        task.task_data = json.dumps(task_data)
         task.save()
         send_to_queue(task=task)
         self.kwargs['task_id'] = task.id
@@ -177,3 +184,46 @@ class VinaSplitView(LoginRequiredMixin, FormView):
         send_to_queue(task=task)
 
         return super(VinaSplitView, self).form_valid(form)
+
+
+class VinaResultListView(LoginRequiredMixin, ListView):
+    # ranked docking results of a vina task, best binders (lowest affinity) first by default
+    template_name = "modules/vina/vina_results.html"
+    context_object_name = 'results'
+    paginate_by = settings.VINA_RESULTS_PAGE_SIZE
+    sort_fields = ['affinity', '-affinity', 'ligand', '-ligand', 'rmsd_lb', '-rmsd_lb', 'rmsd_ub', '-rmsd_ub']
+
+    def get_task(self):
+        tasks = Task.objects.all()
+        if not self.request.user.is_superuser:  # all tasks are visible to the admin
+            tasks = tasks.filter(user=self.request.user)
+        return get_object_or_404(tasks, pk=self.kwargs['pk'])
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort', 'affinity')
+        return sort if sort in self.sort_fields else 'affinity'
+
+    def get_queryset(self):
+        self.task = self.get_task()
+        # the pose is only needed when downloading a single result
+        return VinaResult.objects.filter(task=self.task).defer('pose').order_by(self.get_sort(), 'id')
+
+    def get_context_data(self, **kwargs):
+        context = super(VinaResultListView, self).get_context_data(**kwargs)
+        context['task'] = self.task
+        context['sort'] = self.get_sort()
+        return context
+
+
+@login_required
+def vina_result_pose(request, pk, result_pk):
+    # best pose of a single ligand as a pdbqt file
+    results = VinaResult.objects.filter(task_id=pk)
+    if not request.user.is_superuser:
+        results = results.filter(task__user=request.user)
+    result = get_object_or_404(results, pk=result_pk)
+    response = HttpResponse(result.pose, content_type='text/plain')
+    # ligands of sweeps are named point_N/ligand
+    response['Content-Disposition'] = 'attachment; filename="{0}_out.pdbqt"'.format(
+        re.sub(r'[^\w.-]', '_', result.ligand))
+    return response
@@ -3,7 +3,8 @@ import os
 from django.db.models.signals import post_delete, pre_save, post_save
 from django.dispatch import receiver, Signal
 
-from skylab.models import SkyLabFile, Task, TaskLog, ToolSet, ToolActivation, MPICluster
+from skylab.models import FileBlob, SkyLabFile, Task, TaskLog, ToolSet, ToolActivation, MPICluster, task_log_buffer, \
+    activation_cache
 
 # @receiver(post_save, sender=MPICluster)
 # def auto_delete_related_models_on_task_delete(sender, instance, **kwargs):
@@ -19,10 +20,24 @@ def auto_add_tool_activations_on_toolset_create(sender, instance, **kwargs):
             ToolActivation.objects.get_or_create(mpi_cluster=cluster, toolset=instance)
 post_save.connect(auto_add_tool_activations_on_toolset_create, sender=ToolSet, dispatch_uid="auto_add_tool_activations_on_toolset_create")
 
+def update_activation_cache_on_save(sender, instance, **kwargs):
+    """Keeps the in-process activation status current"""
+    activation_cache.update(instance)
+
+post_save.connect(update_activation_cache_on_save, sender=ToolActivation, dispatch_uid="update_activation_cache_on_save")
+
+
+def invalidate_activation_cache_on_delete(sender, instance, **kwargs):
+    activation_cache.invalidate(instance.mpi_cluster_id, instance.toolset_id)
+
+post_delete.connect(invalidate_activation_cache_on_delete, sender=ToolActivation,
+                    dispatch_uid="invalidate_activation_cache_on_delete")
+
 # @receiver(post_delete, sender=Task)
 def auto_delete_related_models_on_task_delete(sender, instance, **kwargs):
     """"Delete related models on task delete"""
     SkyLabFile.objects.filter(task=instance).delete()
+    task_log_buffer.discard(instance.id)
     TaskLog.objects.filter(task=instance).delete()
 
 post_delete.connect(auto_delete_related_models_on_task_delete, sender=Task, dispatch_uid="auto_delete_related_models_on_task_delete")
@@ -38,10 +53,20 @@ def auto_delete_file_on_delete(sender, instance, **kwargs):
     if instance.file:
         if os.path.isfile(instance.file.path):
             os.remove(instance.file.path)
+    if instance.blob_id:
+        FileBlob.release(instance.blob_id)
 
 post_delete.connect(auto_delete_file_on_delete, sender=SkyLabFile, dispatch_uid="auto_delete_file_on_delete")
 
 
+def auto_delete_blob_on_delete(sender, instance, **kwargs):
+    """Deletes the stored content of a `FileBlob` without references"""
+    if os.path.isfile(instance.path):
+        os.remove(instance.path)
+
+post_delete.connect(auto_delete_blob_on_delete, sender=FileBlob, dispatch_uid="auto_delete_blob_on_delete")
+
+
 #@receiver(pre_save, sender=SkyLabFile)
 def auto_delete_file_on_change(sender, instance, **kwargs):
     """Deletes file from filesystem
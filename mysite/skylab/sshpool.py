@@ -0,0 +1,176 @@
+import logging
+import socket
+import threading
+
+import spur
+from django.conf import settings
+from paramiko.ssh_exception import SSHException
+
+# errors raised by a dead or unreachable ssh connection
+CONNECTION_ERRORS = (spur.ssh.ConnectionError, SSHException, EOFError, socket.error)
+
+
+class PooledSFTPClient(object):
+    """
+    Proxy for a paramiko SFTPClient borrowed from a PooledSshShell
+    close() returns the sftp session to the shell's cache instead of closing its channel
+    """
+
+    def __init__(self, shell, sftp):
+        self._shell = shell
+        self._sftp = sftp
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._sftp, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._shell.release_sftp_client(self._sftp)
+
+
+class PooledSshShell(spur.SshShell):
+    """
+    spur.SshShell shared by several threads: commands and sftp sessions are multiplexed as channels
+    over a single ssh transport kept alive with keepalive packets
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.keepalive_interval = kwargs.pop('keepalive_interval', 0)
+        super(PooledSshShell, self).__init__(*args, **kwargs)
+        self.closed = False
+        self._connect_lock = threading.Lock()
+        self._keepalive_transport = None
+        self._sftp_lock = threading.Lock()
+        self._idle_sftp_clients = []
+
+    def _get_ssh_transport(self):
+        # spur connects on first use, concurrent first calls would each open a connection
+        with self._connect_lock:
+            transport = super(PooledSshShell, self)._get_ssh_transport()
+            if self.keepalive_interval and self._keepalive_transport is not transport:
+                transport.set_keepalive(self.keepalive_interval)
+                self._keepalive_transport = transport
+        return transport
+
+    def _open_sftp_client(self):
+        # reuse an idle sftp session instead of negotiating a new one
+        with self._sftp_lock:
+            while self._idle_sftp_clients:
+                sftp = self._idle_sftp_clients.pop()
+                if not sftp.get_channel().closed:
+                    return PooledSFTPClient(self, sftp)
+        return PooledSFTPClient(self, super(PooledSshShell, self)._open_sftp_client())
+
+    def release_sftp_client(self, sftp):
+        channel = sftp.get_channel()
+        if channel is None or channel.closed:
+            return
+
+        # sessions with unanswered requests (e.g. after a timeout) are not reusable
+        if not self.closed and not getattr(sftp, '_expecting', None):
+            channel.settimeout(None)
+            sftp.chdir(None)
+            with self._sftp_lock:
+                if len(self._idle_sftp_clients) < settings.SSH_SFTP_SESSION_CACHE_SIZE:
+                    self._idle_sftp_clients.append(sftp)
+                    return
+        sftp.close()
+
+    def connect(self):
+        # raises spur.ssh.ConnectionError if the host is unreachable
+        return self._get_ssh_transport()
+
+    def is_healthy(self):
+        if self.closed:
+            return False
+        try:
+            transport = self._get_ssh_transport()
+            if not transport.is_active():
+                return False
+            # from : http://stackoverflow.com/questions/28288533/check-if-paramiko-ssh-connection-is-still-alive
+            transport.send_ignore()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def close(self):
+        self.closed = True
+        with self._sftp_lock:
+            idle_sftp_clients, self._idle_sftp_clients = self._idle_sftp_clients, []
+        for sftp in idle_sftp_clients:
+            try:
+                sftp.close()
+            except CONNECTION_ERRORS:
+                pass
+        super(PooledSshShell, self).close()
+
+
+class SSHConnectionPool(object):
+    """
+    Connected shells keyed by (hostname, username, slot)
+    Each host has at most settings.SSH_CONNECTIONS_PER_HOST connections, callers with the same slot share one
+    """
+
+    def __init__(self):
+        self._shells = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _get_key(self, hostname, username, slot):
+        return hostname, username, slot % max(1, settings.SSH_CONNECTIONS_PER_HOST)
+
+    def _get_or_create_shell(self, key, password):
+        with self._lock:
+            shell = self._shells.get(key)
+            if shell is None or shell.closed:
+                hostname, username, slot = key
+                shell = PooledSshShell(hostname=hostname, username=username, password=password,
+                                       missing_host_key=spur.ssh.MissingHostKey.accept,
+                                       keepalive_interval=settings.SSH_KEEPALIVE_INTERVAL)
+                self._shells[key] = shell
+            return shell
+
+    def get_shell(self, hostname, username, password, slot=0):
+        """
+        Returns a connected shell, replacing the pooled one if its connection is dead
+        Raises spur.ssh.ConnectionError if the host is unreachable
+        """
+        key = self._get_key(hostname, username, slot)
+        shell = self._get_or_create_shell(key, password)
+        if not shell.is_healthy():
+            self.logger.debug('Reconnecting to {1}@{0} [slot {2}]'.format(*key))
+            self.discard(shell)
+            shell = self._get_or_create_shell(key, password)
+            shell.connect()
+        return shell
+
+    def discard(self, shell):
+        # close a shell whose connection dropped, the next get_shell opens a new connection
+        with self._lock:
+            for key, pooled_shell in self._shells.items():
+                if pooled_shell is shell:
+                    del self._shells[key]
+        try:
+            shell.close()
+        except CONNECTION_ERRORS:
+            pass
+
+    def get_host_shells(self, hostname):
+        with self._lock:
+            return [shell for key, shell in self._shells.items() if key[0] == hostname]
+
+    def close_host(self, hostname):
+        # close every connection to a host, e.g. after its cluster is deleted
+        for shell in self.get_host_shells(hostname):
+            self.discard(shell)
+
+
+ssh_pool = SSHConnectionPool()
@@ -0,0 +1,48 @@
+import itertools
+import re
+from collections import OrderedDict
+
+from django.conf import settings
+
+PARAMETER_LINE_RE = re.compile(r'^\s*([a-z_][a-z0-9_]*)\s*=\s*(.+?)\s*$')
+
+
+def parse_parameter_grid(text, allowed_parameters):
+    """
+    Parses a parameter grid, one 'name=value1,value2,...' per line, e.g. exhaustiveness=4,8
+    :raises ValueError: if a line is malformed, a parameter is not allowed or is given twice, or the grid is too large
+    :return: OrderedDict of parameter name: list of values (strings)
+    """
+    grid = OrderedDict()
+    for line in re.split(r'[\n;]', text):
+        if not line.strip():
+            continue
+        match = PARAMETER_LINE_RE.match(line)
+        if not match:
+            raise ValueError('Invalid line "{0}", expected name=value1,value2,...'.format(line.strip()))
+
+        name, values = match.group(1), [value.strip() for value in match.group(2).split(',') if value.strip()]
+        if name not in allowed_parameters:
+            raise ValueError('{0} cannot be swept. Choose from {1}'.format(name, ', '.join(allowed_parameters)))
+        if name in grid:
+            raise ValueError('{0} is given more than once'.format(name))
+        if not values:
+            raise ValueError('No values given for {0}'.format(name))
+        grid[name] = values
+
+    point_count = 1
+    for values in grid.values():
+        point_count *= len(values)
+    if point_count > settings.MAX_SWEEP_POINTS:
+        raise ValueError('The sweep has {0} points, the max is {1}'.format(point_count, settings.MAX_SWEEP_POINTS))
+    return grid
+
+
+def expand_parameter_grid(grid):
+    """
+    Every combination of values of a grid
+    :return: list of points, each an OrderedDict of parameter name: value
+    """
+    if not grid:
+        return []
+    return [OrderedDict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
@@ -1 +1,333 @@
-# Create your tests here.
+import Queue
+import logging
+import threading
+from datetime import timedelta
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from skylab.bootskylab import MPIThread
+from skylab.events import StatusEventBus
+from skylab.jobs import TaskJob, DeleteClusterJob, ShrinkClusterJob, StopConsumerJob
+from skylab.models import ClusterCapacity, MPICluster
+from skylab.modules.vina.results import parse_vina_log, parse_vina_pose
+from skylab.sweeps import expand_parameter_grid, parse_parameter_grid
+from skylab.views import get_cursor_page
+
+
+class FakeTool(object):
+    def __init__(self, toolset_id):
+        self.toolset_id = toolset_id
+
+
+class FakeTask(object):
+    def __init__(self, task_id, priority=3, toolset_id=1):
+        self.id = task_id
+        self.priority = priority
+        self.tool = FakeTool(toolset_id)
+
+
+class FakeCluster(object):
+    id = 1
+    cluster_name = 'cluster'
+
+
+class FakeConsumer(object):
+    def __init__(self, mpi_thread):
+        self.mpi_thread = mpi_thread
+        self.logger = logging.getLogger(__name__)
+        self.log_prefix = ''
+        self.processed = []
+
+    def process_task(self, task):
+        self.processed.append(task.id)
+
+    def run_next_job(self):
+        job = self.mpi_thread.task_queue.get(block=False)
+        try:
+            job.execute(self)
+        finally:
+            self.mpi_thread.job_done()
+
+
+class MPIJobOrderTest(SimpleTestCase):
+    def get_processing_order(self, jobs):
+        queue = Queue.PriorityQueue()
+        for job in jobs:
+            queue.put(job)
+        return [queue.get() for _ in jobs]
+
+    def test_stop_consumer_before_tasks(self):
+        task_job = TaskJob(FakeTask(1, priority=1))
+        stop_job = StopConsumerJob()
+        self.assertEqual(self.get_processing_order([task_job, stop_job]), [stop_job, task_job])
+
+    def test_tasks_by_priority_then_sequence(self):
+        normal_first = TaskJob(FakeTask(1))
+        normal_second = TaskJob(FakeTask(2))
+        high = TaskJob(FakeTask(3, priority=2))
+        self.assertEqual(self.get_processing_order([normal_first, normal_second, high]),
+                         [high, normal_first, normal_second])
+
+    def test_shrink_and_delete_after_tasks(self):
+        delete_job = DeleteClusterJob()
+        shrink_job = ShrinkClusterJob(2)
+        requeued_task = TaskJob(FakeTask(1, priority=100))  # priority lowered by requeues
+        self.assertEqual(self.get_processing_order([delete_job, shrink_job, requeued_task]),
+                         [requeued_task, shrink_job, delete_job])
+
+
+
+class MPIThreadDeletionTest(SimpleTestCase):
+    def setUp(self):
+        self.mpi_thread = MPIThread(FakeCluster(), None)
+        self.events = []
+        self.mpi_thread.stop = lambda: self.events.append('stop')  # no consumers or cluster to stop
+        self.mpi_thread.delete_mpi_cluster = lambda: self.events.append('delete')
+        self.consumer = FakeConsumer(self.mpi_thread)
+
+    def test_parked_task_runs_before_deletion(self):
+        self.mpi_thread.add_toolset_activation_to_queue(1)
+        self.mpi_thread.add_job_to_queue(TaskJob(FakeTask(1, toolset_id=1)))
+        self.consumer.run_next_job()  # parked until toolset 1 is activated
+        self.assertEqual(self.consumer.processed, [])
+
+        self.mpi_thread.add_deletion_to_queue()
+        threading.Timer(0.1, self.mpi_thread.activation_done, args=[1]).start()
+        self.consumer.run_next_job()  # waits for the activation, then gives way to the requeued task
+        self.assertEqual(self.events, [])
+
+        self.consumer.run_next_job()
+        self.assertEqual(self.consumer.processed, [1])
+        self.consumer.run_next_job()
+        self.assertEqual(self.events, ['stop', 'delete'])
+        self.assertTrue(self.mpi_thread.task_queue.empty())
+
+    def test_deletion_without_parked_tasks(self):
+        self.mpi_thread.add_deletion_to_queue()
+        self.consumer.run_next_job()
+        self.assertEqual(self.events, ['stop', 'delete'])
+
+
+@override_settings(STATUS_EVENTS_BUFFER_SIZE=3)
+class StatusEventBusTest(SimpleTestCase):
+    def setUp(self):
+        self.bus = StatusEventBus()
+
+    def publish(self, count):
+        for i in range(count):
+            self.bus.publish({'type': 'task', 'id': i})
+
+    def test_events_after_cursor(self):
+        self.publish(2)
+        events, cursor, reset = self.bus.get_events(1, 0)
+        self.assertEqual([event['cursor'] for event in events], [2])
+        self.assertEqual(cursor, 2)
+        self.assertFalse(reset)
+
+    def test_no_events_before_timeout(self):
+        self.publish(1)
+        self.assertEqual(self.bus.get_events(1, 0), ([], 1, False))
+
+    def test_evicted_events_reset(self):
+        self.publish(5)
+        events, cursor, reset = self.bus.get_events(0, 0)
+        self.assertEqual([event['cursor'] for event in events], [3, 4, 5])
+        self.assertEqual(cursor, 5)
+        self.assertTrue(reset)
+
+    def test_cursor_at_buffer_start_does_not_reset(self):
+        self.publish(5)
+        events, cursor, reset = self.bus.get_events(2, 0)
+        self.assertEqual([event['cursor'] for event in events], [3, 4, 5])
+        self.assertFalse(reset)
+
+    def test_cursor_from_before_restart_resets(self):
+        self.publish(2)
+        self.assertEqual(self.bus.get_events(10, 0), ([], 2, True))
+
+
+@override_settings(AJAX_TABLE_PAGE_SIZE=2)
+class CursorPageTest(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        created = [now, now + timedelta(seconds=1), now + timedelta(seconds=1), now + timedelta(seconds=1),
+                   now + timedelta(seconds=2)]
+        self.clusters = []
+        for i, timestamp in enumerate(created):
+            cluster = MPICluster.objects.create(cluster_name='cluster_{0}'.format(i))
+            MPICluster.objects.filter(pk=cluster.pk).update(created=timestamp)  # save() sets created
+            self.clusters.append(cluster.pk)
+
+    def get_all_pages(self):
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = get_cursor_page(MPICluster.objects.all(), cursor, 'created')
+            pages.append([cluster.pk for cluster in page])
+            if cursor is None:
+                return pages
+
+    def test_pages_newest_first_with_ties_by_id(self):
+        c = self.clusters
+        self.assertEqual(self.get_all_pages(), [[c[4], c[3]], [c[2], c[1]], [c[0]]])
+
+    def test_last_page_has_no_cursor(self):
+        MPICluster.objects.filter(pk__in=self.clusters[:3]).delete()
+        page, cursor = get_cursor_page(MPICluster.objects.all(), None, 'created')
+        self.assertEqual(len(page), 2)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor_returns_first_page(self):
+        first_page, _ = get_cursor_page(MPICluster.objects.all(), None, 'created')
+        page, _ = get_cursor_page(MPICluster.objects.all(), 'invalid', 'created')
+        self.assertEqual(page, first_page)
+
+
+@override_settings(MAX_TOTAL_INSTANCES=5)
+class ClusterCapacityTest(TestCase):
+    def get_allocated_nodes(self):
+        return ClusterCapacity.get_ledger().allocated_nodes
+
+    def test_reserve_within_limit(self):
+        self.assertTrue(ClusterCapacity.reserve(3))
+        self.assertTrue(ClusterCapacity.reserve(2))
+        self.assertEqual(self.get_allocated_nodes(), 5)
+        self.assertEqual(ClusterCapacity.available_nodes(), 0)
+
+    def test_over_reservation_is_refused(self):
+        self.assertTrue(ClusterCapacity.reserve(3))
+        self.assertFalse(ClusterCapacity.reserve(3))
+        self.assertEqual(self.get_allocated_nodes(), 3)
+
+    def test_release_never_goes_below_zero(self):
+        ClusterCapacity.reserve(2)
+        ClusterCapacity.release(3)
+        self.assertEqual(self.get_allocated_nodes(), 2)
+
+    def test_ledger_counts_existing_clusters(self):
+        MPICluster.objects.create(cluster_name='existing', cluster_size=2)
+        MPICluster.objects.create(cluster_name='deleted', cluster_size=2, status=5)
+        self.assertEqual(self.get_allocated_nodes(), 3)
+
+    def test_deleted_cluster_releases_once(self):
+        cluster = MPICluster.objects.create(cluster_name='cluster', cluster_size=1, status=2)
+        self.assertEqual(self.get_allocated_nodes(), 2)
+        cluster.change_status(5)
+        self.assertEqual(self.get_allocated_nodes(), 0)
+        ClusterCapacity.reserve(2)  # nodes of another cluster
+        cluster.change_status(5)
+        self.assertEqual(self.get_allocated_nodes(), 2)
+
+
+VINA_LOG = """#################################################################
+# If you used AutoDock Vina in your work, please cite:          #
+#################################################################
+
+Detected 4 CPUs
+Reading input ... done.
+Setting up the scoring function ... done.
+Analyzing the binding site ... done.
+Using random seed: 1553453376
+Performing search ... done.
+Refining results ... done.
+
+mode |   affinity | dist from best mode
+     | (kcal/mol) | rmsd l.b.| rmsd u.b.
+-----+------------+----------+----------
+   1         -7.2      0.000      0.000
+   2         -6.9      1.921      2.664
+   3         -6.5      2.212      7.103
+Writing output ... done.
+"""
+
+VINA_POSE = """MODEL 1
+REMARK VINA RESULT:      -7.2      0.000      0.000
+REMARK  2 active torsions:
+ROOT
+ATOM      1  C   LIG A   1      -1.297   2.114   0.341  0.00  0.00    +0.000 C
+ENDROOT
+TORSDOF 2
+ENDMDL
+MODEL 2
+REMARK VINA RESULT:      -6.9      1.921      2.664
+ROOT
+ATOM      1  C   LIG A   1      -0.112   1.873   0.902  0.00  0.00    +0.000 C
+ENDROOT
+TORSDOF 2
+ENDMDL
+"""
+
+
+class VinaResultsParserTest(SimpleTestCase):
+    def test_log_modes(self):
+        self.assertEqual(parse_vina_log(VINA_LOG), [(-7.2, 0.0, 0.0), (-6.9, 1.921, 2.664), (-6.5, 2.212, 7.103)])
+
+    def test_empty_log(self):
+        self.assertEqual(parse_vina_log(''), [])
+
+    def test_truncated_log(self):
+        truncated = VINA_LOG[:VINA_LOG.index('   2 ')] + '   2         -6'
+        self.assertEqual(parse_vina_log(truncated), [(-7.2, 0.0, 0.0)])
+
+    def test_log_without_results(self):
+        self.assertEqual(parse_vina_log(VINA_LOG[:VINA_LOG.index('mode |')]), [])
+
+    def test_first_model_of_pose(self):
+        pose, result = parse_vina_pose(VINA_POSE)
+        self.assertEqual(result, (-7.2, 0.0, 0.0))
+        self.assertTrue(pose.startswith('MODEL 1'))
+        self.assertTrue(pose.endswith('ENDMDL'))
+        self.assertNotIn('MODEL 2', pose)
+
+    def test_pose_without_remark(self):
+        pose, result = parse_vina_pose('MODEL 1\nENDMDL\n')
+        self.assertIsNone(result)
+        self.assertEqual(pose, 'MODEL 1\nENDMDL')
+
+    def test_empty_pose(self):
+        self.assertEqual(parse_vina_pose(''), ('', None))
+
+
+@override_settings(MAX_SWEEP_POINTS=6)
+class ParameterGridTest(SimpleTestCase):
+    allowed = ['exhaustiveness', 'num_modes', 'energy_range']
+
+    def test_parse_grid(self):
+        grid = parse_parameter_grid('exhaustiveness = 4, 8\n\nnum_modes=9;energy_range=3', self.allowed)
+        self.assertEqual(list(grid.items()), [('exhaustiveness', ['4', '8']), ('num_modes', ['9']),
+                                              ('energy_range', ['3'])])
+
+    def test_expand_grid(self):
+        grid = parse_parameter_grid('exhaustiveness=4,8\nnum_modes=9,20', self.allowed)
+        points = [list(point.items()) for point in expand_parameter_grid(grid)]
+        self.assertEqual(points, [
+            [('exhaustiveness', '4'), ('num_modes', '9')],
+            [('exhaustiveness', '4'), ('num_modes', '20')],
+            [('exhaustiveness', '8'), ('num_modes', '9')],
+            [('exhaustiveness', '8'), ('num_modes', '20')],
+        ])
+
+    def test_expand_empty_grid(self):
+        self.assertEqual(expand_parameter_grid(parse_parameter_grid('', self.allowed)), [])
+
+    def test_malformed_line(self):
+        with self.assertRaisesRegexp(ValueError, 'Invalid line'):
+            parse_parameter_grid('exhaustiveness 4,8', self.allowed)
+
+    def test_missing_values(self):
+        with self.assertRaisesRegexp(ValueError, 'No values'):
+            parse_parameter_grid('exhaustiveness=,', self.allowed)
+
+    def test_unknown_parameter(self):
+        with self.assertRaisesRegexp(ValueError, 'cannot be swept'):
+            parse_parameter_grid('seed=1,2', self.allowed)
+
+    def test_duplicate_parameter(self):
+        with self.assertRaisesRegexp(ValueError, 'more than once'):
+            parse_parameter_grid('num_modes=9\nnum_modes=20', self.allowed)
+
+    def test_max_sweep_points(self):
+        parse_parameter_grid('exhaustiveness=4,8\nnum_modes=1,2,3', self.allowed)  # 6 points
+        with self.assertRaisesRegexp(ValueError, 'has 8 points, the max is 6'):
+            parse_parameter_grid('exhaustiveness=4,8\nnum_modes=1,2,3,4', self.allowed)
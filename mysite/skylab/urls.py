@@ -2,6 +2,7 @@ from django.conf.urls import include, url
 from django.views.generic import RedirectView
 
 from . import views
+from .modules.vina.views import VinaResultListView, vina_result_pose
 
 urlpatterns = [
 
@@ -11,6 +12,8 @@ urlpatterns = [
     url(r'^mpi-clusters/(?P<cluster_name>\w+)$', views.MPIDetailView.as_view(), name='mpi_detail_view'),
     url(r'^tasks$', views.TaskListView.as_view(), name='task_list_view'),
     url(r'^tasks/(?P<pk>\d+)$', views.TaskDetailView.as_view(), name='task_detail_view'),
+    url(r'^tasks/(?P<pk>\d+)/vina-results$', VinaResultListView.as_view(), name='vina_results_view'),
+    url(r'^tasks/(?P<pk>\d+)/vina-results/(?P<result_pk>\d+)\.pdbqt$', vina_result_pose, name='vina_result_pose'),
     url(r'^toolsets$', views.ToolsetListView.as_view(), name='toolset_list_view'),
     url(r'^toolsets/(?P<toolset_simple_name>[a-z0-9]+)$', views.ToolSetDetailView.as_view(),
         name='toolset_detail_view'),
@@ -24,6 +27,7 @@ urlpatterns = [
     url(r'^ajax/task-detail-fragments/(?P<pk>\d+)$', views.refresh_task_detail_view,
         name='ajax_refresh_task_detail_view'),
     url(r'^ajax/nav-task-list-fragments$', views.refresh_nav_task_list, name='ajax_refresh_nav_task_list'),
+    url(r'^ajax/status-events$', views.poll_status_events, name='ajax_poll_status_events'),
     url(r'^ajax/mpi-privacy$', views.post_mpi_visibility, name='ajax_post_mpi_privacy_change'),
     url(r'^ajax/post-mpi-delete$', views.post_mpi_delete, name='ajax_post_mpi_delete'),
     url(r'^ajax/post-mpi-toolset-activate$', views.post_mpi_toolset_activate, name='ajax_post_mpi_toolset_activate'),
@@ -1,7 +1,8 @@
 from django.conf import settings
 from django.forms import ValidationError
 
-from skylab.models import MPICluster
+from skylab.models import MPICluster, ClusterCapacity
+from skylab.warmpool import warm_pool
 
 # use to validate form inputs
 
@@ -13,7 +14,7 @@ def cluster_name_unique_validator(cluster_name):
 
 def cluster_size_validator(value):
     current_max = get_current_max_nodes()
-    if value > current_max:
+    if value > current_max and not warm_pool.has_claimable(value):  # warm clusters already hold their nodes
         if current_max > 1:
             raise ValidationError(u'Can only create max of {0} nodes'.format(current_max),
                                   code="cluster_size_above_limit")
@@ -23,9 +24,5 @@ def cluster_size_validator(value):
 
 
 def get_current_max_nodes():
-    online_clusters = MPICluster.objects.exclude(status=5)
-    current_instance_count = 0
-    for c in online_clusters:
-        current_instance_count += c.total_node_count
-
-    return min(settings.MAX_NODES_PER_CLUSTER, settings.MAX_TOTAL_INSTANCES - current_instance_count)
+    # single row read, nodes of clusters that are not deleted are kept in the capacity ledger
+    return min(settings.MAX_NODES_PER_CLUSTER, ClusterCapacity.available_nodes())
@@ -1,6 +1,7 @@
 import importlib
 import os
 import json
+import threading
 
 from django.conf import settings
 from django.contrib import messages
@@ -8,10 +9,11 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
-from django.db.models import Q
+from django.db.models import Count, Q
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.http import Http404
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
 from django.views.generic import DetailView, ListView, View
 from django.views.generic.base import TemplateView
@@ -20,8 +22,10 @@ from django_ajax.decorators import ajax
 from sendfile import sendfile
 
 from forms import CreateMPIForm
-from skylab.models import Task, MPICluster, ToolActivation, SkyLabFile, ToolSet, Tool
+from skylab.events import status_events
+from skylab.models import Task, MPICluster, ToolActivation, SkyLabFile, ToolSet, Tool, ClusterCapacity
 from skylab.validators import get_current_max_nodes
+from skylab.warmpool import warm_pool
 
 
 def has_read_permission(request, task_id):
@@ -103,11 +107,32 @@ class CreateMPIView(LoginRequiredMixin, FormView):
         return self.render_to_response(self.get_context_data())
 
     def form_valid(self, form):
-
-        mpi_cluster = MPICluster.objects.create(creator=self.request.user,
-                                                cluster_name=form.cleaned_data['cluster_name'],
-                                                cluster_size=form.cleaned_data['cluster_size'] - 1,
-                                                is_public=form.cleaned_data['is_public'])
+        # a warm cluster is already booted with its nodes reserved
+        mpi_cluster = warm_pool.claim(form.cleaned_data['cluster_size'], creator=self.request.user,
+                                      cluster_name=form.cleaned_data['cluster_name'],
+                                      is_public=form.cleaned_data['is_public'],
+                                      autoscale=form.cleaned_data.get('autoscale', False),
+                                      min_cluster_size=form.cleaned_data['cluster_size'] - 1,
+                                      idle_ttl=form.cleaned_data['idle_ttl'], last_activity=timezone.now())
+        if mpi_cluster is not None:
+            warm_pool.refill_async()
+        else:
+            # cluster_size_validator only reads the ledger, the reservation fails if a concurrent create took the nodes
+            if not ClusterCapacity.reserve(form.cleaned_data['cluster_size']):
+                form.add_error('cluster_size', 'Can only create max of {0} nodes'.format(get_current_max_nodes()))
+                return self.form_invalid(form)
+
+            try:
+                mpi_cluster = MPICluster.objects.create(creator=self.request.user,
+                                                        cluster_name=form.cleaned_data['cluster_name'],
+                                                        cluster_size=form.cleaned_data['cluster_size'] - 1,
+                                                        is_public=form.cleaned_data['is_public'],
+                                                        autoscale=form.cleaned_data.get('autoscale', False),
+                                                        min_cluster_size=form.cleaned_data['cluster_size'] - 1,
+                                                        idle_ttl=form.cleaned_data['idle_ttl'])
+            except Exception:
+                ClusterCapacity.release(form.cleaned_data['cluster_size'])
+                raise
         self.kwargs['pk'] = mpi_cluster.id
 
         mpi_cluster.allowed_users.add(self.request.user)
@@ -134,7 +159,7 @@ class ToolsetListView(LoginRequiredMixin, ListView):
 
 
 class MPIListView(LoginRequiredMixin, ListView):
-    queryset = MPICluster.objects.exclude(status=5)
+    queryset = MPICluster.objects.exclude(status=5).exclude(is_warm_pool=True)  # warm clusters are listed in admin
     template_name = 'layouts/mpi_list_view.html'
     context_object_name = 'mpi_clusters'
     paginate_by = 5
@@ -313,13 +338,76 @@ def refresh_mpi_detail_view(request, pk):
         return {'error':'MPI cluster with pk={0} does not exist'.format(pk)}
 
 
+def get_cursor_page(qs, cursor, field):
+    """
+    Keyset pagination, constant time regardless of the table size unlike OFFSET
+    :param qs: queryset, ordered here by field then id, newest first
+    :param cursor: next_cursor of the previous page, None for the first page
+    :param field: datetime field
+    :return: (list of instances, next_cursor or None for the last page)
+    """
+    page_size = settings.AJAX_TABLE_PAGE_SIZE
+    qs = qs.order_by('-' + field, '-id')
+    if cursor:
+        try:
+            value, pk = cursor.rsplit('|', 1)
+            value = parse_datetime(value)
+            if value is not None:
+                qs = qs.filter(Q(**{field + '__lt': value}) | Q(**{field: value, 'id__lt': int(pk)}))
+        except ValueError:  # invalid cursor, return first page
+            pass
+
+    page = list(qs[:page_size + 1])
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = '{0}|{1}'.format(getattr(page[-1], field).isoformat(), page[-1].id)
+    return page, next_cursor
+
+
+def get_visible_mpi_clusters(user):
+    # unclaimed warm clusters are only listed in admin
+    if user.is_superuser:  # all clusters are visible to the admin
+        return MPICluster.objects.exclude(is_warm_pool=True)
+    # filter all visible clusters that are not deleted
+    # subquery instead of a join on allowed_users, which would duplicate public clusters
+    user_allowed = Q(id__in=MPICluster.objects.filter(allowed_users=user).values('id'))
+    cluster_is_public = Q(is_public=True)
+    return MPICluster.objects.filter(user_allowed | cluster_is_public).exclude(status=5).exclude(is_warm_pool=True)
+
+
+def get_mpi_list_rows(clusters):
+    # queued task count of every cluster in a single aggregate query instead of one count per cluster
+    task_queued_counts = dict(
+        Task.objects.filter(mpi_cluster__in=[cluster.id for cluster in clusters]).exclude(
+            status_code__in=[200, 401]).values_list('mpi_cluster').annotate(Count('id')))
+
+    rows = []
+    for cluster in clusters:  # build array of arrays containing info for each cluster
+        rows.append([
+            # cluster.id,
+            cluster.cluster_name,
+            cluster.total_node_count,
+            cluster.cluster_ip,
+            task_queued_counts.get(cluster.id, 0),
+            cluster.current_simple_status_msg + ' (Scheduled for deletion)' if cluster.queued_for_deletion and cluster.status != 5 else cluster.current_simple_status_msg,
+            'Public' if cluster.is_public else 'Private',
+
+            timezone.localtime(cluster.created).strftime('%x %I:%M %p'),
+        ])
+    return rows
+
+
 @login_required
 @ajax
 def refresh_task_list_table(request):
     if request.user.is_superuser:
-        tasks = Task.objects.all().order_by('-updated')
+        tasks = Task.objects.all()
     else:
-        tasks = Task.objects.filter(user=request.user).order_by('-updated')
+        tasks = Task.objects.filter(user=request.user)
+    tasks = tasks.select_related('tool', 'mpi_cluster')
+    tasks, next_cursor = get_cursor_page(tasks, request.GET.get('cursor'), 'updated')
+
     rows = []
     for task in tasks:  # build array of arrays containing info for each cluster
         rows.append([
@@ -330,39 +418,67 @@ def refresh_task_list_table(request):
             timezone.localtime(task.created).strftime('%x %I:%M %p'),
             timezone.localtime(task.updated).strftime('%x %I:%M %p')
         ])
-    return {'rows': rows}
+    return {'rows': rows, 'next_cursor': next_cursor}
 
 
 @login_required
 @ajax
 def refresh_mpi_list_table(request):
-    if request.user.is_superuser:   #all clusters are visible to the admin
-        qs = MPICluster.objects.all()
-    else:
-        user_allowed = Q(allowed_users=request.user)  # filter all visible clusters that are not deleted
-        cluster_is_public = Q(is_public=True)
-        qs = MPICluster.objects.filter(user_allowed | cluster_is_public)
-        qs = qs.exclude(status=5)
+    clusters, next_cursor = get_cursor_page(get_visible_mpi_clusters(request.user), request.GET.get('cursor'),
+                                            'created')
+    return {'rows': get_mpi_list_rows(clusters), 'next_cursor': next_cursor}
 
-    rows = []
-    for cluster in qs:  # build array of arrays containing info for each cluster
-        rows.append([
-            # cluster.id,
-            cluster.cluster_name,
-            cluster.total_node_count,
-            cluster.cluster_ip,
-            cluster.task_queued_count,
-            cluster.current_simple_status_msg + ' (Scheduled for deletion)' if cluster.queued_for_deletion and cluster.status != 5 else cluster.current_simple_status_msg,
-            'Public' if cluster.is_public else 'Private',
 
-            timezone.localtime(cluster.created).strftime('%x %I:%M %p'),
-        ])
 
-    return {'rows':rows}
 
 
+# each held long-poll ties up a wsgi thread (mod_wsgi daemons default to 15 threads per process)
+long_poll_slots = threading.BoundedSemaphore(settings.STATUS_EVENTS_MAX_LONG_POLLS)
 
 
+@login_required
+def poll_status_events(request):
+    """
+    Long-poll endpoint for task and mpi cluster status changes visible to the user
+    Returns the events after ?cursor= as soon as there is one, or an empty list after STATUS_EVENTS_POLL_TIMEOUT
+    Without a cursor, returns the current cursor immediately
+    Once STATUS_EVENTS_MAX_LONG_POLLS requests are held open, returns at once with retry_after (in seconds)
+    so the client falls back to short polling
+    """
+    try:
+        cursor = int(request.GET['cursor'])
+    except (KeyError, ValueError):
+        return JsonResponse({'events': [], 'cursor': status_events.cursor, 'reset': False, 'retry_after': 0})
+
+    if long_poll_slots.acquire(False):
+        try:
+            events, cursor, reset = status_events.get_events(cursor, settings.STATUS_EVENTS_POLL_TIMEOUT)
+        finally:
+            long_poll_slots.release()
+        retry_after = 0
+    else:
+        events, cursor, reset = status_events.get_events(cursor, 0)
+        retry_after = settings.STATUS_EVENTS_SHORT_POLL_INTERVAL
+
+    if not request.user.is_superuser:
+        visible_events = []
+        allowed_cluster_ids = None
+        for event in events:
+            if event['type'] == 'task':
+                if event['user_id'] == request.user.id:
+                    visible_events.append(event)
+            elif event['is_public']:
+                visible_events.append(event)
+            else:
+                if allowed_cluster_ids is None:  # queried only if needed
+                    allowed_cluster_ids = set(
+                        MPICluster.objects.filter(allowed_users=request.user).values_list('id', flat=True))
+                if event['id'] in allowed_cluster_ids:
+                    visible_events.append(event)
+        events = visible_events
+
+    return JsonResponse({'events': events, 'cursor': cursor, 'reset': reset, 'retry_after': retry_after})
+
 
 @login_required
 @ajax
@@ -432,24 +548,8 @@ def post_allow_user_access_to_mpi(request):
             cluster = MPICluster.objects.get(share_key=share_key)  # give user access to cluster
             cluster.allowed_users.add(request.user)
             data['cluster_name'] = cluster.cluster_name
-            user_allowed = Q(allowed_users=request.user)  # filter all visible clusters that are not deleted
-            cluster_is_public = Q(is_public=True)
-            qs = MPICluster.objects.filter(user_allowed | cluster_is_public)
-            qs = qs.exclude(status=5)
-
-            rows = []
-            for cluster in qs:  # build array of arrays containing info for each cluster
-                rows.append([
-                    # cluster.id,
-                    cluster.cluster_name,
-                    cluster.total_node_count,
-                    cluster.cluster_ip,
-                    cluster.task_queued_count,
-                    cluster.current_simple_status_msg + ' (Scheduled for deletion)' if cluster.queued_for_deletion and cluster.status != 5 else cluster.current_simple_status_msg,
-                    'Public' if cluster.is_public else 'Private',
-                    timezone.localtime(cluster.created).strftime('%x %I:%M %p'),
-                ])
-            data['rows'] = rows
+            clusters, data['next_cursor'] = get_cursor_page(get_visible_mpi_clusters(request.user), None, 'created')
+            data['rows'] = get_mpi_list_rows(clusters)
 
         except MPICluster.DoesNotExist:
             error = True
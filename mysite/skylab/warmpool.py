@@ -0,0 +1,88 @@
+import logging
+import string
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from skylab.models import MPICluster, ClusterCapacity
+
+
+class WarmPool(object):
+    """
+    Keeps settings.WARM_POOL_SIZES clusters booted with their dependencies installed, hidden from users
+    CreateMPIView claims a warm cluster of the requested size instead of waiting for vcluster-start
+    Warm clusters hold their nodes in the capacity ledger, refills stop once settings.MAX_TOTAL_INSTANCES is reached
+    """
+
+    def __init__(self):
+        self._refill_lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _claimable(self, cluster_size):
+        # online means install_dependencies has finished
+        return MPICluster.objects.filter(is_warm_pool=True, queued_for_deletion=False, status=2,
+                                         cluster_size=cluster_size - 1)
+
+    def has_claimable(self, cluster_size):
+        return self._claimable(cluster_size).exists()
+
+    def claim(self, cluster_size, **fields):
+        """
+        Hands over a warm cluster, fields (e.g. creator, cluster_name, is_public) are set on the claimed cluster
+        :param cluster_size: total node count
+        :return: the claimed MPICluster or None if there is no warm cluster of that size
+        """
+        for pk in self._claimable(cluster_size).order_by('created').values_list('id', flat=True):
+            # conditional update, concurrent claims of the same cluster cannot both succeed
+            if MPICluster.objects.filter(pk=pk, is_warm_pool=True, queued_for_deletion=False).update(
+                    is_warm_pool=False, updated=timezone.now(), **fields) == 1:
+                self.logger.info('Claimed warm MPI #{0}'.format(pk))
+                return MPICluster.objects.get(pk=pk)
+        return None
+
+    def refill(self):
+        with self._refill_lock:
+            for cluster_size, count in sorted(settings.WARM_POOL_SIZES.items()):
+                clusters = list(MPICluster.objects.filter(is_warm_pool=True, queued_for_deletion=False,
+                                                          cluster_size=cluster_size - 1).exclude(status=5)
+                                .order_by('-created').values_list('id', flat=True))
+
+                for pk in clusters[count:]:  # pool size was lowered
+                    if MPICluster.objects.filter(pk=pk, is_warm_pool=True).update(queued_for_deletion=True) == 1:
+                        MPICluster.objects.get(pk=pk).save()  # post_save queues the deletion
+
+                for _ in range(count - len(clusters)):
+                    if not ClusterCapacity.reserve(cluster_size):
+                        self.logger.info('Warm pool not refilled, no nodes available for a {0} node cluster'.format(
+                            cluster_size))
+                        return
+                    name = 'warm_{0}_{1}'.format(cluster_size,
+                                                 get_random_string(8, string.ascii_lowercase + string.digits))
+                    try:
+                        # post_save spawns the MPIThread, which creates the cluster and installs dependencies
+                        MPICluster.objects.create(cluster_name=name, instance_name=name,
+                                                  cluster_size=cluster_size - 1, is_public=False, is_warm_pool=True)
+                    except Exception:
+                        ClusterCapacity.release(cluster_size)
+                        raise
+                    self.logger.info('Creating warm cluster {0}'.format(name))
+
+    def refill_async(self):
+        # e.g. after a claim or once a deleted cluster released its nodes
+        if not settings.WARM_POOL_SIZES:
+            return
+
+        def run():
+            try:
+                self.refill()
+            except Exception:
+                self.logger.error('Error while refilling the warm pool', exc_info=True)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+warm_pool = WarmPool()